@@ -0,0 +1,237 @@
+############################## BENCHMARK SUITE #################################
+# Times the Python parts of nipype_pipeline.py and statistics.py on a synthetic phantom cohort (see phantom.py):
+#   first_volume       first volume of DSC_Source (get_first_image_of_time_series), without cache
+#   coregistration     LPS reorientation and resampling of all perfusion maps and the DSC mask (apply_flirt_matrix)
+#   triple_mask        label volume of the triple masks (build_triple_mask_labels)
+#   voi_statistics     statistics of all perfusion maps in all territories (voi_statistics)
+#   aggregation        manifest, VOI results store and wide table of the cohort (update_manifest, voi_results.py)
+#   extract_cohort     perfusion statistics of the cohort from the result folders (statistics.py extract_cohort)
+#   roc_confusion      relMTT vulnerability, confusion matrix, ROC and optimal threshold of statistics.py
+#                      on a larger synthetic table (statistics_subjects)
+# FSL and FreeSurfer nodes are not included. The times of the image benchmarks are per cohort.
+#
+# Every run appends its results with the current git commit to results_file (results.csv in this folder by default,
+# ignored by git), so runs of different commits can be compared,
+# i.e. pd.read_csv("benchmarks/results.csv").pivot_table("best_s", "commit", "benchmark")
+#
+# Run from the repository folder: python benchmarks/run_benchmarks.py [n_subjects] [results_file]
+
+import contextlib
+import datetime
+import glob
+import importlib.util
+import io
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import phantom
+from custom_nodes import get_first_image_of_time_series, apply_flirt_matrix, build_triple_mask_labels, voi_statistics
+from custom_nodes import update_manifest
+from voi_results import from_long_rows, write_subject, read_voi_results, to_wide
+
+
+#### DEFINITIONS ####
+n_subjects = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+dsc_matrix = (64, 64, 20)
+mprage_matrix = (128, 128, 96)
+timepoints = 40
+# subjects of the synthetic table of the statistics benchmark
+statistics_subjects = 1000
+# repetitions per benchmark, the fastest is reported as best_s
+n_repeats = 3
+results_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(repository, "benchmarks", "results.csv")
+
+
+# statistics.py has the name of a module of the standard library and is loaded from its path
+def load_statistics():
+    spec = importlib.util.spec_from_file_location("icad_statistics", os.path.join(repository, "statistics.py"))
+    module = importlib.util.module_from_spec(spec)
+    # registered, so worker processes of extract_cohort can import the functions
+    sys.modules["icad_statistics"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repository, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=repository) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# runs setup() and function() n_repeats times, only function() is timed
+def timeit(function, setup=None):
+    times = []
+    for _ in range(n_repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), float(np.median(times))
+
+
+## PIPELINE BENCHMARKS ##
+# inputs of the nodes: DSC mask (first volume > threshold), LPS MPRAGE as reference and GM, FLIRT matrix of the grids
+def prepare_subject(data_dir, work_dir):
+    import nibabel as nib
+    os.makedirs(work_dir, exist_ok=True)
+    first = nib.load(get_first_image_of_time_series(os.path.join(data_dir, "DSC_Source.nii.gz")))
+    dsc_mask = os.path.join(work_dir, "dsc_mask.nii.gz")
+    nib.save(nib.Nifti1Image((first.get_fdata() > 100).astype(np.uint8), first.affine), dsc_mask)
+    mprage = nib.load(os.path.join(data_dir, "MPRAGE.nii.gz"))
+    mprage = mprage.as_reoriented(nib.orientations.ornt_transform(nib.io_orientation(mprage.affine),
+                                                                  nib.orientations.axcodes2ornt("LPS")))
+    reference = os.path.join(work_dir, "MPRAGE_lps.nii.gz")
+    nib.save(mprage, reference)
+    gm = os.path.join(work_dir, "gm.nii.gz")
+    nib.save(nib.Nifti1Image((mprage.get_fdata() > 0).astype(np.uint8), mprage.affine), gm)
+    matrix = os.path.join(work_dir, "flirt.mat")
+    np.savetxt(matrix, phantom.flirt_matrix(dsc_mask, reference))
+    return {"dsc_mask": dsc_mask, "reference": reference, "gm": gm, "matrix": matrix,
+            "maps": sorted(glob.glob(os.path.join(data_dir, "DSC_pgui*"))),
+            "masks": sorted(glob.glob(os.path.join(data_dir, "Masken_cut", "*mask.nii.gz")))}
+
+
+# runs function in the working folder of every subject (custom nodes write to the current folder)
+def for_subjects(subjects, function):
+    cwd = os.getcwd()
+    try:
+        results = {}
+        for subject, inputs in subjects.items():
+            os.chdir(inputs["work_dir"])
+            results[subject] = function(inputs)
+        return results
+    finally:
+        os.chdir(cwd)
+
+
+def pipeline_benchmarks(directory, truth):
+    results = {}
+    subjects = {}
+    for subject in truth.index:
+        subjects[subject] = prepare_subject(os.path.join(directory, subject), os.path.join(directory, "work", subject))
+        subjects[subject]["work_dir"] = os.path.join(directory, "work", subject)
+        subjects[subject]["source"] = os.path.join(directory, subject, "DSC_Source.nii.gz")
+
+    def remove_first_volumes():
+        for inputs in subjects.values():
+            os.remove(inputs["source"][:-7] + "_0.nii.gz")
+    results["first_volume"] = timeit(
+        lambda: [get_first_image_of_time_series(inputs["source"]) for inputs in subjects.values()], remove_first_volumes)
+
+    def coregistration(inputs):
+        inputs["coreg"], inputs["coreg_mask"] = apply_flirt_matrix(inputs["maps"], inputs["dsc_mask"], inputs["matrix"],
+                                                                    inputs["reference"], orientation="LPS")
+    results["coregistration"] = timeit(lambda: for_subjects(subjects, coregistration))
+
+    def triple_mask(inputs):
+        inputs["labels"], inputs["label_names"], _ = build_triple_mask_labels(
+            inputs["coreg_mask"], inputs["gm"], inputs["masks"], orientation="LPS")
+    results["triple_mask"] = timeit(lambda: for_subjects(subjects, triple_mask))
+
+    def statistics(inputs):
+        inputs["table"] = voi_statistics(inputs["coreg"], inputs["labels"], inputs["label_names"])[0]
+    results["voi_statistics"] = timeit(lambda: for_subjects(subjects, statistics))
+
+    # manifest -> VOI results store -> wide table, as at the end of nipype_pipeline.py
+    manifest_file = os.path.join(directory, "manifest.csv")
+    store_dir = os.path.join(directory, "voi_results")
+
+    def clear_aggregation():
+        shutil.rmtree(store_dir, ignore_errors=True)
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+
+    def aggregation():
+        for subject, inputs in subjects.items():
+            update_manifest([inputs["table"]], subject, manifest_file)
+        for subject, rows in pd.read_csv(manifest_file).groupby("subject"):
+            write_subject(store_dir, subject, from_long_rows(rows))
+        to_wide(read_voi_results(store_dir))
+    results["aggregation"] = timeit(aggregation, clear_aggregation)
+
+    # result folders of the datasink as read by statistics.py
+    statistics_module = load_statistics()
+    run_dir = os.path.join(directory, "run")
+    for subject, inputs in subjects.items():
+        maps_dir = os.path.join(run_dir, statistics_module.maps_folder, subject)
+        masks_dir = os.path.join(run_dir, statistics_module.masks_folder, subject)
+        os.makedirs(maps_dir)
+        os.makedirs(masks_dir)
+        for f in inputs["coreg"]:
+            shutil.copy(f, os.path.join(maps_dir, os.path.basename(f).replace("_lps_flirt", "_reor_coreg")))
+        shutil.copy(inputs["labels"], os.path.join(masks_dir, statistics_module.labels_file))
+        shutil.copy(inputs["label_names"], os.path.join(masks_dir, statistics_module.labels_names))
+
+    # without cached perfusion data, all subjects are extracted
+    def clear_cache():
+        shutil.rmtree(os.path.join(run_dir, statistics_module.cache_folder), ignore_errors=True)
+    def extract_cohort():
+        with contextlib.redirect_stdout(io.StringIO()):
+            statistics_module.extract_cohort(list(subjects), run_dir, statistics_module.stats)
+    results["extract_cohort"] = timeit(extract_cohort, clear_cache)
+    return results
+
+
+## STATISTICS BENCHMARK ##
+# The analysis steps of the main part of statistics.py on a synthetic table of statistics_subjects subjects
+def statistics_benchmark():
+    st = load_statistics()
+    rng = np.random.default_rng(1)
+    truth = phantom.cohort_truth(statistics_subjects, rng=rng)
+    df_all = phantom.perfusion_table(truth, st.stats, rng=rng)
+    sim, sos = phantom.simulation_tables(truth, rng=rng)
+
+    def analysis():
+        df = df_all[[c for c in df_all.columns if c.startswith(st.perfusion_map + "_")]]
+        df = df.rename(columns=lambda column: column[len(st.perfusion_map):])
+        s = sim.copy()
+        s["Stenosis_L0_R1"] = sos["Stenosis_L0_R1"].values
+        s.index = s.index.str.replace("_", "0")
+        df["_MCA_median_relMTT"] = df._MCA_ipsi_median / df._MCA_contra_median
+        df["_MCA_median_vuln"] = np.where(df._MCA_median_relMTT >= st.relMTT_thr, True, False)
+        s["M2 R min"] = s[["M2 sup R", "M2 inf R"]].min(axis=1)
+        s["M2 L min"] = s[["M2 sup L", "M2 inf L"]].min(axis=1)
+        s["M2_ipsi"] = np.where(s["Stenosis_L0_R1"] == 0, s["M2 L min"].values, s["M2 R min"].values)
+        s["MCA_vuln"] = np.where(s["M2_ipsi"] < st.sim_thr, True, False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            st.create_confusion_matrix(df["_MCA_median_vuln"], s["MCA_vuln"])
+            roc = st.do_the_ROC(1 - df["_MCA_median_vuln"], s["M2_ipsi"])
+            st.opt_thr(roc, "MCA_median")
+    return {"roc_confusion": timeit(analysis)}
+
+
+if __name__ == "__main__":
+    commit = git_commit()
+    print("Benchmarks of commit", commit, "-", n_subjects, "phantom subjects")
+    with tempfile.TemporaryDirectory() as directory:
+        truth = phantom.make_cohort(directory, n_subjects, dsc_matrix=dsc_matrix, mprage_matrix=mprage_matrix,
+                                    timepoints=timepoints)
+        results = pipeline_benchmarks(directory, truth)
+    results.update(statistics_benchmark())
+
+    date = datetime.datetime.now().isoformat(timespec="seconds")
+    rows = [{"commit": commit, "date": date, "python": platform.python_version(), "benchmark": name,
+             "n_subjects": statistics_subjects if name == "roc_confusion" else n_subjects,
+             "dsc_matrix": "x".join(map(str, dsc_matrix)), "mprage_matrix": "x".join(map(str, mprage_matrix)),
+             "timepoints": timepoints, "repeats": n_repeats, "best_s": round(best, 4), "median_s": round(median, 4)}
+            for name, (best, median) in results.items()]
+    table = pd.DataFrame(rows)
+    print(table[["benchmark", "n_subjects", "best_s", "median_s"]].to_string(index=False))
+    table.to_csv(results_file, mode="a", header=not os.path.exists(results_file), index=False)
+    print("Results appended to", results_file)
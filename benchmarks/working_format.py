@@ -0,0 +1,97 @@
+############################## WORKING FORMAT BENCHMARK ########################
+# Compares wall time and disk use of the working file formats of nipype_pipeline.py (working_output_type).
+# One subject is simulated as a chain of nodes, each reading the image of the previous node and writing a new one
+# (like NUC -> BET -> FAST -> coregistration), followed by the datasink which saves every image as .nii.gz.
+#
+# Settings:
+#   NIFTI          uncompressed working files, gzip (level 6) only in the datasink
+#   NIFTI_GZ (1)   working files gzipped with level 1 (nibabel, custom nodes)
+#   NIFTI_GZ (6)   working files gzipped with level 6 (zlib default, FSL tools)
+#
+# Run: python benchmarks/working_format.py [image.nii.gz]
+# Without an image, a synthetic MPRAGE-sized volume (noise on a smooth head-like background) is used.
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+
+#### DEFINITIONS ####
+# number of nodes reading and writing the image of one subject
+n_steps = 8
+# number of nodes reading each image (i.e. the skull-stripped MPRAGE is read by FAST, FLIRT and the coregistration)
+n_reads = 2
+# repetitions per setting, the fastest run is reported
+n_repeats = 3
+# shape of the synthetic image (MPRAGE)
+shape = (256, 256, 176)
+settings = [("NIFTI", ".nii", None), ("NIFTI_GZ (1)", ".nii.gz", 1), ("NIFTI_GZ (6)", ".nii.gz", 6)]
+sink_compress_level = 6
+
+
+def synthetic_image(shape):
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"))
+    head = (np.sum(grid ** 2, axis=0) < 0.8).astype(np.float32)
+    data = head * (500 + 100 * grid[0]) + rng.normal(0, 20, shape).astype(np.float32) * head
+    return nib.Nifti1Image(data.astype(np.float32), np.eye(4))
+
+
+def folder_size(directory):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(directory) for f in files)
+
+
+# one node: reads the whole image (as FSL does, n_reads times for the other nodes using it), changes it and writes it
+# in the working format
+def run_chain(image, directory, extension, level):
+    nib.openers.Opener.default_compresslevel = level or 1
+    path = os.path.join(directory, "step_0" + extension)
+    nib.save(image, path)
+    outputs = [path]
+    for step in range(1, n_steps + 1):
+        for _ in range(n_reads):
+            data = np.asanyarray(nib.load(outputs[-1]).dataobj, dtype=np.float32)
+        path = os.path.join(directory, "step_%d%s" % (step, extension))
+        nib.save(nib.Nifti1Image(data * 1.001, image.affine), path)
+        outputs.append(path)
+    return outputs
+
+
+# datasink: copies .nii.gz files and compresses .nii files
+def run_sink(outputs, directory):
+    os.makedirs(directory)
+    for path in outputs:
+        target = os.path.join(directory, os.path.basename(path))
+        if path.endswith(".nii"):
+            with open(path, "rb") as f_in, gzip.open(target + ".gz", "wb", compresslevel=sink_compress_level) as f_out:
+                shutil.copyfileobj(f_in, f_out, 2 ** 20)
+        else:
+            shutil.copyfile(path, target)
+
+
+if __name__ == "__main__":
+    image = nib.load(sys.argv[1]) if len(sys.argv) > 1 else synthetic_image(shape)
+    image = nib.Nifti1Image(np.asanyarray(image.dataobj, dtype=np.float32), image.affine)
+    print("Image shape", image.shape, "-", n_steps, "nodes per subject, every image read", n_reads, "times")
+    print("%-14s %10s %10s %10s %12s %12s" % ("setting", "nodes [s]", "sink [s]", "total [s]", "working [MB]", "sink [MB]"))
+    for name, extension, level in settings:
+        best = None
+        for _ in range(n_repeats):
+            with tempfile.TemporaryDirectory() as directory:
+                working = os.path.join(directory, "working")
+                os.makedirs(working)
+                t0 = time.perf_counter()
+                outputs = run_chain(image, working, extension, level)
+                t1 = time.perf_counter()
+                run_sink(outputs, os.path.join(directory, "sink"))
+                t2 = time.perf_counter()
+                result = (t1 - t0, t2 - t1, folder_size(working) / 2 ** 20, folder_size(os.path.join(directory, "sink")) / 2 ** 20)
+            if best is None or sum(result[:2]) < sum(best[:2]):
+                best = result
+        print("%-14s %10.2f %10.2f %10.2f %12.1f %12.1f" % (name, best[0], best[1], best[0] + best[1], best[2], best[3]))
@@ -0,0 +1,412 @@
+############################## CUSTOM NODE FUNCTIONS ###########################
+# The functions in this file are wrapped as nipype Function nodes in nipype_pipeline.py.
+# Nipype only passes the source code of a function to the node, therefore every function
+# has to import the packages it uses itself and must not call other functions of this file.
+# Images are written as .nii (output_type='NIFTI') or .nii.gz (output_type='NIFTI_GZ', nibabel gzip level 1).
+
+
+## FILE NAMES ##
+# Name of a perfusion map without the file extension and the suffixes of the pipeline nodes ('_lps', '_flirt',
+# '_masked') and of the datasink substitutions ('_reor', '_coreg'), i.e. DSC_pgui_parametric_MTT_lps_flirt.nii.gz,
+# DSC_pgui_parametric_MTT_reor_coreg.nii.gz and DSC_pgui_parametric_MTT_coreg.nii.gz -> DSC_pgui_parametric_MTT.
+# Used by statistics.py; the node functions below keep their own copy.
+def strip_name(path):
+    import os
+    import re
+    name = re.sub(r"\.nii(\.gz)?$", "", os.path.basename(path))
+    return re.sub(r"(_lps|_reor|_flirt|_coreg|_masked)+$", "", name)
+
+
+## CUSTOM NODE DSC_SOURCE FIRST TIMEPOINT EXTRACTION ##
+# Only the first volume of the DSC time series is read through the array proxy (dataobj) of nibabel.
+# A gzipped series is decompressed as a stream up to the end of the first volume, which is stored first in the file,
+# so peak memory is one volume instead of all timepoints.
+# The volume is saved next to the source file and reused by later runs as long as it is newer than the source.
+def get_first_image_of_time_series(in_file):
+    import os
+    import nibabel as nib
+    #extract path from DSC-source file name dropping the seven last digits '.nii.gz'
+    save_path=in_file[:-7]+"_0.nii.gz"
+    #skip the extraction if the volume was already extracted from this source file
+    if os.path.exists(save_path) and os.path.getmtime(save_path) >= os.path.getmtime(in_file):
+        return save_path
+    # load the header only, the data stays on disk
+    image = nib.load(in_file)
+    #subset the picture keeping x, y, z coordinates but dropping all other timepoints but 0
+    data_1 = image.dataobj[(slice(None),) * 3 + (0,) * (len(image.shape) - 3)]
+    #convert array to nifti format
+    image_1 = nib.Nifti1Image(data_1, image.affine)
+    #save the file in the subject folder without data sink; renaming a temporary file prevents that parallel runs
+    #read a partially written volume
+    temp_path = in_file[:-7] + "_0.%d.tmp.nii.gz" % os.getpid()
+    nib.save(image_1, temp_path)
+    os.replace(temp_path, save_path)
+    return save_path
+
+
+## CUSTOM NODE COREGISTRATION OF PERFUSION MAPS AND DSC MASK ##
+# Replaces one fsl ApplyXFM call per perfusion map and one for the DSC brain mask.
+# All images share the FLIRT matrix and the reference, so the mapping of reference voxels to input voxels
+# is computed once and applied to all images, stacked to one (image x voxel) array, by trilinear interpolation.
+# FLIRT matrices map FSL scaled-mm coordinates (voxel index x voxel size, x index flipped if the determinant of the
+# affine is positive) of the input image to those of the reference. Reference voxels outside the input image are 0.
+# The reference is processed in slabs of slab_size slices along z to limit the memory of the interpolation.
+# Like FLIRT, the outputs keep the data type of the inputs (integer types are rounded).
+# If orientation is given (i.e. 'LPS'), the perfusion maps (not the mask) are reoriented like nipype Reorient before
+# the matrix is applied. The reorientation only flips and transposes the array in memory (views) and updates the affine,
+# no reoriented file is written.
+def apply_flirt_matrix(in_files, mask_file, in_matrix_file, reference, orientation=None, output_type="NIFTI_GZ",
+                       slab_size=16):
+    import os
+    import re
+    import nibabel as nib
+    import numpy as np
+
+    # data, affine and voxel size of an image, reoriented to orientation as by nipype Reorient
+    def load_oriented(image, orientation):
+        data = np.asanyarray(image.dataobj, dtype=np.float32)
+        if not orientation:
+            return data, image.affine, image.header.get_zooms()[:3], False
+        transform = nib.orientations.ornt_transform(nib.io_orientation(image.affine),
+                                                    nib.orientations.axcodes2ornt(orientation))
+        if np.array_equal(transform, [[axis, 1] for axis in range(3)]):
+            return data, image.affine, image.header.get_zooms()[:3], False
+        affine = image.affine @ nib.orientations.inv_ornt_aff(transform, image.shape)
+        return nib.orientations.apply_orientation(data, transform), affine, nib.affines.voxel_sizes(affine), True
+
+    # voxel index -> FSL scaled-mm coordinates
+    def fsl_scaled_mm(shape, affine, zooms):
+        scale = np.diag(list(zooms) + [1.0])
+        if np.linalg.det(affine[:3, :3]) > 0:
+            flip = np.eye(4)
+            flip[0, 0] = -1
+            flip[0, 3] = shape[0] - 1
+            scale = scale @ flip
+        return scale
+
+    reference_image = nib.load(reference)
+    out_shape = reference_image.shape[:3]
+    images = [nib.load(f) for f in list(in_files) + [mask_file]]
+    oriented = [load_oriented(image, orientation) for image in images[:-1]] + [load_oriented(images[-1], None)]
+    in_shape, in_affine, in_zooms = oriented[0][0].shape[:3], oriented[0][1], oriented[0][2]
+    # the mapping is computed from the grid of the first image, all (reoriented) images must be on the same grid
+    for f, (volume, affine, zooms, _) in zip(list(in_files) + [mask_file], oriented):
+        if volume.shape[:3] != in_shape:
+            raise ValueError("Shape of %s %s does not match the shape of %s %s" % (f, volume.shape, in_files[0], in_shape))
+        if not (np.allclose(affine, in_affine, atol=1e-3) and np.allclose(zooms, in_zooms, atol=1e-4)):
+            raise ValueError("Grid of %s (affine %s, voxel size %s) does not match the grid of %s (affine %s, voxel size %s)"
+                             % (f, affine.tolist(), list(zooms), in_files[0], in_affine.tolist(), list(in_zooms)))
+
+    # reference voxel -> input voxel, computed once for all images
+    matrix = np.loadtxt(in_matrix_file)
+    mapping = (np.linalg.inv(fsl_scaled_mm(in_shape, in_affine, in_zooms)) @ np.linalg.inv(matrix)
+               @ fsl_scaled_mm(out_shape, reference_image.affine, reference_image.header.get_zooms()[:3]))
+
+    # all images as one (image x voxel) array, voxels in C order of the (reoriented) input grid
+    data = np.stack([volume.reshape(-1) for volume, _, _, _ in oriented])
+    reoriented_images = [item[3] for item in oriented[:-1]]
+    # the loaded volumes are no longer needed, only the stacked copy
+    del oriented[:]
+    strides = np.array([in_shape[1] * in_shape[2], in_shape[2], 1])
+    upper = np.array(in_shape) - 1
+    out = np.zeros((len(images),) + out_shape, dtype=np.float32)
+
+    step = np.where(upper > 0, strides, 0)
+    for z0 in range(0, out_shape[2], slab_size):
+        z1 = min(z0 + slab_size, out_shape[2])
+        # reference voxels of the slab and the corresponding input voxels; only those inside the input are interpolated
+        ref = np.indices(out_shape[:2] + (z1 - z0,)).reshape(3, -1)
+        ref[2] += z0
+        coords = mapping[:3, :3] @ ref + mapping[:3, 3:]
+        inside = np.flatnonzero(np.all((coords >= -1e-6) & (coords <= upper[:, np.newaxis] + 1e-6), axis=0))
+        coords = np.clip(coords[:, inside], 0, upper[:, np.newaxis])
+        base = np.minimum(np.floor(coords), np.maximum(upper - 1, 0)[:, np.newaxis]).astype(np.int64)
+        weight = (coords - base).astype(np.float32)
+        index = strides @ base
+        values = np.zeros((len(images), inside.size), dtype=np.float32)
+        for corner in range(8):
+            offset = [(corner >> axis) & 1 for axis in range(3)]
+            w = np.prod([weight[axis] if offset[axis] else 1 - weight[axis] for axis in range(3)], axis=0)
+            values += w * data[:, index + step @ offset]
+        slab = np.zeros((len(images), ref.shape[1]), dtype=np.float32)
+        slab[:, inside] = values
+        out[..., z0:z1] = slab.reshape((len(images), out_shape[0], out_shape[1], z1 - z0))
+
+    # outputs are named like the outputs of FLIRT (<input>_flirt.nii.gz, <input>_lps_flirt.nii.gz if reoriented)
+    # and saved on the grid of the reference
+    extension = {"NIFTI": ".nii", "NIFTI_GZ": ".nii.gz"}[output_type]
+    suffixes = ["_" + orientation.lower() if reoriented else "" for reoriented in reoriented_images] + [""]
+    out_files = []
+    for in_file, image, volume, suffix in zip(list(in_files) + [mask_file], images, out, suffixes):
+        dtype = image.get_data_dtype()
+        slope, inter = image.header.get_slope_inter()
+        if np.issubdtype(dtype, np.integer) and slope in (None, 1) and inter in (None, 0):
+            info = np.iinfo(dtype)
+            volume = np.clip(np.rint(volume), info.min, info.max).astype(dtype)
+        else:
+            dtype = np.float32
+        header = reference_image.header.copy()
+        header.set_data_dtype(dtype)
+        header.set_slope_inter(1, 0)
+        name = re.sub(r"\.nii(\.gz)?$", "", os.path.basename(in_file)) + suffix + "_flirt" + extension
+        out_file = os.path.join(os.getcwd(), name)
+        nib.save(nib.Nifti1Image(volume, reference_image.affine, header), out_file)
+        out_files.append(out_file)
+    return out_files[:-1], out_files[-1]
+
+
+## CUSTOM NODE TRIPLE MASK LABEL VOLUME ##
+# Replaces the chain of fsl ApplyMask nodes (DSC mask x GM mask, then DSC_GM mask x 8 VOI masks).
+# The coregistered DSC brain mask, the GM class of FAST and all reoriented VOI masks are combined in memory
+# into one uint8 label volume: bit i is set in a voxel if it lies in the DSC mask, in GM and in VOI mask i
+# (like fslmaths -mas, mask values > 0 count; VOI masks count where != 0). Territories may overlap (i.e. hemi and MCA).
+# The territory names in bit order are saved in a JSON sidecar next to the label volume.
+# Per-territory triple masks are only written if write_masks=True.
+# If orientation is given (i.e. 'LPS'), the VOI masks are reoriented like nipype Reorient in memory (array views).
+def build_triple_mask_labels(dsc_mask_file, gm_file, voi_mask_files, orientation=None, write_masks=False,
+                             output_type="NIFTI_GZ"):
+    import json
+    import os
+    import re
+    import nibabel as nib
+    import numpy as np
+
+    # territory names are taken from the VOI mask file names, e.g. 'MCA_ipsi_mask_lps.nii.gz' -> 'MCA_ipsi'
+    def territory_name(path):
+        name = re.sub(r"\.nii(\.gz)?$", "", os.path.basename(path))
+        return re.sub(r"_mask$", "", re.sub(r"(_lps|_flirt|_masked)+$", "", name))
+
+    voi_mask_files = sorted(voi_mask_files, key=territory_name)
+    territories = [territory_name(f) for f in voi_mask_files]
+    if len(territories) > 8:
+        raise ValueError("A uint8 label volume holds at most 8 territories, got %d" % len(territories))
+
+    # all masks must be on the grid of the DSC mask (as in apply_flirt_matrix)
+    def check_grid(path, affine):
+        if not np.allclose(affine, dsc_image.affine, atol=1e-3):
+            raise ValueError("Grid of %s (affine %s) does not match the grid of %s (affine %s)"
+                             % (path, affine.tolist(), dsc_mask_file, dsc_image.affine.tolist()))
+
+    dsc_image = nib.load(dsc_mask_file)
+    dsc_gm = np.asanyarray(dsc_image.dataobj) > 0
+    gm_image = nib.load(gm_file)
+    gm = np.asanyarray(gm_image.dataobj) > 0
+    if gm.shape != dsc_gm.shape:
+        raise ValueError("Shape of %s %s does not match the shape of %s %s" % (gm_file, gm.shape, dsc_mask_file, dsc_gm.shape))
+    check_grid(gm_file, gm_image.affine)
+    dsc_gm &= gm
+    del gm
+
+    labels = np.zeros(dsc_gm.shape, dtype=np.uint8)
+    for bit, voi_file in enumerate(voi_mask_files):
+        voi_image = nib.load(voi_file)
+        voi = np.asanyarray(voi_image.dataobj) != 0
+        affine = voi_image.affine
+        if orientation:
+            transform = nib.orientations.ornt_transform(nib.io_orientation(voi_image.affine),
+                                                        nib.orientations.axcodes2ornt(orientation))
+            voi = nib.orientations.apply_orientation(voi, transform)
+            affine = voi_image.affine @ nib.orientations.inv_ornt_aff(transform, voi_image.shape)
+        if voi.shape != labels.shape:
+            raise ValueError("Shape of %s %s does not match the shape of %s %s" % (voi_file, voi.shape, dsc_mask_file, labels.shape))
+        check_grid(voi_file, affine)
+        labels[voi & dsc_gm] |= np.uint8(1 << bit)
+
+    # the label volume is saved on the grid of the GM mask (MPRAGE)
+    extension = {"NIFTI": ".nii", "NIFTI_GZ": ".nii.gz"}[output_type]
+    header = gm_image.header.copy()
+    header.set_data_dtype(np.uint8)
+    header.set_slope_inter(1, 0)
+    label_file = os.path.join(os.getcwd(), "triple_mask_labels" + extension)
+    nib.save(nib.Nifti1Image(labels, gm_image.affine, header), label_file)
+    label_names = os.path.join(os.getcwd(), "triple_mask_labels.json")
+    with open(label_names, "w") as f:
+        json.dump({"territories": territories}, f, indent=1)
+
+    mask_files = []
+    if write_masks:
+        for bit, territory in enumerate(territories):
+            # one folder per territory, the leading '_' keeps the folder in the datasink output
+            out_dir = os.path.join(os.getcwd(), "_" + territory)
+            os.makedirs(out_dir, exist_ok=True)
+            out_file = os.path.join(out_dir, territory + "_mask" + extension)
+            mask = ((labels >> bit) & 1).astype(np.uint8)
+            nib.save(nib.Nifti1Image(mask, gm_image.affine, header), out_file)
+            mask_files.append(out_file)
+    return label_file, label_names, mask_files
+
+
+## CUSTOM NODE VOI STATISTICS ##
+# Replaces the former chain of 12 Select, 12 VOI_masking (fsl ApplyMask) and 12 averaging (fsl ImageMeants) nodes.
+# Every coregistered perfusion map is loaded once and all triple masks (DSC, GM, VOI) of the label volume
+# (see build_triple_mask_labels) are applied with numpy.
+# Returns one table with mean, median and number of voxels for every perfusion map x territory.
+# Like fslmeants, mean, median and n_voxels include all voxels of a territory, also those with intensity 0.
+# mean_nonzero, median_nonzero and n_nonzero exclude voxels with value 0 (no perfusion value), as extract_patient of
+# statistics.py, so the VOI results store, the histograms and statistics.py give the same relMTT.
+# Masked perfusion images are only written if write_masked=True.
+# In the same pass a histogram of all voxels of every perfusion map x territory is saved to voi_histograms.npz (n_bins
+# bins from the minimum to the maximum of the territory, with the number of zero voxels and the sum of the values), so other
+# percentiles can be computed later without the images (see voi_histograms.py).
+# With write_relative=True relative perfusion maps <map>_rel are written as well: every voxel of a territory pair
+# (i.e. MCA_ipsi and MCA_contra) is divided by the non-zero median of the contralateral territory of the same map. Voxels in
+# several territories (i.e. MCA and hemi) are normalized by the smallest territory. The ipsi/contra masks already
+# follow the side of the stenosis. For MTT maps, voxels of the ipsilateral territories with relative MTT >=
+# relative_threshold are written to a vulnerability mask <map>_rel_vulnerable.
+def voi_statistics(in_files, label_file, label_names, write_masked=False, output_type="NIFTI_GZ", n_bins=1024,
+                   write_relative=False, relative_threshold=1.387):
+    import json
+    import os
+    import re
+    import nibabel as nib
+    import numpy as np
+    import pandas as pd
+
+    # drops the file extension and the suffixes added by the pipeline (as strip_name above)
+    def strip_name(path):
+        name = re.sub(r"\.nii(\.gz)?$", "", os.path.basename(path))
+        return re.sub(r"(_lps|_reor|_flirt|_coreg|_masked)+$", "", name)
+
+    extension = {"NIFTI": ".nii", "NIFTI_GZ": ".nii.gz"}[output_type]
+
+    # territory names in bit order of the label volume
+    with open(label_names) as f:
+        territories = json.load(f)["territories"]
+
+    # the label volume is unpacked to one boolean (territory x voxel) matrix, restricted to voxels inside any territory
+    labels = np.asanyarray(nib.load(label_file).dataobj).astype(np.uint8, copy=False)
+    shape = labels.shape
+    labels = labels.reshape(-1)
+    inside = np.flatnonzero(labels)
+    bits = np.arange(len(territories), dtype=labels.dtype)
+    masks = ((labels[inside][np.newaxis, :] >> bits[:, np.newaxis]) & 1).astype(bool)
+
+    # territory pairs of the relative maps (voxels of both sides, index of the contralateral territory),
+    # largest first, so that voxels of smaller territories are overwritten with their own normalization
+    # the vulnerability masks only hold voxels of the ipsilateral territories of the pairs
+    pairs = []
+    in_ipsi = np.zeros(inside.size, dtype=bool)
+    for territory in territories:
+        if territory.endswith("_ipsi") and territory[:-len("_ipsi")] + "_contra" in territories:
+            contra = territories.index(territory[:-len("_ipsi")] + "_contra")
+            pair = np.flatnonzero(masks[territories.index(territory)] | masks[contra])
+            pairs.append((pair, contra))
+            in_ipsi |= masks[territories.index(territory)]
+    pairs.sort(key=lambda pair: -pair[0].size)
+
+    rows = []
+    masked_files = []
+    relative_files = []
+    vulnerability_files = []
+    histograms = {"map": [], "territory": [], "lo": [], "hi": [], "n_zero": [], "sum": [], "counts": []}
+    for in_file in in_files:
+        image = nib.load(in_file)
+        if image.shape != shape:
+            raise ValueError("Shape of %s %s does not match the shape of the masks %s" % (in_file, image.shape, shape))
+        data = np.asanyarray(image.dataobj, dtype=np.float32).reshape(-1)
+        values = data[inside]
+        for territory, mask in zip(territories, masks):
+            voxels = values[mask]
+            nonzero = voxels[voxels != 0]
+            row = {"map": strip_name(in_file), "territory": territory}
+            for suffix, selected in (("", voxels), ("_nonzero", nonzero)):
+                row["mean" + suffix] = selected.mean(dtype=np.float64) if selected.size else np.nan
+                row["median" + suffix] = np.median(selected) if selected.size else np.nan
+            row["n_voxels"], row["n_nonzero"] = voxels.size, nonzero.size
+            rows.append(row)
+
+            counts = np.zeros(n_bins, dtype=np.uint32)
+            lo = hi = np.nan
+            if voxels.size:
+                lo, hi = float(voxels.min()), float(voxels.max())
+                index = np.zeros(voxels.size, dtype=np.int64)
+                if hi > lo:
+                    index = np.minimum(((voxels.astype(np.float64) - lo) * (n_bins / (hi - lo))).astype(np.int64),
+                                       n_bins - 1)
+                counts += np.bincount(index, minlength=n_bins).astype(np.uint32)
+            for key, value in (("map", strip_name(in_file)), ("territory", territory), ("lo", lo), ("hi", hi),
+                               ("n_zero", np.count_nonzero(voxels == 0)), ("sum", voxels.sum(dtype=np.float64)),
+                               ("counts", counts)):
+                histograms[key].append(value)
+
+            if write_masked:
+                # one folder per territory, the leading '_' keeps the folder in the datasink output
+                out_dir = os.path.join(os.getcwd(), "_" + territory)
+                os.makedirs(out_dir, exist_ok=True)
+                masked = np.zeros(data.size, dtype=np.float32)
+                masked[inside[mask]] = voxels
+                out_file = os.path.join(out_dir, re.sub(r"\.nii(\.gz)?$", "", os.path.basename(in_file)) + extension)
+                masked_image = nib.Nifti1Image(masked.reshape(shape), image.affine, image.header)
+                masked_image.set_data_dtype(np.float32)
+                nib.save(masked_image, out_file)
+                masked_files.append(out_file)
+
+        if write_relative:
+            medians = [row["median_nonzero"] for row in rows[-len(territories):]]
+            relative = np.zeros(inside.size, dtype=np.float32)
+            for pair, contra in pairs:
+                # territories without voxels or a median of 0 give no relative values
+                if medians[contra] > 0:
+                    relative[pair] = values[pair] / np.float32(medians[contra])
+            out_file = os.path.join(os.getcwd(), strip_name(in_file) + "_rel" + extension)
+            relative_image = np.zeros(data.size, dtype=np.float32)
+            relative_image[inside] = relative
+            relative_image = nib.Nifti1Image(relative_image.reshape(shape), image.affine, image.header)
+            relative_image.set_data_dtype(np.float32)
+            nib.save(relative_image, out_file)
+            relative_files.append(out_file)
+
+            if strip_name(in_file).endswith("_MTT"):
+                vulnerable = np.zeros(data.size, dtype=np.uint8)
+                vulnerable[inside] = in_ipsi & (relative >= relative_threshold)
+                out_file = os.path.join(os.getcwd(), strip_name(in_file) + "_rel_vulnerable" + extension)
+                mask_image = nib.Nifti1Image(vulnerable.reshape(shape), image.affine, image.header)
+                mask_image.set_data_dtype(np.uint8)
+                nib.save(mask_image, out_file)
+                vulnerability_files.append(out_file)
+
+    out_table = os.path.join(os.getcwd(), "voi_statistics.csv")
+    pd.DataFrame(rows, columns=["map", "territory", "mean", "median", "n_voxels", "mean_nonzero", "median_nonzero",
+                                "n_nonzero"]).to_csv(out_table, index=False)
+    out_histograms = os.path.join(os.getcwd(), "voi_histograms.npz")
+    np.savez_compressed(out_histograms, n_bins=n_bins, counts=np.array(histograms.pop("counts")).reshape(-1, n_bins),
+                        **{key: np.array(values) for key, values in histograms.items()})
+    return out_table, masked_files, out_histograms, relative_files, vulnerability_files
+
+
+## CUSTOM NODE RESULTS MANIFEST ##
+# Runs after the datasink of a subject. The VOI statistics table saved by the datasink is appended to one manifest
+# (subject, map, territory, statistic, value, path) for the whole cohort, so the aggregation reads one index file
+# instead of searching the datasink folders. An flock on the sidecar <manifest>.lock serializes subjects finishing at
+# the same time; the lock is released by the operating system when a process dies, so a killed run leaves no stale lock.
+# The rows of remove_subjects are removed under the same lock (before a run adds their new rows).
+def update_manifest(sink_files, subject_id, manifest_file, remove_subjects=()):
+    import fcntl
+    import os
+    import pandas as pd
+
+    sink_files = sink_files if isinstance(sink_files, list) else [sink_files]
+    tables = [f for f in sink_files if isinstance(f, str) and f.endswith("voi_statistics.csv")]
+    rows = []
+    for path in tables:
+        table = pd.read_csv(path).melt(id_vars=["map", "territory"], var_name="statistic")
+        table.insert(0, "subject", subject_id)
+        table["path"] = path
+        rows.append(table)
+    if not rows and not (remove_subjects and os.path.exists(manifest_file)):
+        return manifest_file
+
+    # the lock file is kept: removing it would let a waiting process lock the removed file
+    with open(manifest_file + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if remove_subjects and os.path.exists(manifest_file):
+                manifest = pd.read_csv(manifest_file)
+                manifest[~manifest["subject"].isin(list(remove_subjects))].to_csv(manifest_file + ".tmp", index=False)
+                os.replace(manifest_file + ".tmp", manifest_file)
+            new_file = not os.path.exists(manifest_file)
+            if rows:
+                pd.concat(rows).to_csv(manifest_file, mode="a", header=new_file, index=False)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return manifest_file
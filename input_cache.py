@@ -0,0 +1,83 @@
+############################## INPUT CACHE #####################################
+# Cache of the parsed inputs of statistics.py (simulation tables, perfusion statistics) in a folder of pickle files.
+# Every entry <name>.pkl holds a key and a value. The key contains a fingerprint of the source files of the entry,
+# so an entry is rebuilt as soon as a source file changes, and stored again under the same name (the stale entry is
+# replaced). Entries whose source files no longer exist are removed by prune.
+#
+# Fingerprints use path, size and modification time of the files; with hash_content = True the file contents are
+# hashed instead of the modification times (slower, but also detects files copied with new times and unchanged content).
+
+import glob
+import hashlib
+import os
+import pickle
+
+
+## FINGERPRINT ##
+def fingerprint(paths, hash_content=False):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(os.path.abspath(path).encode())
+        if not os.path.exists(path):
+            digest.update(b"missing")
+        elif hash_content:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2 ** 20), b""):
+                    digest.update(block)
+        else:
+            stat = os.stat(path)
+            digest.update(("%d %d" % (stat.st_size, stat.st_mtime_ns)).encode())
+    return digest.hexdigest()
+
+
+## ENTRIES ##
+def _entry_path(cache_dir, name):
+    return os.path.join(cache_dir, name + ".pkl")
+
+
+# value of the entry name if it was stored with key, otherwise None (missing, stale or unreadable entry)
+def load_entry(cache_dir, name, key):
+    try:
+        with open(_entry_path(cache_dir, name), "rb") as f:
+            entry = pickle.load(f)
+    except Exception:
+        return None
+    return entry["value"] if entry.get("key") == key else None
+
+
+# stores value under name, replacing an older entry; sources are the files checked by prune
+def store_entry(cache_dir, name, key, value, sources=()):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _entry_path(cache_dir, name)
+    # written to a temporary file first, so an interrupted run does not leave a broken entry
+    tmp = path + ".tmp%d" % os.getpid()
+    with open(tmp, "wb") as f:
+        pickle.dump({"key": key, "sources": [os.path.abspath(s) for s in sources], "value": value}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+# value of the entry name; build() is called and its result stored if a source file or key changed
+def cached(cache_dir, name, sources, build, key="", hash_content=False):
+    key = key + "|" + fingerprint(sources, hash_content)
+    value = load_entry(cache_dir, name, key)
+    if value is None:
+        value = build()
+        store_entry(cache_dir, name, key, value, sources)
+    return value
+
+
+## PRUNE ##
+# removes unreadable entries and entries with missing source files; returns the names of the removed entries
+def prune(cache_dir):
+    removed = []
+    for path in glob.glob(os.path.join(cache_dir, "*.pkl")):
+        try:
+            with open(path, "rb") as f:
+                sources = pickle.load(f).get("sources", [])
+        except Exception:
+            sources = None
+        if sources is None or not all(os.path.exists(source) for source in sources):
+            os.remove(path)
+            removed.append(os.path.basename(path)[:-len(".pkl")])
+    return removed
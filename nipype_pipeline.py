@@ -1,23 +1,18 @@
-import nipype.interfaces.fsl as fsl
-from os.path import join as opj
-import nipype.interfaces.freesurfer as fs
-from nipype.interfaces.io import SelectFiles, DataSink
-from nipype.pipeline.engine import Workflow, Node, MapNode
-from nipype.interfaces.utility import IdentityInterface, Select
+import argparse
+import glob
+import hashlib
+import json
 import os
+import sys
 import time
-from nipype.interfaces.image import Reorient
-from nipype import Node, Function
-from nipype.interfaces.fsl import ImageMeants
-from pathlib import Path
-import pandas as pd
-
-
-# start timer to calculate run time of the script
-start = time.time()
+from os.path import join as opj
+# nipype, the FSL/FreeSurfer interfaces and pandas are imported by the stages that need them (see STAGES), so the
+# aggregation does not pay the startup of the workflow
 
 
 ############################## SET PATHS AND SUBS ##############################
+# Default settings; every setting can be replaced in a JSON config file (python nipype_pipeline.py --config run.json)
+# "python nipype_pipeline.py --write-config run.json" writes the defaults as a starting point
 
 # give your workflow a name
 workflow_name = "run_01"
@@ -27,682 +22,682 @@ experiment_dir = "/fast/users/..."
 results_dir = "/fast/users/.../results"
 # set number of CPU cores for multiple processing
 cpus = 8
-# name the subjects to run the script on
+# memory budget (GB) for all nodes running at the same time; None uses 90% of the system memory (nipype default)
+# nodes only start if their estimated memory fits into the free budget (see resources.py)
+memory_gb = None
+# record peak memory and CPU use of every node (nipype resource monitor, requires psutil)
+# the recordings of earlier runs replace the default estimates of resources.py
+record_resources = True
+# write a report of run time, CPU time, peak memory and file sizes of every node to 46_Profiling (see profiling.py)
+# CPU time and memory are only reported with record_resources = True
+write_profile_report = True
+# shared store for results of NUC, BET, FAST and FLIRT, reused by all runs and workflows; None disables the store
+result_store_dir = "/fast/users/.../result_store"
+# entries of the result store are removed if unused for this number of days or if the store grows beyond this size
+result_store_max_age_days = 180
+result_store_max_size_gb = 500
+# name the subjects to run the script on; None includes all subject folders found in experiment_dir
 subject_list = ["PEG0005","PEG0006"]
+# file format of the images passed between nodes: "NIFTI" (uncompressed, no gzip time, memory-mapped reads) or
+# "NIFTI_GZ" (less disk space in the working directory); images saved to the datasink are always .nii.gz
+# FreeSurfer NUC keeps the format of its input image (.nii.gz)
+working_output_type = "NIFTI"
+# a failing node only stops its own subject; the crash files of failed subjects are moved to 47_Failed_subjects and
+# their status is kept in subject_status.json ("python nipype_pipeline.py resume" runs them again, see subject_status.py)
+# subjects whose crash files all match one of transient_errors (regular expressions) are run again up to max_retries
+# times in the same run; nipype reuses the nodes that finished before the failure
+max_retries = 1
+transient_errors = ["MemoryError", "Stale file handle", "Resource temporarily unavailable", "No space left on device",
+                    "Input/output error", "BrokenProcessPool", "[Tt]imed? ?out"]
+# incremental mode: only subjects that are new or whose input files changed since the last run are processed,
+# their results replace their tables in the VOI results store in 45_Results_VOI_avg
+incremental = True
+
+# write the triple masked perfusion images (one image per perfusion map and territory) to the datasink
+# the VOI statistics are computed in memory and do not need these images
+write_masked_images = False
+# write one triple mask per territory to the datasink in addition to the label volume of all territories
+write_triple_masks = False
+# write the LPS reoriented perfusion maps and VOI masks to the datasink
+# the coregistration and the triple masks reorient them in memory and do not need these images
+write_reoriented_images = False
+# write voxel-wise relative perfusion maps (each voxel divided by the median of the contralateral territory) for all
+# perfusion maps, and vulnerability masks of the relative MTT maps (ipsilateral voxels with relative MTT >=
+# relative_threshold)
+write_relative_maps = False
+# Source: Grubb RL, Derdeyn CP, Videen TO, Carpenter DA, Powers WJ. Relative mean transit time predicts subsequent
+# stroke in symptomatic carotid occlusion. J Stroke Cerebrovasc Dis 2016;25(6):1421-4 (relMTT_thr of statistics.py)
+relative_threshold = 1.387
+# number of bins of the histograms of every perfusion map x territory saved next to the VOI statistics
+# (voi_histograms.npz); percentiles, IQR and fractions above thresholds are computed from them (see voi_histograms.py)
+histogram_bins = 1024
 
-# name workflow output files to be included for averaging in the final output .csv file
-include_average_list=[
-    "33_DSC_TTP_reor_coreg_gm_VOI_avg",
-    "34_DSC_C_CBV_reor_coreg_gm_VOI_avg",
-    "35_DSC_parametric_CBV_reor_coreg_gm_VOI_avg",
-    "36_DSC_parametric_CBF_reor_coreg_gm_VOI_avg",
-    "37_DSC_parametric_MTT_reor_coreg_gm_VOI_avg",
-    "38_DSC_parametric_Tmax_reor_coreg_gm_VOI_avg",
-    "39_DSC_oSVD_CBF_reor_coreg_gm_VOI_avg",
-    "40_DSC_oSVD_MTT_reor_coreg_gm_VOI_avg",
-    "41_DSC_oSVD_Tmax_reor_coreg_gm_VOI_avg",
-    "42_DSC_sSVD_CBF_reor_coreg_gm_VOI_avg",
-    "43_DSC_sSVD_MTT_reor_coreg_gm_VOI_avg",
-    "44_DSC_sSVD_Tmax_reor_coreg_gm_VOI_avg"]
-
-
-############################## NODE DEFINITIONS ################################
-
-## SEARCH NODES ##
-# nipype infosource node defines which subjects to include for select files node
-infosource = Node(IdentityInterface(fields=["subject_id"]), name="infosource")
-infosource.iterables = [("subject_id", subject_list)]
-# dictionary of the files to select for this workflow
-MPRAGE = opj(experiment_dir, "{subject_id}", "MPRAGE.nii.gz")
-DSC_Source = opj(experiment_dir, "{subject_id}", "DSC_Source.nii.gz")
-perfusion_imgs = opj(experiment_dir, "{subject_id}", "DSC_pgui*")
-masks = opj(experiment_dir, "{subject_id}", "Masken_cut", "*mask.nii.gz")
-
-# assing names to files in dictionary to call upon for wf.connect
-templates = {
-    "MPRAGE": MPRAGE,
-    "DSC_Source": DSC_Source,
-    "perf": perfusion_imgs,
-    "masks": masks
-            }
-# define select file node to localize files
-selectfiles = Node(SelectFiles(templates, base_directory=experiment_dir), name="selectfiles")
-
-
-## CUSTOM NODE DSC_SOURCE FIRST TIMEPOINT EXTRACTION ##
-def get_first_image_of_time_series(in_file):
-    import nibabel as nib
-    #extract path from DSC-source file name dropping the seven last digits '.nii.gz'
-    save_path=in_file[:-7]+"_0.nii.gz"
-    # load the image
-    image = nib.load(in_file)
-    # change shape of the data
-    data=image.get_data()
-    #subset the picture keeping x, y, z coordinates but dropping all other timepoints but 0
-    data_1= data[:,:,:,0,0,0]
-    #convert array to nifti format
-    image_1 = nib.Nifti1Image(data_1, image.affine)
-    #save the file in the subject folder without data sink
-    nib.save(image_1, save_path)
-    return save_path
-
-# now we integrate the custom function as nipype custom node
-extract_first_time_series_image = Node(Function(input_names=["in_file"],
-                       output_names=["out_file"],
-                       function=get_first_image_of_time_series),
-              name='extract_timeseries')
-
-
-## INTENSITY CORRECTION NODES/ FREESURFER NUC ##
-correct = Node(fs.MNIBiasCorrection(), name="NUC")
-correct.inputs.iterations = 6
-correct.inputs.protocol_iterations = 1000
-correct.inputs.distance = 50
-correct_2 = correct.clone(name="NUC_2")
-
-
-## SKULL STRIP NODE/ FSL BET ##
-# set frac variables to fine-tune BET
-skullstrip_MPRAGE = Node(fsl.BET(mask=True, output_type="NIFTI_GZ", robust=True, name="BETnode_MPRAGE", frac=0.6), name="BETnode_MPRAGE")
-skullstrip_DSC = Node(fsl.BET(mask=True, output_type="NIFTI_GZ", robust=True, frac=0.5), name="BETnode_DSC")
-
-
-## COREGISTRATION NODE/ MPRAGE AND DSC_SOURCE_0 ##
-# Inter-modality registration using mutual info as cost function
-reg = Node(fsl.FLIRT(),name="fsl_reg")
-reg.inputs.cost="mutualinfo"
-
-
-## LPS REORIENTATION NODES ##
 # DSC_source is reference with RAI-orientation
 # MPRAGE, perfusion maps, VOI masks need left posterior superior reorientation to match RAI
-reorient_MPRAGE = Node(Reorient(orientation='LPS'), name="reorient_MPRAGE")
-# Multiple input files per node require map nodes
-reorient = MapNode(Reorient(orientation='LPS') ,iterfield=['in_file'], name="reorient_image")
-reorient_VOI_masks = MapNode(Reorient(orientation='LPS') ,iterfield=['in_file'], name="reorient_VOI_masks")
-
-
-## APPLY TRANSFORMATION MATRIX FOR COREGISTRATION ##
-# 1) to perfusion maps
-apptrans= MapNode(fsl.ApplyXFM(apply_xfm=True), name= "applytransforms",iterfield=['in_file'])
-
-# 2) to DSC_Source_NUC_BET_mask
-## APPLY TRANSFORM TO PERFUSION MAPS NODE ##
-applytrans_dsc_mask= Node(fsl.ApplyXFM(apply_xfm=True), name= "applytrans_dsc_mask")
-
-
-## GM/WM SEGMENTATION NODE/ FSL FAST ##
-gmwmseg = Node(fsl.FAST(output_type='NIFTI_GZ', no_bias=True, segments=True), name="segmentation")
-
-
-## SELECT GM MASK NODE ##
-# fsl FAST segmentation node outputs 3 masks whitematter:1 grey matter:2 and csf:3 in a list called tissue class files.
-# We want the 2. element in this list therefore use list[1].
-select_gm_mask =  Node(Select(),name= "select_gm_mask")
-select_gm_mask.inputs.index=1
-
-
-## MASKING NODES/ FSL APPLY MASK ##
-# Combination of DSC_mask and gm_mask with in_file=DSC_mask and mask_file=gm_mask selected from tissue class files
-maskimage_dsc_gm = Node(fsl.ApplyMask(output_type='NIFTI_GZ'),name="maskimage_dsc_gm")
-
-# Map node combining DSC_GM_masks with the 8 VOI_masks; in_file=VOI_masks (iterfield); mask_file=DSC_GM_mask
-maskimage_dsc_gm_voi = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="maskimage_dsc_gm_voi",iterfield=["in_file"])
-
-# Final mask (dsc, gm, voi) applied to DSC_param maps; both in_file and mask_file are iterfields
-apply_maskimage = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="apply_maskimage",iterfield=["mask_file"])
-
-
-## SELECT GM MASKED PERFUSION MAPS NODE ##
-# this node selects the 12 greymatter-masked perfusion maps from the map node 'gm_mask' to allow for independent use in VOI_masking nodes
-select_0 =  Node(Select(),name= "select_0")
-select_0.inputs.index=0
-select_1 =  Node(Select(),name= "select_1")
-select_1.inputs.index=1
-select_2 =  Node(Select(),name= "select_2")
-select_2.inputs.index=2
-select_3 =  Node(Select(),name= "select_3")
-select_3.inputs.index=3
-select_4 =  Node(Select(),name= "select_4")
-select_4.inputs.index=4
-select_5 =  Node(Select(),name= "select_5")
-select_5.inputs.index=5
-select_6 =  Node(Select(),name= "select_6")
-select_6.inputs.index=6
-select_7 =  Node(Select(),name= "select_7")
-select_7.inputs.index=7
-select_8 =  Node(Select(),name= "select_8")
-select_8.inputs.index=8
-select_9 =  Node(Select(),name= "select_9")
-select_9.inputs.index=9
-select_10 =  Node(Select(),name= "select_10")
-select_10.inputs.index=10
-select_11 =  Node(Select(),name= "select_11")
-select_11.inputs.index=11
-
-
-## VOI MASKING NODES ##
-VOI_masking_0 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_0",iterfield=["mask_file"])
-VOI_masking_1 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_1",iterfield=["mask_file"])
-VOI_masking_2 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_2",iterfield=["mask_file"])
-VOI_masking_3 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_3",iterfield=["mask_file"])
-VOI_masking_4 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_4",iterfield=["mask_file"])
-VOI_masking_5 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_5",iterfield=["mask_file"])
-VOI_masking_6 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_6",iterfield=["mask_file"])
-VOI_masking_7 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_7",iterfield=["mask_file"])
-VOI_masking_8 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_8",iterfield=["mask_file"])
-VOI_masking_9 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_9",iterfield=["mask_file"])
-VOI_masking_10 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_10",iterfield=["mask_file"])
-VOI_masking_11 = MapNode(fsl.ApplyMask(output_type='NIFTI_GZ'),name="VOI_masking_11",iterfield=["mask_file"])
-
-
-## AVERAGING NODES/ IMAGE MEANTS ##
-# calculates average intensity of a VOI for each perfusion map
-avg_00 = MapNode(ImageMeants(),iterfield=["in_file","mask"],name="avg_00")
-avg_01 = avg_00.clone(name="avg_01")
-avg_02 = avg_00.clone(name="avg_02")
-avg_03 = avg_00.clone(name="avg_03")
-avg_04 = avg_00.clone(name="avg_04")
-avg_05 = avg_00.clone(name="avg_05")
-avg_06 = avg_00.clone(name="avg_06")
-avg_07 = avg_00.clone(name="avg_07")
-avg_08 = avg_00.clone(name="avg_08")
-avg_09 = avg_00.clone(name="avg_09")
-avg_10 = avg_00.clone(name="avg_10")
-avg_11 = avg_00.clone(name="avg_11")
-
-## AVERAGING NODES/ ImageStats for median/ 50th percentile (use -M for mean from non-zero values)
-median = Node(ImageStats(op_string='-P 50',
-             name="median"))
-median.inputs.in_file = dir + "/DSC_pgui_parametric_MTT_reor_coreg.nii.gz"
+orientation = 'LPS'
+
+# perfusion maps (<subject>/<map>.nii.gz) and territories (<subject>/Masken_cut/<territory>_<side>_mask.nii.gz) of the
+# analysis; the file templates and connections of the workflow are generated from these lists
+# None includes all perfusion maps (DSC_pgui*) or all VOI masks (*mask.nii.gz) found in the subject folders
+perfusion_maps = None
+territories = None
+sides = ["ipsi", "contra"]
+
+SETTINGS = ["workflow_name", "experiment_dir", "results_dir", "cpus", "memory_gb", "record_resources",
+            "write_profile_report", "result_store_dir", "result_store_max_age_days", "result_store_max_size_gb",
+            "max_retries", "transient_errors",
+            "subject_list", "working_output_type", "incremental", "write_masked_images", "write_triple_masks",
+            "write_reoriented_images", "write_relative_maps", "relative_threshold", "histogram_bins", "orientation",
+            "perfusion_maps", "territories", "sides"]
+
+
+############################## STAGES ##########################################
+# preprocess  runs the MPRAGE and DSC_Source pre-processing and co-registration (FreeSurfer NUC, FSL BET/FAST/FLIRT)
+# extract     runs the whole workflow: pre-processing results of earlier runs are reused, perfusion maps are
+#             co-registered and the VOI statistics are extracted and added to the manifest
+# graph       writes the graph of the workflow
+# aggregate   writes the VOI statistics of the manifest to the VOI results store (no nipype import)
+# Stages run in this order; preprocess and extract together run the workflow once
+# "resume" runs extract and aggregate only for the subjects that failed or did not finish in earlier runs
+STAGES = ["preprocess", "extract", "graph", "aggregate"]
+
+
+# default settings updated with the settings of a JSON config file
+def load_settings(config_file=None):
+    settings = {name: globals()[name] for name in SETTINGS}
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+        unknown = sorted(set(config) - set(SETTINGS))
+        if unknown:
+            raise ValueError("Unknown settings in %s: %s" % (config_file, ", ".join(unknown)))
+        settings.update(config)
+    return settings
+
+
+#results directory and folder of the aggregate files
+def result_paths(settings):
+    results_directory = settings["results_dir"] + "/" + settings["workflow_name"] + '_results'
+    aggregate_directory = results_directory + "/" + "45_Results_VOI_avg"
+    return {"results_directory": results_directory,
+            "aggregate_directory": aggregate_directory,
+            # typed long-format store of the VOI results with one Parquet file per subject (see voi_results.py)
+            "voi_results_directory": aggregate_directory + "/" + "voi_results",
+            # histograms of the perfusion values with one file per subject (see voi_histograms.py)
+            "voi_histograms_directory": aggregate_directory + "/" + "voi_histograms",
+            # index of the VOI statistics of all subjects, written while the datasink saves the results
+            "manifest_file": results_directory + "/" + "manifest.csv",
+            # status of every subject and crash files of failed subjects (see subject_status.py)
+            "status_file": results_directory + "/" + "subject_status.json",
+            "quarantine_directory": results_directory + "/" + "47_Failed_subjects",
+            # peak memory and CPU use recorded in earlier runs (see resources.py), next to the profile reports
+            "resources_file": results_directory + "/" + "46_Profiling" + "/" + "recorded_resources.json",
+            "subjects_file": aggregate_directory + "/" + "subjects.csv"}
+
+
+############################## INCREMENTAL COHORT ##############################
+
+# subject folders are recognized by the MPRAGE and DSC_Source files
+def discover_subjects(directory):
+    return sorted(name for name in os.listdir(directory)
+                  if os.path.isfile(opj(directory, name, "MPRAGE.nii.gz"))
+                  and os.path.isfile(opj(directory, name, "DSC_Source.nii.gz")))
+
+
+# fingerprint of the input files of a subject (names, sizes and modification times)
+def subject_fingerprint(directory, subject):
+    files = [opj(directory, subject, "MPRAGE.nii.gz"), opj(directory, subject, "DSC_Source.nii.gz")]
+    files += sorted(glob.glob(opj(directory, subject, "DSC_pgui*")))
+    files += sorted(glob.glob(opj(directory, subject, "Masken_cut", "*mask.nii.gz")))
+    sha = hashlib.sha256()
+    for f in files:
+        stat = os.stat(f)
+        sha.update(("%s %d %d;" % (os.path.relpath(f, directory), stat.st_size, stat.st_mtime_ns)).encode())
+    return sha.hexdigest()
+
+
+# fingerprints of the processed subjects (subjects.csv of the aggregate folder)
+def processed_subjects(subjects_file):
+    import csv
+    if not os.path.exists(subjects_file):
+        return {}
+    with open(subjects_file, newline="") as f:
+        return {row["subject"]: row["fingerprint"] for row in csv.DictReader(f)}
+
+
+# subjects with rows in the manifest
+def manifest_subjects(manifest_file):
+    import csv
+    if not os.path.exists(manifest_file):
+        return set()
+    with open(manifest_file, newline="") as f:
+        return {row["subject"] for row in csv.DictReader(f)}
+
+
+# subjects of the cohort, their fingerprints and the subjects to process
+# subjects already in the aggregate files are skipped if their fingerprint did not change
+# subjects with missing or unreadable input files are marked as failed and not run, the rest of the cohort is run
+def subjects_to_run(settings):
+    from subject_status import read_status, set_status, write_status
+    subjects = settings["subject_list"]
+    if subjects is None:
+        subjects = discover_subjects(settings["experiment_dir"])
+    fingerprints, unreadable = {}, {}
+    for subject in subjects:
+        try:
+            fingerprints[subject] = subject_fingerprint(settings["experiment_dir"], subject)
+        except OSError as error:
+            unreadable[subject] = "input files not readable: %s" % error
+            print("Subject", subject, "skipped:", unreadable[subject])
+    if unreadable:
+        status_file = result_paths(settings)["status_file"]
+        status = read_status(status_file)
+        for subject, error in unreadable.items():
+            set_status(status, [subject], "failed", error=error, crashes=[])
+        write_status(status_file, status)
+    subjects = [subject for subject in subjects if subject in fingerprints]
+    run_list = list(subjects)
+    if settings["incremental"]:
+        processed = processed_subjects(result_paths(settings)["subjects_file"])
+        run_list = [subject for subject in subjects if processed.get(subject) != fingerprints[subject]]
+    return fingerprints, run_list
 
 
 ############################## SUBSTITUTIONS ###################################
-# substitutions are a list of 2-tuples and are carried out in the order in which they were entered. Use them to rename results.
+# substitutions are a list of 2-tuples. Use them to rename results.
+# They are applied in one pass (see sinks.py): a replacement must not contain or be part of a key
 
 substitutions = [
 ("_subject_id_", ""),
+("_output_brain", "_NUC_BET"),
 ("_output", "_NUC"),
-("_NUC_brain", "_NUC_BET"),
 ("_flirt", "_coreg"),
 ("_seg_0", "_seg_csf"),
 ("_seg_1", "_seg_gm"),
 ("_seg_2", "_seg_wm"),
 ("_lps", "_reor"),
 ("_masked", ""),
-
-
-("VOI_masking_00", "ACA_contra"),
-("VOI_masking_01", "ACA_ipsi"),
-("VOI_masking_02", "MCA_contra"),
-("VOI_masking_03", "MCA_ipsi"),
-("VOI_masking_04", "PCA_contra"),
-("VOI_masking_05", "PCA_ipsi"),
-("VOI_masking_06", "hemi_contra"),
-("VOI_masking_07", "hemi_ipsi"),
-
-("VOI_masking_10", "ACA_contra"),
-("VOI_masking_11", "ACA_ipsi"),
-("VOI_masking_12", "MCA_contra"),
-("VOI_masking_13", "MCA_ipsi"),
-("VOI_masking_14", "PCA_contra"),
-("VOI_masking_15", "PCA_ipsi"),
-("VOI_masking_16", "hemi_contra"),
-("VOI_masking_17", "hemi_ipsi"),
-
-("VOI_masking_20", "ACA_contra"),
-("VOI_masking_21", "ACA_ipsi"),
-("VOI_masking_22", "MCA_contra"),
-("VOI_masking_23", "MCA_ipsi"),
-("VOI_masking_24", "PCA_contra"),
-("VOI_masking_25", "PCA_ipsi"),
-("VOI_masking_26", "hemi_contra"),
-("VOI_masking_27", "hemi_ipsi"),
-
-("VOI_masking_30", "ACA_contra"),
-("VOI_masking_31", "ACA_ipsi"),
-("VOI_masking_32", "MCA_contra"),
-("VOI_masking_33", "MCA_ipsi"),
-("VOI_masking_34", "PCA_contra"),
-("VOI_masking_35", "PCA_ipsi"),
-("VOI_masking_36", "hemi_contra"),
-("VOI_masking_37", "hemi_ipsi"),
-
-("VOI_masking_40", "ACA_contra"),
-("VOI_masking_41", "ACA_ipsi"),
-("VOI_masking_42", "MCA_contra"),
-("VOI_masking_43", "MCA_ipsi"),
-("VOI_masking_44", "PCA_contra"),
-("VOI_masking_45", "PCA_ipsi"),
-("VOI_masking_46", "hemi_contra"),
-("VOI_masking_47", "hemi_ipsi"),
-
-("VOI_masking_50", "ACA_contra"),
-("VOI_masking_51", "ACA_ipsi"),
-("VOI_masking_52", "MCA_contra"),
-("VOI_masking_53", "MCA_ipsi"),
-("VOI_masking_54", "PCA_contra"),
-("VOI_masking_55", "PCA_ipsi"),
-("VOI_masking_56", "hemi_contra"),
-("VOI_masking_57", "hemi_ipsi"),
-
-("VOI_masking_60", "ACA_contra"),
-("VOI_masking_61", "ACA_ipsi"),
-("VOI_masking_62", "MCA_contra"),
-("VOI_masking_63", "MCA_ipsi"),
-("VOI_masking_64", "PCA_contra"),
-("VOI_masking_65", "PCA_ipsi"),
-("VOI_masking_66", "hemi_contra"),
-("VOI_masking_67", "hemi_ipsi"),
-
-("VOI_masking_70", "ACA_contra"),
-("VOI_masking_71", "ACA_ipsi"),
-("VOI_masking_72", "MCA_contra"),
-("VOI_masking_73", "MCA_ipsi"),
-("VOI_masking_74", "PCA_contra"),
-("VOI_masking_75", "PCA_ipsi"),
-("VOI_masking_76", "hemi_contra"),
-("VOI_masking_77", "hemi_ipsi"),
-
-("VOI_masking_80", "ACA_contra"),
-("VOI_masking_81", "ACA_ipsi"),
-("VOI_masking_82", "MCA_contra"),
-("VOI_masking_83", "MCA_ipsi"),
-("VOI_masking_84", "PCA_contra"),
-("VOI_masking_85", "PCA_ipsi"),
-("VOI_masking_86", "hemi_contra"),
-("VOI_masking_87", "hemi_ipsi"),
-
-("VOI_masking_90", "ACA_contra"),
-("VOI_masking_91", "ACA_ipsi"),
-("VOI_masking_92", "MCA_contra"),
-("VOI_masking_93", "MCA_ipsi"),
-("VOI_masking_94", "PCA_contra"),
-("VOI_masking_95", "PCA_ipsi"),
-("VOI_masking_96", "hemi_contra"),
-("VOI_masking_97", "hemi_ipsi"),
-
-("VOI_masking_100", "ACA_contra"),
-("VOI_masking_101", "ACA_ipsi"),
-("VOI_masking_102", "MCA_contra"),
-("VOI_masking_103", "MCA_ipsi"),
-("VOI_masking_104", "PCA_contra"),
-("VOI_masking_105", "PCA_ipsi"),
-("VOI_masking_106", "hemi_contra"),
-("VOI_masking_107", "hemi_ipsi"),
-
-("VOI_masking_110", "ACA_contra"),
-("VOI_masking_111", "ACA_ipsi"),
-("VOI_masking_112", "MCA_contra"),
-("VOI_masking_113", "MCA_ipsi"),
-("VOI_masking_114", "PCA_contra"),
-("VOI_masking_115", "PCA_ipsi"),
-("VOI_masking_116", "hemi_contra"),
-("VOI_masking_117", "hemi_ipsi"),
-
-("avg_000", "ACA_contra"),
-("avg_001", "ACA_ipsi"),
-("avg_002", "MCA_contra"),
-("avg_003", "MCA_ipsi"),
-("avg_004", "PCA_contra"),
-("avg_005", "PCA_ipsi"),
-("avg_006", "hemi_contra"),
-("avg_007", "hemi_ipsi"),
-
-("avg_010", "ACA_contra"),
-("avg_011", "ACA_ipsi"),
-("avg_012", "MCA_contra"),
-("avg_013", "MCA_ipsi"),
-("avg_014", "PCA_contra"),
-("avg_015", "PCA_ipsi"),
-("avg_016", "hemi_contra"),
-("avg_017", "hemi_ipsi"),
-
-("avg_020", "ACA_contra"),
-("avg_021", "ACA_ipsi"),
-("avg_022", "MCA_contra"),
-("avg_023", "MCA_ipsi"),
-("avg_024", "PCA_contra"),
-("avg_025", "PCA_ipsi"),
-("avg_026", "hemi_contra"),
-("avg_027", "hemi_ipsi"),
-
-("avg_030", "ACA_contra"),
-("avg_031", "ACA_ipsi"),
-("avg_032", "MCA_contra"),
-("avg_033", "MCA_ipsi"),
-("avg_034", "PCA_contra"),
-("avg_035", "PCA_ipsi"),
-("avg_036", "hemi_contra"),
-("avg_037", "hemi_ipsi"),
-
-("avg_040", "ACA_contra"),
-("avg_041", "ACA_ipsi"),
-("avg_042", "MCA_contra"),
-("avg_043", "MCA_ipsi"),
-("avg_044", "PCA_contra"),
-("avg_045", "PCA_ipsi"),
-("avg_046", "hemi_contra"),
-("avg_047", "hemi_ipsi"),
-
-("avg_050", "ACA_contra"),
-("avg_051", "ACA_ipsi"),
-("avg_052", "MCA_contra"),
-("avg_053", "MCA_ipsi"),
-("avg_054", "PCA_contra"),
-("avg_055", "PCA_ipsi"),
-("avg_056", "hemi_contra"),
-("avg_057", "hemi_ipsi"),
-
-("avg_060", "ACA_contra"),
-("avg_061", "ACA_ipsi"),
-("avg_062", "MCA_contra"),
-("avg_063", "MCA_ipsi"),
-("avg_064", "PCA_contra"),
-("avg_065", "PCA_ipsi"),
-("avg_066", "hemi_contra"),
-("avg_067", "hemi_ipsi"),
-
-("avg_070", "ACA_contra"),
-("avg_071", "ACA_ipsi"),
-("avg_072", "MCA_contra"),
-("avg_073", "MCA_ipsi"),
-("avg_074", "PCA_contra"),
-("avg_075", "PCA_ipsi"),
-("avg_076", "hemi_contra"),
-("avg_077", "hemi_ipsi"),
-
-("avg_080", "ACA_contra"),
-("avg_081", "ACA_ipsi"),
-("avg_082", "MCA_contra"),
-("avg_083", "MCA_ipsi"),
-("avg_084", "PCA_contra"),
-("avg_085", "PCA_ipsi"),
-("avg_086", "hemi_contra"),
-("avg_087", "hemi_ipsi"),
-
-("avg_090", "ACA_contra"),
-("avg_091", "ACA_ipsi"),
-("avg_092", "MCA_contra"),
-("avg_093", "MCA_ipsi"),
-("avg_094", "PCA_contra"),
-("avg_095", "PCA_ipsi"),
-("avg_096", "hemi_contra"),
-("avg_097", "hemi_ipsi"),
-
-
-("avg_100", "ACA_contra"),
-("avg_101", "ACA_ipsi"),
-("avg_102", "MCA_contra"),
-("avg_103", "MCA_ipsi"),
-("avg_104", "PCA_contra"),
-("avg_105", "PCA_ipsi"),
-("avg_106", "hemi_contra"),
-("avg_107", "hemi_ipsi"),
-
-
-("avg_110", "ACA_contra"),
-("avg_111", "ACA_ipsi"),
-("avg_112", "MCA_contra"),
-("avg_113", "MCA_ipsi"),
-("avg_114", "PCA_contra"),
-("avg_115", "PCA_ipsi"),
-("avg_116", "hemi_contra"),
-("avg_117", "hemi_ipsi"),
              ]
 
 
-########################## DATASINK TO SAVE FILES ##############################
-
-datasink = Node(DataSink(), name="datasink")
-datasink.inputs.base_directory = results_dir
-datasink.inputs.container = workflow_name + '_results' +""
-datasink.inputs.substitutions = substitutions
-
-
-############################ WORKFLOW CONNECTIONS ##############################
-
-# define workflow
-wf = Workflow(name=workflow_name)
-wf.base_dir = experiment_dir
-
-
-## HOW TO USE CONNECTIONS ##
-# Selectfiles uses the dictionary of key strings in "template" defined above to select files.
-# Datasink will save files in folders named with strings you define here
-# All other NODES have "input" and "output" parameters as defined in the function. Those have to be taken from the Nipype documentation.
-
-
-# describe how the nodes are connected to each other, specify input and output of each node
-# output of every step is connected to the datasink
-wf.connect([
-
-    # subject ID subsetting
-    (infosource, selectfiles, [("subject_id", "subject_id")]),
-
-# MPRAGE pre-processing:
-    # MPRAGEs are LPS reoriented to match other DSC files
-    (selectfiles, reorient_MPRAGE, [("MPRAGE", "in_file")]),
-    (reorient_MPRAGE, datasink, [("out_file", "01_MPRAGE_reor")]),
-    
-    # intensity normalization is performed (NUC)
-    (reorient_MPRAGE, correct, [("out_file", "in_file")]),
-    (correct, datasink, [("out_file", "02_MPRAGE_reor_NUC")]),
-
-    # brain extraction (BET) gives out two outputs: (1) skull-stripped MPRAGE, (2) binary brain extraction mask 
-    (correct, skullstrip_MPRAGE, [("out_file", "in_file")]),
-    (skullstrip_MPRAGE, datasink, [("out_file", "03_MPRAGE_reor_NUC_BET")]),
-    (skullstrip_MPRAGE, datasink, [("mask_file", "04_MPRAGE_reor_NUC_BET_mask")]),
-
-    # MPRAGE grey-matter/ white-matter segmentation gives two outputs: (1) "tissue_class_files" for CSF, GM, and WM, (2) combined map of the three aforementioned 
-    (skullstrip_MPRAGE, gmwmseg, [("out_file", "in_files")]),
-    (gmwmseg, datasink, [("tissue_class_files", "05_MPRAGE_reor_NUC_BET_seg"),
-                         ("tissue_class_map", "06_MPRAGE_reor_NUC_BET_seg_comb")]),
-   
-# DSC_Source pre-processing:
-    # First timepoint of the DSC time series data is extracted using a custom_time_series_extraction_node
-    (selectfiles, extract_first_time_series_image,  [("DSC_Source", "in_file")]),
-    (extract_first_time_series_image, datasink, [("out_file", "07_DSC_Source_0")]),
-    
-    # intensity normalization is performed (NUC)
-    (extract_first_time_series_image, correct_2, [("out_file", "in_file")]),
-    (correct_2, datasink, [("out_file", "08_DSC_Source_0_NUC")]),
-
-    # brain extraction (BET) gives out two outputs: (1) skull-stripped DSC_Source_0, (2) binary brain extraction mask 
-    (correct_2, skullstrip_DSC, [("out_file", "in_file")]),
-    (skullstrip_DSC, datasink, [("out_file", "09_DSC_Source_0_NUC_BET")]),
-    (skullstrip_DSC, datasink, [("mask_file", "10_DSC_Source_0_NUC_BET_mask")]),
-
-# Co-registration of DSC_Source_0 with MPRAGE
-    # fsl_coreg is performed using 09_DSC_Source_0_NUC_BET base file and 03_MPRAGE_reor_NUC_BET as reference file 
-    (skullstrip_MPRAGE, reg, [("out_file", "reference")]),
-    (skullstrip_DSC, reg, [("out_file", "in_file")]),
-    (reg, datasink, [("out_file", "11_DSC_Source_0_NUC_BET_coreg"), 
-                     ("out_matrix_file", "12_DSC_Source_0_NUC_BET_coreg_matrix")]),
-
-# Pre-processing of DSC-parametermaps: 
-    # Parametermaps are LPS reoriented to match MPRAGE and other DSC files
-    (selectfiles, reorient, [("perf", "in_file")]),
-    (reorient, datasink, [("out_file", "13_DSC_parametermaps_reor")]),
-    
-    # The transformation matrix resulting from the co-registration of MPRAGE and DSC_Source_0 is applied to reoriented perfusion images
-    # MPRAGE is used as reference image of the co-registration
-    (reorient, apptrans, [("out_file", "in_file")]),
-    (reg, apptrans, [("out_matrix_file", "in_matrix_file")]),
-    (skullstrip_MPRAGE, apptrans, [("out_file", "reference")]),
-    (apptrans, datasink, [("out_file", "14_DSC_parametermaps_reor_coreg")]),
-
-# VOI mask Reorientation:
-    # manual VOI masks are still in LPI orientation and need to be LPS reoriented 
-    (selectfiles, reorient_VOI_masks, [("masks", "in_file")]),
-    (reorient_VOI_masks, datasink, [("out_file", "16_VOI_masks_reor")]),
-
-# PREPARATION FOR TRIPLE MASKS (GM, VOI, DSC)
-# For the analysis three masks have to be combined before applying them to the perfusion parameter maps
-# Step 1) DSC_mask (1x) + GM_mask (1x)
-# Step 2) DSC_GM_mask (1x) + VOI_masks (8x)
-# Step 3) apply DSC_GM_VOI_masks (8x) to 1/12 perfusion parameter map
-
-
-# Step 1)
-    # DSC_mask is co-registered to MPRAGE
-    (skullstrip_DSC, applytrans_dsc_mask, [("mask_file", "in_file")]),
-    (reg, applytrans_dsc_mask, [("out_matrix_file", "in_matrix_file")]),
-    (skullstrip_MPRAGE, applytrans_dsc_mask, [("out_file", "reference")]),
-    (applytrans_dsc_mask, datasink, [("out_file", "17_DSC_mask_coreg")]),
+############################## FILE TEMPLATES ##################################
+# templates of the select files node: one template per perfusion map and territory of the settings, or one glob
+# template for all perfusion maps or masks; returns the templates and the keys of the perfusion maps and masks
+def file_templates(settings):
+    experiment_dir = settings["experiment_dir"]
+    templates = {"MPRAGE": opj(experiment_dir, "{subject_id}", "MPRAGE.nii.gz"),
+                 "DSC_Source": opj(experiment_dir, "{subject_id}", "DSC_Source.nii.gz")}
+    if settings["perfusion_maps"] is None:
+        templates["perf"] = opj(experiment_dir, "{subject_id}", "DSC_pgui*")
+    else:
+        templates.update({"perf_" + name: opj(experiment_dir, "{subject_id}", name + ".nii*")
+                          for name in settings["perfusion_maps"]})
+    if settings["territories"] is None:
+        templates["masks"] = opj(experiment_dir, "{subject_id}", "Masken_cut", "*mask.nii.gz")
+    else:
+        templates.update({"mask_%s_%s" % (territory, side): opj(experiment_dir, "{subject_id}", "Masken_cut",
+                                                                 "%s_%s_mask.nii.gz" % (territory, side))
+                          for territory in settings["territories"] for side in settings["sides"]})
+    perf_keys = [key for key in templates if key == "perf" or key.startswith("perf_")]
+    mask_keys = [key for key in templates if key == "masks" or key.startswith("mask_")]
+    return templates, perf_keys, mask_keys
+
+
+############################## WORKFLOW ########################################
+# Builds the workflow for the subjects of run_list; without extract only the pre-processing nodes are included
+# resources holds the memory and thread estimates of the nodes (see resources.py), other nodes keep the nipype default
+def build_workflow(settings, run_list, extract=True, resources=None):
+    from nipype.interfaces.io import SelectFiles
+    from nipype.pipeline.engine import Workflow, Node, MapNode
+    from nipype.interfaces.utility import IdentityInterface, Select, Merge
+    from nipype.interfaces.image import Reorient
+    from nipype import Function
+    from custom_nodes import get_first_image_of_time_series, apply_flirt_matrix, build_triple_mask_labels, voi_statistics, update_manifest
+    from node_cache import CachedMNIBiasCorrection, CachedBET, CachedFAST, CachedFLIRT
+    from resources import node_arguments
+    from sinks import PipelineDataSink
+
+    experiment_dir = settings["experiment_dir"]
+    result_store_dir = settings["result_store_dir"]
+    working_output_type = settings["working_output_type"]
+    orientation = settings["orientation"]
+    # mem_gb and n_procs of the estimated nodes, limited to the budget of the plugin
+    estimates = node_arguments(resources or {}, settings["memory_gb"], settings["cpus"])
+
+    ############################## NODE DEFINITIONS ################################
+
+    ## SEARCH NODES ##
+    # nipype infosource node defines which subjects to include for select files node
+    infosource = Node(IdentityInterface(fields=["subject_id"]), name="infosource")
+    infosource.iterables = [("subject_id", run_list)]
+    # dictionary of the files to select for this workflow (MPRAGE, DSC_Source, perfusion maps and VOI masks)
+    templates, perf_keys, mask_keys = file_templates(settings)
+    # define select file node to localize files
+    selectfiles = Node(SelectFiles(templates, base_directory=experiment_dir), name="selectfiles",
+                       **estimates.get("selectfiles", {}))
+
+    # perfusion maps and masks selected by one template per file are merged to one list (one node for all files)
+    def file_list(keys, name):
+        if keys in (["perf"], ["masks"]):
+            return selectfiles, keys[0], []
+        merge = Node(Merge(len(keys)), name=name, **estimates.get(name, {}))
+        return merge, "out", [(selectfiles, merge, [(key, "in%d" % (i + 1))]) for i, key in enumerate(keys)]
+    perf_files, perf_output, perf_connections = file_list(perf_keys, "merge_perfusion_maps")
+    mask_files, mask_output, mask_connections = file_list(mask_keys, "merge_VOI_masks")
+
+
+    ## CUSTOM NODE DSC_SOURCE FIRST TIMEPOINT EXTRACTION ##
+    # get_first_image_of_time_series (custom_nodes.py) reads only the first volume of the DSC time series
+    # and caches it next to the source file
+
+    # now we integrate the custom function as nipype custom node
+    extract_first_time_series_image = Node(Function(input_names=["in_file"],
+                           output_names=["out_file"],
+                           function=get_first_image_of_time_series),
+                  name='extract_timeseries', **estimates.get("extract_timeseries", {}))
+
+
+    ## INTENSITY CORRECTION NODES/ FREESURFER NUC ##
+    # NUC, BET, FAST and FLIRT look up their results in the shared result store (node_cache.py) before running
+    # both NUC nodes are built with the same inputs and their own memory estimate
+    def bias_correction(name):
+        node = Node(CachedMNIBiasCorrection(store_dir=result_store_dir), name=name, **estimates.get(name, {}))
+        node.inputs.iterations = 6
+        node.inputs.protocol_iterations = 1000
+        node.inputs.distance = 50
+        return node
+    correct = bias_correction("NUC")
+    correct_2 = bias_correction("NUC_2")
+
+
+    ## SKULL STRIP NODE/ FSL BET ##
+    # set frac variables to fine-tune BET
+    skullstrip_MPRAGE = Node(CachedBET(store_dir=result_store_dir, mask=True, output_type=working_output_type, robust=True, frac=0.6), name="BETnode_MPRAGE",
+                             **estimates.get("BETnode_MPRAGE", {}))
+    skullstrip_DSC = Node(CachedBET(store_dir=result_store_dir, mask=True, output_type=working_output_type, robust=True, frac=0.5), name="BETnode_DSC",
+                          **estimates.get("BETnode_DSC", {}))
+
+
+    ## COREGISTRATION NODE/ MPRAGE AND DSC_SOURCE_0 ##
+    # Inter-modality registration using mutual info as cost function
+    reg = Node(CachedFLIRT(store_dir=result_store_dir),name="fsl_reg", **estimates.get("fsl_reg", {}))
+    reg.inputs.cost="mutualinfo"
+    reg.inputs.output_type = working_output_type
+
+
+    ## LPS REORIENTATION NODES ##
+    # The reoriented MPRAGE is written to disk, it is the input of FreeSurfer NUC
+    reorient_MPRAGE = Node(Reorient(orientation=orientation), name="reorient_MPRAGE",
+                           **estimates.get("reorient_MPRAGE", {}))
+    # Perfusion maps and VOI masks are reoriented in memory by the coregistration and triple mask nodes;
+    # these map nodes only run if the reoriented images are saved (write_reoriented_images)
+    reorient = MapNode(Reorient(orientation=orientation) ,iterfield=['in_file'], name="reorient_image",
+                       **estimates.get("reorient_image", {}))
+    reorient_VOI_masks = MapNode(Reorient(orientation=orientation) ,iterfield=['in_file'], name="reorient_VOI_masks",
+                                 **estimates.get("reorient_VOI_masks", {}))
+
+
+    ## APPLY TRANSFORMATION MATRIX FOR COREGISTRATION ##
+    # Custom node applying the FLIRT matrix to 1) the perfusion maps and 2) the DSC_Source_NUC_BET_mask (see apply_flirt_matrix)
+    # The mapping to the MPRAGE grid is computed once and all images are interpolated (trilinear) together
+    # The perfusion maps are LPS reoriented in memory before
+    apptrans = Node(Function(input_names=["in_files", "mask_file", "in_matrix_file", "reference", "orientation", "output_type"],
+                             output_names=["out_files", "out_mask_file"],
+                             function=apply_flirt_matrix),
+                    name="applytransforms", **estimates.get("applytransforms", {}))
+    apptrans.inputs.orientation = orientation
+    apptrans.inputs.output_type = working_output_type
+
+
+    ## GM/WM SEGMENTATION NODE/ FSL FAST ##
+    gmwmseg = Node(CachedFAST(store_dir=result_store_dir, output_type=working_output_type, no_bias=True, segments=True), name="segmentation",
+                   **estimates.get("segmentation", {}))
+
+
+    ## SELECT GM MASK NODE ##
+    # fsl FAST segmentation node outputs 3 masks whitematter:1 grey matter:2 and csf:3 in a list called tissue class files.
+    # We want the 2. element in this list therefore use list[1].
+    select_gm_mask =  Node(Select(),name= "select_gm_mask", **estimates.get("select_gm_mask", {}))
+    select_gm_mask.inputs.index=1
+
+
+    ## TRIPLE MASK NODE ##
+    # Custom node combining DSC_mask, GM_mask and the 8 VOI_masks in memory (see build_triple_mask_labels)
+    # Output is one uint8 label volume with one bit per territory and a JSON file with the territory names
+    # The VOI masks are LPS reoriented in memory before
+    triple_mask = Node(Function(input_names=["dsc_mask_file", "gm_file", "voi_mask_files", "orientation", "write_masks",
+                                             "output_type"],
+                                output_names=["label_file", "label_names", "mask_files"],
+                                function=build_triple_mask_labels),
+                       name="triple_mask", **estimates.get("triple_mask", {}))
+    triple_mask.inputs.orientation = orientation
+    triple_mask.inputs.write_masks = settings["write_triple_masks"]
+    triple_mask.inputs.output_type = working_output_type
+
+    ## VOI STATISTICS NODE ##
+    # Custom node replacing 12 Select, 12 VOI masking (ApplyMask) and 12 averaging (ImageMeants) nodes.
+    # Each coregistered perfusion map is loaded once and all 8 triple masks of the label volume are applied in memory.
+    # Mean, median and number of voxels of every perfusion map x territory are returned in one table,
+    # histograms of the values of every perfusion map x territory in one file of n_bins bins per row.
+    # The relative maps and vulnerability masks are computed from the same loaded maps and masks.
+    voi_stats = Node(Function(input_names=["in_files", "label_file", "label_names", "write_masked", "output_type",
+                                           "n_bins", "write_relative", "relative_threshold"],
+                              output_names=["out_table", "masked_files", "out_histograms", "relative_files",
+                                            "vulnerability_files"],
+                              function=voi_statistics),
+                     name="voi_statistics", **estimates.get("voi_statistics", {}))
+    voi_stats.inputs.write_masked = settings["write_masked_images"]
+    voi_stats.inputs.output_type = working_output_type
+    voi_stats.inputs.n_bins = settings["histogram_bins"]
+    voi_stats.inputs.write_relative = settings["write_relative_maps"]
+    voi_stats.inputs.relative_threshold = settings["relative_threshold"]
+
+
+    ########################## DATASINK TO SAVE FILES ##############################
+
+    # .nii working files are saved as .nii.gz (see sinks.py)
+    datasink = Node(PipelineDataSink(), name="datasink", **estimates.get("datasink", {}))
+    datasink.inputs.base_directory = settings["results_dir"]
+    datasink.inputs.container = settings["workflow_name"] + '_results' +""
+    datasink.inputs.substitutions = substitutions
+
+    # custom node appending the VOI statistics saved by the datasink to the manifest (see update_manifest)
+    # like the datasink it runs every time, also if its inputs did not change
+    manifest = Node(Function(input_names=["sink_files", "subject_id", "manifest_file"],
+                             output_names=["manifest_file"],
+                             function=update_manifest),
+                    name="manifest", overwrite=True, **estimates.get("manifest", {}))
+    manifest.inputs.manifest_file = result_paths(settings)["manifest_file"]
+
+
+    ############################ WORKFLOW CONNECTIONS ##############################
+
+    # define workflow
+    wf = Workflow(name=settings["workflow_name"])
+    wf.base_dir = experiment_dir
+
+
+    ## HOW TO USE CONNECTIONS ##
+    # Selectfiles uses the dictionary of key strings in "template" defined above to select files.
+    # Datasink will save files in folders named with strings you define here
+    # All other NODES have "input" and "output" parameters as defined in the function. Those have to be taken from the Nipype documentation.
+
+
+    # describe how the nodes are connected to each other, specify input and output of each node
+    # output of every step is connected to the datasink
+    wf.connect([
+
+        # subject ID subsetting
+        (infosource, selectfiles, [("subject_id", "subject_id")]),
+
+    # MPRAGE pre-processing:
+        # MPRAGEs are LPS reoriented to match other DSC files
+        (selectfiles, reorient_MPRAGE, [("MPRAGE", "in_file")]),
+        (reorient_MPRAGE, datasink, [("out_file", "01_MPRAGE_reor")]),
+
+        # intensity normalization is performed (NUC)
+        (reorient_MPRAGE, correct, [("out_file", "in_file")]),
+        (correct, datasink, [("out_file", "02_MPRAGE_reor_NUC")]),
+
+        # brain extraction (BET) gives out two outputs: (1) skull-stripped MPRAGE, (2) binary brain extraction mask
+        (correct, skullstrip_MPRAGE, [("out_file", "in_file")]),
+        (skullstrip_MPRAGE, datasink, [("out_file", "03_MPRAGE_reor_NUC_BET")]),
+        (skullstrip_MPRAGE, datasink, [("mask_file", "04_MPRAGE_reor_NUC_BET_mask")]),
+
+        # MPRAGE grey-matter/ white-matter segmentation gives two outputs: (1) "tissue_class_files" for CSF, GM, and WM, (2) combined map of the three aforementioned
+        (skullstrip_MPRAGE, gmwmseg, [("out_file", "in_files")]),
+        (gmwmseg, datasink, [("tissue_class_files", "05_MPRAGE_reor_NUC_BET_seg"),
+                             ("tissue_class_map", "06_MPRAGE_reor_NUC_BET_seg_comb")]),
+
+    # DSC_Source pre-processing:
+        # First timepoint of the DSC time series data is extracted using a custom_time_series_extraction_node
+        (selectfiles, extract_first_time_series_image,  [("DSC_Source", "in_file")]),
+        (extract_first_time_series_image, datasink, [("out_file", "07_DSC_Source_0")]),
+
+        # intensity normalization is performed (NUC)
+        (extract_first_time_series_image, correct_2, [("out_file", "in_file")]),
+        (correct_2, datasink, [("out_file", "08_DSC_Source_0_NUC")]),
+
+        # brain extraction (BET) gives out two outputs: (1) skull-stripped DSC_Source_0, (2) binary brain extraction mask
+        (correct_2, skullstrip_DSC, [("out_file", "in_file")]),
+        (skullstrip_DSC, datasink, [("out_file", "09_DSC_Source_0_NUC_BET")]),
+        (skullstrip_DSC, datasink, [("mask_file", "10_DSC_Source_0_NUC_BET_mask")]),
+
+    # Co-registration of DSC_Source_0 with MPRAGE
+        # fsl_coreg is performed using 09_DSC_Source_0_NUC_BET base file and 03_MPRAGE_reor_NUC_BET as reference file
+        (skullstrip_MPRAGE, reg, [("out_file", "reference")]),
+        (skullstrip_DSC, reg, [("out_file", "in_file")]),
+        (reg, datasink, [("out_file", "11_DSC_Source_0_NUC_BET_coreg"),
+                         ("out_matrix_file", "12_DSC_Source_0_NUC_BET_coreg_matrix")]),
 
     # GM-masks have to be extracted from the three "tissue_class_files" of fsl FAST using a custom function
     # Only GM-areas of perfusion maps are considered for further analysis
-    (gmwmseg, select_gm_mask, [("tissue_class_files", "inlist")]),
-
-    # GM masking of DSC_mask
-    # Combination of DSC_mask and gm_mask with in_file=DSC_mask and mask_file=gm_mask selected from tissue class files
-    (applytrans_dsc_mask, maskimage_dsc_gm, [("out_file", "in_file")]),
-    (select_gm_mask, maskimage_dsc_gm, [("out", "mask_file")]),
-    (maskimage_dsc_gm, datasink, [("out_file", "18_Double_mask_DSC_GM")]),
-
-# Step 2)
-    # Map node combining DSC_GM_masks with the 8 VOI_masks; in_file=VOI_masks (iterfield); mask_file=DSC_GM_mask
-    (reorient_VOI_masks, maskimage_dsc_gm_voi, [("out_file", "in_file")]),
-    (maskimage_dsc_gm, maskimage_dsc_gm_voi, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, datasink, [("out_file", "19_Triple_mask_DSC_GM_VOI")]),
-
-# Step 3)
-    # Combined DSC_GM_VOI_masks (8x) are applied to the 12 perfusion parametermaps
-    # First all 8 mask files are connected using iterfield
-    (maskimage_dsc_gm_voi, VOI_masking_0, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_1, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_2, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_3, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_4, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_5, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_6, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_7, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_8, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_9, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_10, [("out_file", "mask_file")]),
-    (maskimage_dsc_gm_voi, VOI_masking_11, [("out_file", "mask_file")]),
-
-    # Each perfusion parameter map is selected from the list of 12 to be used separately
-    # Note: this is only done because multiple iterfields did not work with this masking map node
-
-    # select C_CBV from output list of apptrans
-    (apptrans,select_0 , [("out_file","inlist")]),
-    (select_0,VOI_masking_0, [("out", "in_file")]),
-
-    # select TTP from output list of apptrans
-    (apptrans, select_1, [("out_file", "inlist")]),
-    (select_1, VOI_masking_1, [("out", "in_file")]),
-
-    # select oSVD_CBF from output list of apptrans
-    (apptrans, select_2, [("out_file", "inlist")]),
-    (select_2, VOI_masking_2, [("out", "in_file")]),
-
-    # select oSVD_MTT from output list of apptrans
-    (apptrans, select_3, [("out_file", "inlist")]),
-    (select_3, VOI_masking_3, [("out", "in_file")]),
-
-    # select oSVD_Tmax from output list of apptrans
-    (apptrans, select_4, [("out_file", "inlist")]),
-    (select_4, VOI_masking_4, [("out", "in_file")]),
-
-    # select parametric_CBF from output list of apptrans
-    (apptrans, select_5, [("out_file", "inlist")]),
-    (select_5, VOI_masking_5, [("out", "in_file")]),
-
-    # select parametric_CBV from output list of apptrans
-    (apptrans, select_6, [("out_file", "inlist")]),
-    (select_6, VOI_masking_6, [("out", "in_file")]),
-
-    # select parametric_MTT from output list of apptrans
-    (apptrans, select_7, [("out_file", "inlist")]),
-    (select_7, VOI_masking_7, [("out", "in_file")]),
-
-    # select parametric_Tmax from output list of apptrans
-    (apptrans, select_8, [("out_file", "inlist")]),
-    (select_8, VOI_masking_8, [("out", "in_file")]),
-
-    # select sSVD_CBF from output list of apptrans
-    (apptrans, select_9, [("out_file", "inlist")]),
-    (select_9, VOI_masking_9, [("out", "in_file")]),
-
-    # select sSVD_MTT from output list of apptrans
-    (apptrans, select_10, [("out_file", "inlist")]),
-    (select_10, VOI_masking_10, [("out", "in_file")]),
-
-    # select sSVD_Tmax from output list of apptrans
-    (apptrans, select_11, [("out_file", "inlist")]),
-    (select_11, VOI_masking_11, [("out", "in_file")]),
-
-    # Triple masked perfusion images are safed to datasink
-    (VOI_masking_0, datasink, [("out_file", "22_DSC_C_CBV_reor_coreg_gm_VOI")]),
-    (VOI_masking_1, datasink, [("out_file", "21_DSC_TTP_reor_coreg_gm_VOI")]),
-    (VOI_masking_2, datasink, [("out_file", "27_DSC_oSVD_CBF_reor_coreg_gm_VOI")]),
-    (VOI_masking_3, datasink, [("out_file", "28_DSC_oSVD_MTT_reor_coreg_gm_VOI")]),
-    (VOI_masking_4, datasink, [("out_file", "29_DSC_oSVD_Tmax_reor_coreg_gm_VOI")]),
-    (VOI_masking_5, datasink, [("out_file", "24_DSC_parametric_CBF_reor_coreg_gm_VOI")]),
-    (VOI_masking_6, datasink, [("out_file", "23_DSC_parametric_CBV_reor_coreg_gm_VOI")]),
-    (VOI_masking_7, datasink, [("out_file", "25_DSC_parametric_MTT_reor_coreg_gm_VOI")]),
-    (VOI_masking_8, datasink, [("out_file", "26_DSC_parametric_Tmax_reor_coreg_gm_VOI")]),
-    (VOI_masking_9, datasink, [("out_file", "30_DSC_sSVD_CBF_reor_coreg_gm_VOI")]),
-    (VOI_masking_10, datasink, [("out_file", "31_DSC_sSVD_MTT_reor_coreg_gm_VOI")]),
-    (VOI_masking_11, datasink, [("out_file", "32_DSC_sSVD_Tmax_reor_coreg_gm_VOI")]),
-
-# Average intensities of each VOI is extracted
-    # Perfusion maps are used as separate in_files
-    (VOI_masking_0, avg_00, [("out_file", "in_file")]),
-    (VOI_masking_1, avg_01, [("out_file", "in_file")]),
-    (VOI_masking_2, avg_02, [("out_file", "in_file")]),
-    (VOI_masking_3, avg_03, [("out_file", "in_file")]),
-    (VOI_masking_4, avg_04, [("out_file", "in_file")]),
-    (VOI_masking_5, avg_05, [("out_file", "in_file")]),
-    (VOI_masking_6, avg_06, [("out_file", "in_file")]),
-    (VOI_masking_7, avg_07, [("out_file", "in_file")]),
-    (VOI_masking_8, avg_08, [("out_file", "in_file")]),
-    (VOI_masking_9, avg_09, [("out_file", "in_file")]),
-    (VOI_masking_10, avg_10, [("out_file", "in_file")]),
-    (VOI_masking_11, avg_11, [("out_file", "in_file")]),
-
-    # Triple masks as additional input for averaging node
-    (maskimage_dsc_gm_voi, avg_00, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_01, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_02, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_03, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_04, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_05, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_06, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_07, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_08, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_09, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_10, [("out_file", "mask")]),
-    (maskimage_dsc_gm_voi, avg_11, [("out_file", "mask")]),
-
-    # Average intensity values are saved in txt files
-    (avg_00, datasink, [("out_file", "34_DSC_C_CBV_reor_coreg_gm_VOI_avg")]),
-    (avg_01, datasink, [("out_file", "33_DSC_TTP_reor_coreg_gm_VOI_avg")]),
-    (avg_02, datasink, [("out_file", "39_DSC_oSVD_CBF_reor_coreg_gm_VOI_avg")]),
-    (avg_03, datasink, [("out_file", "40_DSC_oSVD_MTT_reor_coreg_gm_VOI_avg")]),
-    (avg_04, datasink, [("out_file", "41_DSC_oSVD_Tmax_reor_coreg_gm_VOI_avg")]),
-    (avg_05, datasink, [("out_file", "36_DSC_parametric_CBF_reor_coreg_gm_VOI_avg")]),
-    (avg_06, datasink, [("out_file", "35_DSC_parametric_CBV_reor_coreg_gm_VOI_avg")]),
-    (avg_07, datasink, [("out_file", "37_DSC_parametric_MTT_reor_coreg_gm_VOI_avg")]),
-    (avg_08, datasink, [("out_file", "38_DSC_parametric_Tmax_reor_coreg_gm_VOI_avg")]),
-    (avg_09, datasink, [("out_file", "42_DSC_sSVD_CBF_reor_coreg_gm_VOI_avg")]),
-    (avg_10, datasink, [("out_file", "43_DSC_sSVD_MTT_reor_coreg_gm_VOI_avg")]),
-    (avg_11, datasink, [("out_file", "44_DSC_sSVD_Tmax_reor_coreg_gm_VOI_avg")])
-
-])
+        (gmwmseg, select_gm_mask, [("tissue_class_files", "inlist")]),
+    ])
+
+    # The perfusion maps and masks are only processed in the extract stage
+    if not extract:
+        return wf
+
+    wf.connect(perf_connections + mask_connections + [
+    # Pre-processing of DSC-parametermaps:
+        # Parametermaps are LPS reoriented to match MPRAGE and other DSC files (in memory, see applytransforms)
+        # The transformation matrix resulting from the co-registration of MPRAGE and DSC_Source_0 is applied to reoriented perfusion images
+        # and to the DSC_mask; MPRAGE is used as reference image of the co-registration
+        (perf_files, apptrans, [(perf_output, "in_files")]),
+        (skullstrip_DSC, apptrans, [("mask_file", "mask_file")]),
+        (reg, apptrans, [("out_matrix_file", "in_matrix_file")]),
+        (skullstrip_MPRAGE, apptrans, [("out_file", "reference")]),
+        (apptrans, datasink, [("out_files", "14_DSC_parametermaps_reor_coreg"),
+                              ("out_mask_file", "17_DSC_mask_coreg")]),
+
+    # PREPARATION FOR TRIPLE MASKS (GM, VOI, DSC)
+    # For the analysis three masks have to be combined before applying them to the perfusion parameter maps
+    # Step 1) DSC_mask (1x) + GM_mask (1x) + VOI_masks (8x) -> one label volume
+    # Step 2) apply the label volume (8 territories) to the 12 perfusion parameter maps
+
+
+    # Step 1)
+        # DSC_mask, GM_mask and the 8 VOI_masks are combined to one label volume with one bit per territory
+        # manual VOI masks are still in LPI orientation and are LPS reoriented in memory
+        # DSC_mask is co-registered to MPRAGE together with the perfusion maps (applytransforms)
+        (apptrans, triple_mask, [("out_mask_file", "dsc_mask_file")]),
+        (select_gm_mask, triple_mask, [("out", "gm_file")]),
+        (mask_files, triple_mask, [(mask_output, "voi_mask_files")]),
+        (triple_mask, datasink, [("label_file", "19_Triple_mask_DSC_GM_VOI"),
+                                 ("label_names", "19_Triple_mask_DSC_GM_VOI.@names")]),
+
+    # Step 2)
+        # The label volume (8 territories) is applied to the 12 perfusion parametermaps in one node
+        # Mean, median and number of voxels of each VOI are saved in one table per subject, the histograms next to it
+        (apptrans, voi_stats, [("out_files", "in_files")]),
+        (triple_mask, voi_stats, [("label_file", "label_file"), ("label_names", "label_names")]),
+        (voi_stats, datasink, [("out_table", "33_DSC_reor_coreg_gm_VOI_stats"),
+                               ("out_histograms", "33_DSC_reor_coreg_gm_VOI_stats.@histograms")]),
+
+    # Manifest of the results
+        # the VOI statistics table saved by the datasink is added to the manifest of the cohort
+        (datasink, manifest, [("out_file", "sink_files")]),
+        (infosource, manifest, [("subject_id", "subject_id")])
+
+    ])
+
+    # LPS reoriented perfusion maps and VOI masks are only saved to datasink if requested
+    if settings["write_reoriented_images"]:
+        wf.connect([
+            (perf_files, reorient, [(perf_output, "in_file")]),
+            (reorient, datasink, [("out_file", "13_DSC_parametermaps_reor")]),
+            (mask_files, reorient_VOI_masks, [(mask_output, "in_file")]),
+            (reorient_VOI_masks, datasink, [("out_file", "16_VOI_masks_reor")]),
+        ])
+
+    # Triple masks of the single territories and triple masked perfusion images are only saved to datasink if requested
+    if settings["write_triple_masks"]:
+        wf.connect(triple_mask, "mask_files", datasink, "19_Triple_mask_DSC_GM_VOI.@territories")
+    if settings["write_masked_images"]:
+        wf.connect(voi_stats, "masked_files", datasink, "21_DSC_reor_coreg_gm_VOI")
+    # Relative perfusion maps and vulnerability masks are only computed and saved if requested
+    if settings["write_relative_maps"]:
+        wf.connect([
+            (voi_stats, datasink, [("relative_files", "22_DSC_reor_coreg_relative"),
+                                   ("vulnerability_files", "23_DSC_reor_coreg_vulnerability")]),
+        ])
+    return wf
 
-############################### RUN WORKFLOW ###################################
 
-# Define number of CPUs used with n_procs
-wf.run('MultiProc', plugin_args={'n_procs': cpus})
+############################### RUN WORKFLOW ###################################
 
-# Visualize the graph
-wf.write_graph(graph2use='flat')
+## STREAMING RESULTS ##
+# status_callback of the MultiProc plugin: the VOI statistics of a subject are written to the VOI results store as
+# soon as its voi_statistics node has finished (or was reused from an earlier run), so the results of finished
+# subjects can be read while the cohort is still running, i.e. by statistics.py with voi_results_dir.
+# The histograms of the subject are copied to the histogram store in the same way.
+# The aggregate stage writes them again from the manifest and records the fingerprints of the subjects.
+def stream_results(voi_results_directory, voi_histograms_directory):
+    from profiling import node_subject
+    from voi_results import from_voi_statistics, write_subject
+    from voi_histograms import write_subject_histograms
+
+    def status_callback(node, status):
+        if status != "end" or node.name != "voi_statistics":
+            return
+        # errors of the hook must not stop the workflow, the subject is written by the aggregate stage
+        try:
+            subject = node_subject(node)
+            write_subject(voi_results_directory, subject, from_voi_statistics(node.result.outputs.out_table, subject))
+            write_subject_histograms(voi_histograms_directory, subject, node.result.outputs.out_histograms)
+            print("VOI results of", subject, "written to", voi_results_directory)
+        except Exception as error:
+            print("VOI results of", node.fullname, "could not be written:", error)
+    return status_callback
+
+
+def run_workflow(settings, run_list, extract=True):
+    from nipype import config
+    from custom_nodes import update_manifest
+    from node_cache import evict_result_store
+    from resources import node_resources
+    from voi_results import remove_subjects, stored_subjects
+    from voi_histograms import remove_subject_histograms, stored_histogram_subjects
+
+    paths = result_paths(settings)
+
+    # Remove old and least recently used entries from the result store
+    if settings["result_store_dir"]:
+        evict_result_store(settings["result_store_dir"], max_size_gb=settings["result_store_max_size_gb"],
+                           max_age_days=settings["result_store_max_age_days"])
+
+    # Rows of the subjects to process are removed from the manifest, the workflow adds their new rows
+    # (under the lock of update_manifest, subjects of another run may be finishing)
+    if extract and run_list:
+        update_manifest([], None, paths["manifest_file"], remove_subjects=run_list)
+    # without incremental mode the VOI results and histogram stores only hold the subjects of this run
+    if extract and not settings["incremental"]:
+        remove_subjects(paths["voi_results_directory"], stored_subjects(paths["voi_results_directory"]))
+        remove_subject_histograms(paths["voi_histograms_directory"],
+                                  stored_histogram_subjects(paths["voi_histograms_directory"]))
+
+    if settings["record_resources"]:
+        config.enable_resource_monitor()
+
+    # Define number of CPUs used with n_procs and the memory budget with memory_gb
+    plugin_args = {'n_procs': settings["cpus"]}
+    # VOI results of every subject are written to the store as soon as they are available
+    if extract:
+        plugin_args['status_callback'] = stream_results(paths["voi_results_directory"],
+                                                        paths["voi_histograms_directory"])
+    if settings["memory_gb"]:
+        plugin_args['memory_gb'] = settings["memory_gb"]
+
+    # Subjects with transient failures are run again (max_retries), the graph only holds the subjects of the attempt
+    # A subject is complete if its results reached the datasink (preprocess) or the manifest (extract)
+    # Memory and threads of every node are estimated from earlier runs of this workflow or taken from resources.py
+    # and passed to the nodes when the workflow is built; the recorded peaks are cached next to the profile reports
+    work_dir = opj(settings["experiment_dir"], settings["workflow_name"])
+    wf = build_workflow(settings, run_list, extract, node_resources(work_dir, cache_file=paths["resources_file"]))
+    pending = list(run_list)
+    attempt = 0
+    while pending:
+        if attempt:
+            wf = build_workflow(settings, pending, extract, node_resources(work_dir, cache_file=paths["resources_file"]))
+        sinks = run_attempt(settings, wf, pending, plugin_args)
+        pending = finish_attempt(settings, wf, pending, extract, attempt, sinks)
+        attempt += 1
+    return wf
+
+
+## FAULT ISOLATION ##
+# runs the workflow once; a failed node only stops its own subject (nipype runs all nodes that do not depend on it)
+# and the crash files are written as text to the crash folder of the workflow
+# Returns the subjects whose datasink finished in this attempt
+def run_attempt(settings, wf, subjects, plugin_args):
+    from profiling import ProfiledMultiProcPlugin, write_profile, node_subject
+    from subject_status import read_status, set_status, write_status
+    import shutil
+
+    paths = result_paths(settings)
+    crash_dir = opj(wf.base_dir, wf.name, "crashes")
+    # crash files left by a killed run cannot be assigned to this attempt
+    shutil.rmtree(crash_dir, ignore_errors=True)
+    wf.config["execution"]["crashdump_dir"] = crash_dir
+    wf.config["execution"]["crashfile_format"] = "txt"
+    write_status(paths["status_file"], set_status(read_status(paths["status_file"]), subjects, "running"))
+    # the datasink runs every time, also if all other nodes of the subject were reused
+    sinks = set()
+    stream = plugin_args.get("status_callback")
+
+    def status_callback(node, status):
+        if status == "end" and node.name == "datasink":
+            sinks.add(node_subject(node))
+        if stream:
+            stream(node, status)
+    runner = ProfiledMultiProcPlugin(plugin_args=dict(plugin_args, status_callback=status_callback))
+    try:
+        wf.run(runner)
+    except RuntimeError as error:
+        print("Workflow finished with failed nodes:", str(error).strip().splitlines()[-1])
+    finally:
+        # Slowest nodes and critical path of every subject, also of runs with failed subjects;
+        # the reports of all runs are kept for comparison
+        if settings["write_profile_report"] and runner.execgraph is not None:
+            write_profile(runner.execgraph, paths["results_directory"] + "/" + "46_Profiling")
+    return sinks
+
+
+# status of the subjects of an attempt from the crash files and the results of the subjects: rows in the manifest
+# (extract) or a finished datasink (sinks, preprocess); failed subjects are quarantined with their crash files,
+# subjects with transient errors are returned to be run again
+def finish_attempt(settings, wf, subjects, extract, attempt, sinks):
+    from subject_status import (read_status, set_status, write_status, crash_files_by_subject, crash_error,
+                                is_transient, quarantine)
+
+    paths = result_paths(settings)
+    crashes = crash_files_by_subject(opj(wf.base_dir, wf.name, "crashes"))
+    finished = manifest_subjects(paths["manifest_file"]) if extract else set(sinks)
+    stage = "extract" if extract else "preprocess"
+    status = read_status(paths["status_file"])
+    retry = []
+    for subject in subjects:
+        crash_files = crashes.get(subject, [])
+        if not crash_files and subject in finished:
+            set_status(status, [subject], "complete", stage=stage)
+        elif attempt < settings["max_retries"] and is_transient(crash_files, settings["transient_errors"]):
+            print("Transient failure of", subject, "(%s), running it again" % crash_error(crash_files[0]))
+            for path in crash_files:
+                os.remove(path)
+            retry.append(subject)
+        else:
+            error = crash_error(crash_files[0]) if crash_files else ("no VOI statistics in the manifest" if extract
+                                                                       else "results did not reach the datasink")
+            crash_files = quarantine(crash_files, paths["quarantine_directory"], subject)
+            set_status(status, [subject], "failed", error=error, crashes=crash_files, stage=stage)
+            print("Subject", subject, "failed:", error)
+    # crash files of nodes outside the subject iterables
+    if "" in crashes:
+        print("Crash files of the workflow moved to", quarantine(crashes[""], paths["quarantine_directory"], ""))
+    write_status(paths["status_file"], status)
+    return retry
 
-end = time.time()
-print(end - start, "seconds")
 
 ################################# ANALYSIS #####################################
 
@@ -712,66 +707,114 @@ def create_a_directory(base_directory, directory_name_to_create):
         print("....Created "+base_directory + "/" + directory_name_to_create)
 
 
-def find_txts_and_corresponding_regions(directory, patient_name ,file="001.nii",  ):
-    segmentation_strings=[]
-    txts=[]
-    for x, y, z in (os.walk(directory)):
-        for item in z:
-             if file in item:
-                image_to_evaluate=os.path.join(x, item)
-                #first leaves out(cuts) the filename of the path then
-                cut = Path(image_to_evaluate).parent
-                #gets the last element after /
-                folder_name = os.path.basename(cut)
-                #remove ground_truth from comparison
-                # if ground_truth_folder_and_file_name not in folder_name:
-                segmentation_strings.append(folder_name)
-                if patient_name in image_to_evaluate:
-                    txts.append(image_to_evaluate)
-                #print(txts)
-                dic = dict(zip(txts, segmentation_strings))
-                print("Hi Jonas!", dic)
-    return dic
-
-#results directory
-results_directory = results_dir+ "/" + workflow_name + '_results'
-print("Here is the results directory: ", results_directory)
-new_dict={}
-dict_nice={}
-
-#loops through patients and perfusion images
-for patient in subject_list:
-    content_all = []
-    column_name_list=[]
-    for perfusion_ID in include_average_list:
-        #locates folder where txts are stored
-        path=results_directory+"/"+perfusion_ID
-        print("Here is the folder the txt file is stored", path)
-        #finds all txt files in the path and saves them in a dictionary with their corresponding masks ACA, MCA etc
-        dictionary=find_txts_and_corresponding_regions(path,patient,file="txt")
-        print(dictionary)
-        #reads the value in the text file and stores the values in a new dictionary
-        for key, value in dictionary.items():
-            f = open(key, "r")
-            contents =f.read()
-            content_all.append(float(contents))
-            #value is the mask territory
-            new_dict[patient + "_" + perfusion_ID+ value]=float(contents)
-            column_name = perfusion_ID[3:] + value
-            column_name = column_name.replace("_coreg_gm_VOI", "")
-            column_name_list.append(column_name)
-    dict_nice[patient]= content_all
-    print(column_name_list)
-
-
-df_nice=pd.DataFrame.from_dict(dict_nice,orient='index')
-#creates dataframe from new_dict dictionary
-df=pd.DataFrame.from_dict(new_dict,orient='index')
-#renames the 0 column
-df.rename(columns={0: "Average_VOI_intensity"}, inplace=True)
-#creates a folder to save the csv file
-create_a_directory(results_directory,"45_Results_VOI_avg")
-df.to_csv(results_directory+"/"+ "45_Results_VOI_avg/all_averages.csv")
-
-df_nice.columns = column_name_list
-df_nice.to_csv(results_directory+"/"+ "45_Results_VOI_avg/all_averages_nice.csv")
+# Writes the VOI statistics of the processed subjects from the manifest to the VOI results store
+def aggregate(settings, fingerprints, run_list):
+    import pandas as pd
+    from voi_results import from_long_rows, write_subject, remove_subjects, stored_subjects
+    from voi_histograms import write_subject_histograms, remove_subject_histograms, stored_histogram_subjects
+
+    paths = result_paths(settings)
+    voi_results_directory = paths["voi_results_directory"]
+    voi_histograms_directory = paths["voi_histograms_directory"]
+    print("Here is the results directory: ", paths["results_directory"])
+    #creates a folder to save the results
+    create_a_directory(paths["results_directory"],"45_Results_VOI_avg")
+
+    #fingerprints of all subjects in the VOI results store; subjects without results are processed again in the next run
+    processed = {}
+    if settings["incremental"]:
+        processed = processed_subjects(paths["subjects_file"])
+    else:
+        #without incremental mode the store is rebuilt from the subjects of this run
+        remove_subjects(voi_results_directory, stored_subjects(voi_results_directory))
+        remove_subject_histograms(voi_histograms_directory, stored_histogram_subjects(voi_histograms_directory))
+
+    #reads the manifest once and writes the latest rows of every processed patient to the VOI results store
+    missing = list(run_list)
+    if run_list and os.path.exists(paths["manifest_file"]):
+        manifest_df = pd.read_csv(paths["manifest_file"])
+        manifest_df = manifest_df[manifest_df["subject"].isin(run_list)]
+        manifest_df = manifest_df.drop_duplicates(["subject", "map", "territory", "statistic"], keep="last")
+        for patient, rows in manifest_df.groupby("subject"):
+            write_subject(voi_results_directory, patient, from_long_rows(rows))
+            #histograms saved by the datasink next to the VOI statistics table
+            histograms = os.path.join(os.path.dirname(rows["path"].iloc[-1]), "voi_histograms.npz")
+            if os.path.exists(histograms):
+                write_subject_histograms(voi_histograms_directory, patient, histograms)
+            processed[patient] = fingerprints[patient]
+        missing = [patient for patient in run_list if patient not in set(manifest_df["subject"])]
+
+    #results of missing subjects in the stores are stale (results of the inputs before a change) or partial (streamed
+    #before a later node failed); they are removed, so the stores never mix results of different inputs
+    remove_subjects(voi_results_directory, missing)
+    remove_subject_histograms(voi_histograms_directory, missing)
+    for patient in missing:
+        processed.pop(patient, None)
+
+    pd.Series(processed, name="fingerprint", dtype=object).rename_axis("subject").to_csv(paths["subjects_file"])
+    print("VOI results of", len(stored_subjects(voi_results_directory)), "subjects in", voi_results_directory)
+
+    #subjects without VOI statistics (failed or not run) are processed again in the next run or with "resume"
+    if missing:
+        from subject_status import read_status
+        status = read_status(paths["status_file"])
+        print("Missing VOI statistics of", len(missing), "subjects:")
+        for patient in missing:
+            entry = status.get(patient, {})
+            print("   ", patient, entry.get("status", "not run"), entry.get("error", ""))
+
+
+############################### COMMAND LINE ###################################
+# python nipype_pipeline.py [stage ...] [--config run.json]
+# i.e. "python nipype_pipeline.py aggregate" only updates the VOI results store; without stages all stages run
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="DSC perfusion pipeline: " + ", ".join(STAGES))
+    parser.add_argument("stages", nargs="*", metavar="stage",
+                        help="stages to run (%s) or resume, default: all" % ", ".join(STAGES))
+    parser.add_argument("--config", help="JSON file with settings replacing the defaults of this file")
+    parser.add_argument("--write-config", metavar="FILE", help="write the settings to FILE and exit")
+    args = parser.parse_args(argv)
+    unknown = [stage for stage in args.stages if stage not in STAGES + ["resume"]]
+    if unknown:
+        parser.error("unknown stages: %s (choose from %s, resume)" % (", ".join(unknown), ", ".join(STAGES)))
+
+    # start timer to calculate run time of the script
+    start = time.time()
+    settings = load_settings(args.config)
+    if args.write_config:
+        with open(args.write_config, "w") as f:
+            json.dump(settings, f, indent=2)
+        print("Settings written to", args.write_config)
+        return
+    stages = [stage for stage in STAGES if stage in (args.stages or STAGES)]
+
+    fingerprints, run_list = subjects_to_run(settings)
+    # failed and unfinished subjects of the cohort, without the graph of the complete cohort
+    if "resume" in args.stages:
+        from subject_status import read_status, unfinished_subjects
+        unfinished = unfinished_subjects(read_status(result_paths(settings)["status_file"]))
+        run_list = [subject for subject in unfinished if subject in fingerprints]
+        stages = [stage for stage in STAGES if stage in args.stages or stage in ["extract", "aggregate"]]
+    print("Subjects to process:", run_list)
+    # without pending subjects the workflow would have no iterables: it is neither built nor run
+    skipped = [stage for stage in stages if stage in ["preprocess", "extract", "graph"]]
+    if skipped and not run_list:
+        print("No subjects to process - stages skipped:", ", ".join(skipped))
+        stages = [stage for stage in stages if stage not in skipped]
+
+    wf = None
+    if "preprocess" in stages or "extract" in stages:
+        wf = run_workflow(settings, run_list, extract="extract" in stages)
+    if "graph" in stages:
+        # Visualize the graph
+        wf = wf if wf is not None and "extract" in stages else build_workflow(settings, run_list)
+        wf.write_graph(graph2use='flat')
+    if "aggregate" in stages:
+        aggregate(settings, fingerprints, run_list)
+
+    end = time.time()
+    print(end - start, "seconds")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
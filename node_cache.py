@@ -0,0 +1,164 @@
+############################## CROSS-RUN RESULT STORE ##########################
+# Nipype only reuses results inside the working directory of one workflow (wf.base_dir/workflow_name).
+# The interfaces in this file look up their outputs in a shared result store before running.
+# Entries are keyed by the content of the input images plus the node parameters and the version of the tool (FSL,
+# FreeSurfer), so every run and workflow reuses bias corrections, skull strips, segmentations and coregistration
+# matrices already computed for a subject, and an upgrade of the tools computes them again.
+#
+# Layout of the store: <store_dir>/<key[:2]>/<key>/outputs.json and one copy of every output file.
+# The modification time of outputs.json is the time of the last use of an entry and is used for eviction.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import nipype.interfaces.freesurfer as fs
+import nipype.interfaces.fsl as fsl
+from nipype.interfaces.base import isdefined
+
+# stdout of nodes whose outputs were restored from the store; their recorded resources are not those of a real run
+RESTORED_MESSAGE = "Outputs restored from result store entry"
+
+
+# content hash of a file, read in chunks to keep memory low for large images
+def file_hash(path, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+## RESULT STORE MIXIN ##
+# Has to be placed before the nipype interface in the base classes, i.e. class CachedBET(ResultStoreMixin, fsl.BET).
+# store_dir=None disables the store and the interface behaves like the original one.
+class ResultStoreMixin(object):
+    # inputs that do not influence the results
+    _store_ignore = ("environ",)
+
+    def __init__(self, store_dir=None, **inputs):
+        super(ResultStoreMixin, self).__init__(**inputs)
+        self.store_dir = store_dir
+
+    # file paths are replaced by the hash of the file content, so the key does not depend on the run directory;
+    # the version of the tool is None if it cannot be determined
+    def _store_key(self):
+        def digest(value):
+            if isinstance(value, (list, tuple)):
+                return [digest(v) for v in value]
+            if isinstance(value, str) and os.path.isfile(value):
+                return file_hash(value)
+            return value
+
+        inputs = {name: digest(value) for name, value in self.inputs.get_traitsfree().items()
+                  if name not in self._store_ignore and isdefined(value)}
+        payload = json.dumps([self._cmd, self.version, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _run_interface(self, runtime):
+        if not self.store_dir:
+            return super(ResultStoreMixin, self)._run_interface(runtime)
+
+        key = self._store_key()
+        entry = os.path.join(self.store_dir, key[:2], key)
+        if os.path.isfile(os.path.join(entry, "outputs.json")):
+            self._restore_outputs(entry)
+            runtime.returncode = 0
+            runtime.stdout = RESTORED_MESSAGE + " " + entry
+            return runtime
+
+        runtime = super(ResultStoreMixin, self)._run_interface(runtime)
+        if getattr(runtime, "returncode", 0) == 0:
+            self._store_outputs(entry)
+        return runtime
+
+    # output files are copied to a temporary folder which is renamed at the end,
+    # so parallel runs never see incomplete entries
+    def _store_outputs(self, entry):
+        temp = "%s.%d.tmp" % (entry, os.getpid())
+        os.makedirs(temp)
+        stored = {}
+        for name, value in self._list_outputs().items():
+            files = value if isinstance(value, list) else [value]
+            if not files or not all(isinstance(f, str) and os.path.isfile(f) for f in files):
+                continue
+            stored[name] = []
+            for i, f in enumerate(files):
+                stored_name = "%s_%d_%s" % (name, i, os.path.basename(f))
+                shutil.copyfile(f, os.path.join(temp, stored_name))
+                stored[name].append(stored_name)
+        with open(os.path.join(temp, "outputs.json"), "w") as f:
+            json.dump({"interface": self.__class__.__name__, "outputs": stored}, f, indent=1)
+        try:
+            os.rename(temp, entry)
+        except OSError:
+            # another run stored the same entry in the meantime
+            shutil.rmtree(temp, ignore_errors=True)
+
+    # output files are copied to the names the interface would have produced in the node directory
+    def _restore_outputs(self, entry):
+        with open(os.path.join(entry, "outputs.json")) as f:
+            stored = json.load(f)["outputs"]
+        expected = self._list_outputs()
+        for name, stored_names in stored.items():
+            targets = expected[name] if isinstance(expected[name], list) else [expected[name]]
+            for stored_name, target in zip(stored_names, targets):
+                shutil.copyfile(os.path.join(entry, stored_name), target)
+        os.utime(os.path.join(entry, "outputs.json"))
+
+
+## CACHED INTERFACES ##
+# NUC, BET, FAST and FLIRT are most of the run time of a subject
+class CachedMNIBiasCorrection(ResultStoreMixin, fs.MNIBiasCorrection):
+    pass
+
+
+class CachedBET(ResultStoreMixin, fsl.BET):
+    pass
+
+
+class CachedFAST(ResultStoreMixin, fsl.FAST):
+    pass
+
+
+class CachedFLIRT(ResultStoreMixin, fsl.FLIRT):
+    pass
+
+
+## EVICTION ##
+# Removes entries that were not used for max_age_days, then the least recently used entries
+# until the store is smaller than max_size_gb. Leftovers of interrupted runs older than one day are removed as well.
+def evict_result_store(store_dir, max_size_gb=None, max_age_days=None):
+    if not os.path.isdir(store_dir):
+        return
+    now = time.time()
+    entries = []
+    for prefix in os.listdir(store_dir):
+        prefix_dir = os.path.join(store_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry = os.path.join(prefix_dir, key)
+            manifest = os.path.join(entry, "outputs.json")
+            if not os.path.isfile(manifest):
+                if key.endswith(".tmp") and now - os.path.getmtime(entry) > 24 * 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(manifest), size, entry))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for last_used, size, entry in entries:
+        too_old = max_age_days is not None and now - last_used > max_age_days * 24 * 3600
+        too_large = max_size_gb is not None and total > max_size_gb * 1024 ** 3
+        if not (too_old or too_large):
+            continue
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed += 1
+    if removed:
+        print("Removed", removed, "entries from result store", store_dir)
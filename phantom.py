@@ -0,0 +1,202 @@
+############################## SYNTHETIC PHANTOM COHORT ########################
+# Generates synthetic subjects in the layout of the patient data of nipype_pipeline.py (MPRAGE.nii.gz,
+# DSC_Source.nii.gz, DSC_pgui_*.nii.gz, Masken_cut/*_mask.nii.gz) and the simulation files of statistics.py
+# (<bp>.csv, Side_of_stenosis.csv), so both scripts can be run and benchmarked without clinical data.
+#
+# Every head is an ellipsoid divided into the hemispheres (left/right) and the territories ACA (anterior third),
+# MCA (middle third) and PCA (posterior third). The side of stenosis is drawn per subject; in vulnerable subjects the
+# perfusion of the ipsilateral MCA territory is delayed (MTT, Tmax, TTP increased, CBF decreased) and the simulated
+# perfusion pressure of the ipsilateral M2 segments is below the autoregulation threshold.
+#
+# Orientation as in the study data: DSC_Source is stored in LPS (RAI in ITK terms), MPRAGE, perfusion maps and VOI
+# masks in LPI, so the LPS reorientation of the pipeline brings them onto the grids of DSC_Source and MPRAGE.
+#
+# Example: python phantom.py <directory> [n_subjects]
+
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+
+#### DEFINITIONS ####
+# perfusion maps (name: value in healthy tissue) as in the study data
+MAPS = {"DSC_pgui_c_CBV": 4.0, "DSC_pgui_oSVD_MTT": 4.0, "DSC_pgui_oSVD_Tmax": 1.0, "DSC_pgui_parametric_CBF": 50.0,
+        "DSC_pgui_parametric_CBV": 4.0, "DSC_pgui_parametric_MTT": 4.0, "DSC_pgui_parametric_Tmax": 1.0,
+        "DSC_pgui_TTP": 30.0}
+TERRITORIES = ["ACA", "MCA", "PCA", "hemi"]
+# prolonged (time) and reduced (flow) parameters in delayed perfusion
+DELAYED = ("MTT", "Tmax", "TTP")
+REDUCED = ("CBF",)
+
+
+# affine of an LPS grid with the given shape and voxel size centered on the origin
+def lps_affine(shape, voxel_size):
+    affine = np.diag([-voxel_size[0], -voxel_size[1], voxel_size[2], 1.0])
+    affine[:3, 3] = [(shape[0] - 1) / 2.0 * voxel_size[0], (shape[1] - 1) / 2.0 * voxel_size[1],
+                     -(shape[2] - 1) / 2.0 * voxel_size[2]]
+    return affine
+
+
+# saves an LPS array in the given orientation (nibabel axis codes)
+def save_oriented(data, affine, path, orientation="LPI"):
+    image = nib.Nifti1Image(data, affine)
+    if orientation != "LPS":
+        image = image.as_reoriented(nib.orientations.ornt_transform(nib.orientations.axcodes2ornt("LPS"),
+                                                                    nib.orientations.axcodes2ornt(orientation)))
+    nib.save(image, path)
+    return path
+
+
+# head (ellipsoid), left hemisphere and territory index (0 ACA, 1 MCA, 2 PCA) of every voxel of an LPS grid;
+# coordinates are normalized to the field of view, so all grids of a subject share the same anatomy
+def anatomy(shape):
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    head = (x / 0.9) ** 2 + (y / 0.95) ** 2 + (z / 0.9) ** 2 < 1
+    left = x > 0
+    territory = np.digitize(y, [-1 / 3.0, 1 / 3.0])
+    return head, left, territory
+
+
+# masks of all territories (dict <territory>_<ipsi|contra> -> bool array) for a side of stenosis (0 left, 1 right)
+def territory_masks(shape, stenosis_side):
+    head, left, territory = anatomy(shape)
+    ipsi = left if stenosis_side == 0 else ~left
+    masks = {}
+    for side, hemisphere in (("ipsi", ipsi), ("contra", ~ipsi)):
+        for index, name in enumerate(TERRITORIES[:3]):
+            masks[name + "_" + side] = head & hemisphere & (territory == index)
+        masks["hemi_" + side] = head & hemisphere
+    return masks
+
+
+## SUBJECT ##
+# Writes one subject. rel_mtt is the ratio of the MTT of the ipsilateral to the contralateral MCA territory.
+def make_subject(directory, subject, stenosis_side, rel_mtt, dsc_matrix=(64, 64, 20), mprage_matrix=(128, 128, 96),
+                 field_of_view=(220.0, 220.0, 160.0), timepoints=40, maps=None, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    maps = MAPS if maps is None else maps
+    subject_dir = os.path.join(directory, subject)
+    os.makedirs(os.path.join(subject_dir, "Masken_cut"), exist_ok=True)
+    mprage_affine = lps_affine(mprage_matrix, [f / n for f, n in zip(field_of_view, mprage_matrix)])
+    dsc_affine = lps_affine(dsc_matrix, [f / n for f, n in zip(field_of_view, dsc_matrix)])
+
+    # MPRAGE: brighter core (white matter) in a darker shell (grey matter)
+    head, _, _ = anatomy(mprage_matrix)
+    x, y, z = np.meshgrid(*[np.linspace(-1, 1, n) for n in mprage_matrix], indexing="ij")
+    core = (x / 0.7) ** 2 + (y / 0.75) ** 2 + (z / 0.7) ** 2 < 1
+    mprage = head * (400.0 + 300.0 * core) + rng.normal(0, 15, mprage_matrix) * head
+    save_oriented(mprage.astype(np.float32), mprage_affine, os.path.join(subject_dir, "MPRAGE.nii.gz"))
+
+    for name, mask in territory_masks(mprage_matrix, stenosis_side).items():
+        save_oriented(mask.astype(np.uint8), mprage_affine, os.path.join(subject_dir, "Masken_cut", name + "_mask.nii.gz"))
+
+    # delay factor of every DSC voxel: rel_mtt in the ipsilateral MCA territory, 1 elsewhere
+    head, _, _ = anatomy(dsc_matrix)
+    delay = np.where(territory_masks(dsc_matrix, stenosis_side)["MCA_ipsi"], rel_mtt, 1.0)
+    for name, value in maps.items():
+        parameter = name.split("_")[-1]
+        factor = delay if parameter in DELAYED else 1.0 / delay if parameter in REDUCED else 1.0
+        data = head * value * factor * (1 + rng.normal(0, 0.05, dsc_matrix))
+        save_oriented(data.astype(np.float32), dsc_affine, os.path.join(subject_dir, name + ".nii.gz"))
+
+    # DSC source: signal drop of a gamma variate bolus, arriving later in delayed tissue
+    t = np.arange(timepoints, dtype=np.float32)[np.newaxis, np.newaxis, np.newaxis, :]
+    arrival = 8.0 * delay[..., np.newaxis]
+    shifted = np.clip(t - arrival, 0, None)
+    bolus = (shifted / (1.5 * delay[..., np.newaxis])) ** 3 * np.exp(-shifted / (1.5 * delay[..., np.newaxis]))
+    signal = head[..., np.newaxis] * 1000.0 * np.exp(-0.02 * bolus) + rng.normal(0, 10, dsc_matrix + (timepoints,))
+    save_oriented(np.clip(signal, 0, None).astype(np.int16), dsc_affine, os.path.join(subject_dir, "DSC_Source.nii.gz"),
+                  orientation="LPS")
+    return subject_dir
+
+
+## SIMULATION ##
+# Simulated perfusion pressures (mmHg) of the M2 segments and side of stenosis in the format of statistics.py.
+# Subject IDs PEG0001 are written as PEG_001 (statistics.py replaces '_' by '0').
+def simulation_tables(truth, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    index = truth.index.str.replace("PEG0", "PEG_", regex=False)
+    ipsi = np.where(truth["vulnerable"], rng.normal(40, 8, len(truth)), rng.normal(70, 8, len(truth)))
+    contra = rng.normal(75, 5, len(truth))
+    right = truth["Stenosis_L0_R1"].to_numpy() == 1
+    sim = pd.DataFrame(index=index)
+    for segment, offset in (("M2 sup", 0.0), ("M2 inf", 3.0)):
+        sim[segment + " R"] = np.where(right, ipsi, contra) + offset + rng.normal(0, 2, len(truth))
+        sim[segment + " L"] = np.where(right, contra, ipsi) + offset + rng.normal(0, 2, len(truth))
+    sos = pd.DataFrame({"Stenosis_L0_R1": truth["Stenosis_L0_R1"].to_numpy()}, index=index)
+    return sim.round(1), sos
+
+
+# Ground truth of a cohort: side of stenosis, vulnerability and ratio of ipsi- to contralateral MCA MTT
+def cohort_truth(n_subjects, vulnerable_fraction=0.4, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    vulnerable = rng.random(n_subjects) < vulnerable_fraction
+    truth = pd.DataFrame({"Stenosis_L0_R1": rng.integers(0, 2, n_subjects), "vulnerable": vulnerable,
+                          "rel_mtt": np.where(vulnerable, rng.normal(1.6, 0.15, n_subjects),
+                                              rng.normal(1.1, 0.1, n_subjects)).round(3)},
+                         index=pd.Index(["PEG%04d" % (i + 1) for i in range(n_subjects)], name="subject"))
+    return truth
+
+
+## PERFUSION TABLE ##
+# Statistics of the perfusion maps per territory in the format of perfusion_stats.csv of statistics.py
+# (<map>_<territory>_<side><stat>), computed from the ground truth without images; used for large synthetic cohorts.
+def perfusion_table(truth, stats=("_median", "_mean"), maps=None, rng=None):
+    rng = np.random.default_rng(0) if rng is None else rng
+    maps = MAPS if maps is None else maps
+    columns = {}
+    for name, value in maps.items():
+        parameter = name.split("_")[-1]
+        for territory in TERRITORIES:
+            for side in ("ipsi", "contra"):
+                delay = truth["rel_mtt"].to_numpy() if (territory == "MCA" and side == "ipsi") else 1.0
+                factor = delay if parameter in DELAYED else 1.0 / delay if parameter in REDUCED else np.ones(len(truth))
+                for stat in stats:
+                    columns["%s_%s_%s%s" % (name, territory, side, stat)] = value * factor * rng.normal(1, 0.02, len(truth))
+    return pd.DataFrame(columns, index=truth.index)
+
+
+## COHORT ##
+# Writes n_subjects subjects to <directory> and the simulation files for every bp (i.e. "MAP70_MCAonly") to
+# <directory>/Simulation_Data. Returns the ground truth.
+def make_cohort(directory, n_subjects=4, bps=("MAP70_MCAonly",), seed=0, **subject_args):
+    rng = np.random.default_rng(seed)
+    truth = cohort_truth(n_subjects, rng=rng)
+    for subject, row in truth.iterrows():
+        make_subject(directory, subject, row["Stenosis_L0_R1"], row["rel_mtt"], rng=rng, **subject_args)
+    sim_directory = os.path.join(directory, "Simulation_Data")
+    os.makedirs(sim_directory, exist_ok=True)
+    for bp in bps:
+        sim, sos = simulation_tables(truth, rng=rng)
+        sim.to_csv(os.path.join(sim_directory, bp + ".csv"), sep=";")
+    sos.to_csv(os.path.join(sim_directory, "Side_of_stenosis.csv"), sep=";")
+    truth.to_csv(os.path.join(sim_directory, "phantom_truth.csv"))
+    return truth
+
+
+# FLIRT matrix (FSL scaled-mm convention) of two images that are aligned in world coordinates,
+# i.e. the DSC grid and the MPRAGE grid of a phantom after the LPS reorientation
+def flirt_matrix(in_file, reference):
+    def fsl_scaled_mm(image):
+        scale = np.diag(list(image.header.get_zooms()[:3]) + [1.0])
+        if np.linalg.det(image.affine[:3, :3]) > 0:
+            flip = np.eye(4)
+            flip[0, 0] = -1
+            flip[0, 3] = image.shape[0] - 1
+            scale = scale @ flip
+        return scale
+
+    in_image, reference_image = nib.load(in_file), nib.load(reference)
+    return (fsl_scaled_mm(reference_image) @ np.linalg.inv(reference_image.affine) @ in_image.affine
+            @ np.linalg.inv(fsl_scaled_mm(in_image)))
+
+
+if __name__ == "__main__":
+    directory = sys.argv[1]
+    n_subjects = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    truth = make_cohort(directory, n_subjects)
+    print("Created", len(truth), "synthetic subjects in", directory)
+    print(truth)
@@ -0,0 +1,152 @@
+############################## RUN PROFILING ###################################
+# Report of the run time and resource use of every node instance of a workflow run (per subject and per map node
+# index), built from the execution graph returned by wf.run and the result files of the nodes.
+#
+# Columns of the report:
+#   subject        value of the subject_id iterable ("" for nodes outside the iterables)
+#   node           node name, i.e. segmentation
+#   index          index of the subnode of a map node, -1 for other nodes
+#   start, end     start and end time (UTC, ISO format); results of earlier runs reused by nipype keep their times
+#   wall_s         wall time in seconds
+#   cpu_s          CPU time in seconds (all threads and child processes), integrated from the resource monitor samples
+#   cpu_peak       peak CPU use in percent of one core
+#   peak_rss_gb    peak resident memory in GB
+#   input_bytes    size of the input files of the node
+#   output_bytes   size of the output files of the node
+# CPU and memory are only known if the nipype resource monitor was enabled (config.enable_resource_monitor()).
+
+import datetime
+import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins import MultiProcPlugin
+from nipype.utils.filemanip import loadpkl
+
+
+COLUMNS = ["subject", "node", "index", "start", "end", "wall_s", "cpu_s", "cpu_peak", "peak_rss_gb",
+           "input_bytes", "output_bytes"]
+
+
+# total size of all existing files in (nested) inputs or outputs of a node
+def _file_bytes(value):
+    if isinstance(value, dict):
+        return sum(_file_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_file_bytes(v) for v in value)
+    if isinstance(value, str) and os.path.isfile(value):
+        return os.path.getsize(value)
+    return 0
+
+
+# CPU time from the samples of the resource monitor (time in s, CPU use in percent)
+def _cpu_seconds(runtime):
+    samples = getattr(runtime, "prof_dict", None)
+    if not samples or len(samples.get("time", [])) < 2:
+        cpu_percent = getattr(runtime, "cpu_percent", None)
+        return np.nan if cpu_percent is None else cpu_percent / 100.0 * runtime.duration
+    cpus, times = np.asarray(samples["cpus"]) / 100.0, np.asarray(samples["time"])
+    return float(np.sum((cpus[1:] + cpus[:-1]) / 2 * np.diff(times)))
+
+
+def _result_row(result_file, subject, node, index):
+    result = loadpkl(result_file)
+    runtime = result.runtime
+    outputs = result.outputs.get() if hasattr(result.outputs, "get") else {}
+    mem_gb = getattr(runtime, "mem_peak_gb", None)
+    cpu_peak = getattr(runtime, "cpu_percent", None)
+    return {"subject": subject, "node": node, "index": index,
+            "start": runtime.startTime, "end": runtime.endTime, "wall_s": runtime.duration,
+            "cpu_s": _cpu_seconds(runtime),
+            "cpu_peak": np.nan if cpu_peak is None else cpu_peak,
+            "peak_rss_gb": np.nan if mem_gb is None else mem_gb,
+            "input_bytes": _file_bytes(result.inputs or {}), "output_bytes": _file_bytes(outputs)}
+
+
+# subject of a node instance from its working directory, i.e. .../run_01/_subject_id_PEG0005/segmentation
+def node_subject(node):
+    match = re.search(r"_subject_id_([^/\\]+)", node.output_dir())
+    return match.group(1) if match else ""
+
+
+## PLUGIN ##
+# MultiProc plugin keeping the execution graph: wf.run only returns it if all nodes succeeded, so the profile of a
+# run with failed subjects is written from runner.execgraph (i.e. wf.run(runner))
+class ProfiledMultiProcPlugin(MultiProcPlugin):
+    execgraph = None
+
+    def run(self, graph, config, updatehash=False):
+        self.execgraph = graph
+        return super(ProfiledMultiProcPlugin, self).run(graph, config, updatehash=updatehash)
+
+
+## PROFILE TABLE ##
+# One row per node instance of the execution graph; map nodes get one row per subnode.
+def collect_profile(execgraph):
+    rows = []
+    for node in execgraph.nodes():
+        subject = node_subject(node)
+        if isinstance(node, MapNode):
+            result_files = glob.glob(os.path.join(node.output_dir(), "mapflow", "_" + node.name + "*",
+                                                  "result__" + node.name + "*.pklz"))
+            for result_file in result_files:
+                index = int(re.search(r"(\d+)\.pklz$", result_file).group(1))
+                rows.append(_result_row(result_file, subject, node.name, index))
+        else:
+            result_file = os.path.join(node.output_dir(), "result_%s.pklz" % node.name)
+            if os.path.exists(result_file):
+                rows.append(_result_row(result_file, subject, node.name, -1))
+    return pd.DataFrame(rows, columns=COLUMNS).sort_values(["subject", "start"]).reset_index(drop=True)
+
+
+## CRITICAL PATH ##
+# Longest chain of dependent nodes of every subject, weighted by the wall time of the nodes. Nodes outside the
+# iterables (subject "") are part of the chains of all subjects.
+# The subnodes of a map node run in parallel, the map node counts with its slowest subnode (waiting times for free
+# cores are not included).
+def critical_paths(execgraph, profile):
+    wall = profile.groupby(["subject", "node"])["wall_s"].max().to_dict()
+
+    import networkx as nx
+    paths = {}
+    longest = {}
+    for node in nx.topological_sort(execgraph):
+        subject = node_subject(node)
+        duration = wall.get((subject, node.name), 0.0)
+        best = max((longest[pred] for pred in execgraph.predecessors(node) if node_subject(pred) in (subject, "")),
+                   key=lambda item: item[0], default=(0.0, []))
+        longest[node] = (best[0] + duration, best[1] + [node.name])
+        if subject and longest[node][0] > paths.get(subject, (-1.0, []))[0]:
+            paths[subject] = longest[node]
+    return {subject: {"wall_s": round(total, 2), "nodes": names} for subject, (total, names) in sorted(paths.items())}
+
+
+## REPORT ##
+# Writes profile_<time>.csv and profile_<time>.json (rows, slowest nodes, critical paths) to out_dir and prints a summary.
+# Reports of several runs in out_dir can be compared to track regressions.
+def write_profile(execgraph, out_dir, n_slowest=10):
+    os.makedirs(out_dir, exist_ok=True)
+    profile = collect_profile(execgraph)
+    stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    profile.to_csv(os.path.join(out_dir, "profile_%s.csv" % stamp), index=False)
+
+    slowest = (profile.groupby("node")
+               .agg(instances=("wall_s", "size"), wall_s=("wall_s", "sum"), cpu_s=("cpu_s", "sum"),
+                    peak_rss_gb=("peak_rss_gb", "max"), io_bytes=("output_bytes", "sum"))
+               .sort_values("wall_s", ascending=False).head(n_slowest))
+    paths = critical_paths(execgraph, profile)
+    report = {"rows": json.loads(profile.to_json(orient="records")),
+              "slowest_nodes": json.loads(slowest.reset_index().to_json(orient="records")),
+              "critical_paths": paths}
+    with open(os.path.join(out_dir, "profile_%s.json" % stamp), "w") as f:
+        json.dump(report, f, indent=1)
+
+    print("Slowest nodes (summed over all instances):")
+    print(slowest.round(2).to_string())
+    for subject, path in paths.items():
+        print("Critical path", subject, path["wall_s"], "s:", " -> ".join(path["nodes"]))
+    return profile
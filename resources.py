@@ -0,0 +1,119 @@
+############################## NODE RESOURCES ##################################
+# The MultiProc plugin of nipype only starts a node if its estimated memory (mem_gb) and number of threads (n_procs)
+# fit into the free part of the budget (plugin_args memory_gb and n_procs). Without estimates every node counts as
+# 0.2 GB and one thread, so FAST, NUC and FLIRT of several subjects may run at the same time and exhaust the memory.
+#
+# Estimates are taken from DEFAULT_RESOURCES and raised to the peak memory and CPU use recorded in earlier runs
+# of the workflow, if the nipype resource monitor was enabled (config.enable_resource_monitor(), requires psutil).
+# Recorded peaks never lower the defaults, and runs whose outputs were restored from the result store (see
+# node_cache.py) are not recorded: the tool did not run, so their peaks would underestimate the next cold run.
+# The recorded peaks are cached in a JSON file (next to the profile reports), so only result files written since
+# the last run are loaded. The estimates are passed to the nodes when the workflow is built (Node mem_gb and n_procs).
+
+import glob
+import json
+import math
+import os
+import re
+
+from nipype.utils.filemanip import loadpkl
+
+from node_cache import RESTORED_MESSAGE
+
+
+## DEFAULT ESTIMATES ##
+# (memory in GB, threads) per node name for one subject with a 1 mm MPRAGE; nodes not listed keep the nipype default
+DEFAULT_RESOURCES = {
+    "reorient_MPRAGE": (0.5, 1),
+    "extract_timeseries": (0.5, 1),
+    # mri_nu_correct.mni (FreeSurfer NUC)
+    "NUC": (1.5, 1),
+    "NUC_2": (0.5, 1),
+    "BETnode_MPRAGE": (1.0, 1),
+    "BETnode_DSC": (0.5, 1),
+    # FAST keeps several copies of the image and the tissue probabilities in memory
+    "segmentation": (3.0, 1),
+    "fsl_reg": (1.0, 1),
+    # all perfusion maps and the DSC mask on the MPRAGE grid (float32)
+    "applytransforms": (1.5, 1),
+    "triple_mask": (0.5, 1),
+    "voi_statistics": (1.0, 1),
+    "reorient_image": (0.5, 1),
+    "reorient_VOI_masks": (0.5, 1),
+}
+
+
+# node name of a result file; subnodes of a map node (i.e. result__reorient_image3.pklz) count for their map node
+def _node_name(result_file):
+    name = os.path.basename(result_file)[len("result_"):-len(".pklz")]
+    mapflow = re.match(r"^_(.+?)\d+$", name)
+    if mapflow and os.path.basename(os.path.dirname(os.path.dirname(result_file))) == "mapflow":
+        return mapflow.group(1)
+    return name
+
+
+## RECORDED RESOURCES ##
+# Peak memory and CPU use of every node in the working directory of a workflow (wf.base_dir/wf.name).
+# The estimate of a node is the largest peak of all its runs times margin; threads are the peak CPU use rounded up
+# (peaks less than 10% above a full thread, i.e. 205% by sampling noise, are rounded down).
+# With cache_file the peaks and the modification times of the result files are kept: result files that did not
+# change are not loaded again, and the peaks of earlier runs are kept when the working directory is removed.
+def recorded_resources(work_dir, margin=1.25, cache_file=None):
+    peaks, read_files = {}, {}
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            peaks = {name: tuple(peak) for name, peak in cache["peaks"].items()}
+            read_files = cache["files"]
+        except (ValueError, KeyError, TypeError):
+            # a damaged cache is rebuilt from the result files
+            peaks, read_files = {}, {}
+    files, result_files = {}, []
+    if work_dir and os.path.isdir(work_dir):
+        result_files = glob.glob(os.path.join(work_dir, "**", "result_*.pklz"), recursive=True)
+    for result_file in result_files:
+        files[result_file] = os.path.getmtime(result_file)
+        if read_files.get(result_file) == files[result_file]:
+            continue
+        try:
+            runtime = loadpkl(result_file).runtime
+        except Exception:
+            # results of interrupted runs or of other nipype versions are skipped
+            continue
+        runtime = runtime if isinstance(runtime, list) else [runtime]
+        for rt in runtime:
+            mem_gb, cpu_percent = getattr(rt, "mem_peak_gb", None), getattr(rt, "cpu_percent", None)
+            if mem_gb is None or cpu_percent is None:
+                continue
+            if str(getattr(rt, "stdout", "") or "").startswith(RESTORED_MESSAGE):
+                continue
+            name = _node_name(result_file)
+            old_mem, old_cpu = peaks.get(name, (0.0, 0.0))
+            peaks[name] = (max(old_mem, float(mem_gb)), max(old_cpu, float(cpu_percent)))
+    if cache_file:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump({"peaks": peaks, "files": files}, f, indent=1)
+        os.replace(cache_file + ".tmp", cache_file)
+    return {name: (round(float(mem_gb) * margin, 2), max(1, int(math.ceil(float(cpu_percent) / 100.0 - 0.1))))
+            for name, (mem_gb, cpu_percent) in peaks.items()}
+
+
+## NODE ARGUMENTS ##
+# mem_gb and n_procs arguments of the Node of every estimated node name. Estimates are limited to the budget of the
+# plugin, otherwise MultiProc refuses to start a node that needs more than the budget.
+def node_arguments(resources, memory_gb=None, n_procs=None):
+    return {name: {"mem_gb": min(mem_gb, memory_gb) if memory_gb else mem_gb,
+                   "n_procs": min(threads, n_procs) if n_procs else threads}
+            for name, (mem_gb, threads) in resources.items()}
+
+
+# default estimates raised to the recorded resources of earlier runs in work_dir (memory and threads separately)
+def node_resources(work_dir=None, margin=1.25, cache_file=None):
+    resources = dict(DEFAULT_RESOURCES)
+    if (work_dir and os.path.isdir(work_dir)) or (cache_file and os.path.exists(cache_file)):
+        for name, (mem_gb, threads) in recorded_resources(work_dir, margin, cache_file).items():
+            default_mem, default_threads = resources.get(name, (0.0, 1))
+            resources[name] = (max(default_mem, mem_gb), max(default_threads, threads))
+    return resources
@@ -0,0 +1,122 @@
+############################## PIPELINE DATASINK ###############################
+# Intermediate images of the workflow may be written uncompressed (working_output_type = "NIFTI" in
+# nipype_pipeline.py), so nodes do not spend their time in gzip and nibabel can memory-map the files.
+# The datasink below saves every .nii file it receives as .nii.gz, so the results folder has the same
+# file names and size as with compressed working files.
+# The datasink runs in every run of the workflow; .nii files whose .nii.gz in the results folder is at least as new as
+# the source are neither copied nor compressed again.
+# Its substitutions are applied in one pass of a compiled regular expression instead of one replace per substitution.
+
+import functools
+import gzip
+import os
+import re
+import shutil
+
+from nipype.interfaces.base import traits, isdefined
+from nipype.utils.filemanip import ensure_list
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
+
+
+# compresses a .nii file to .nii.gz next to it and removes the .nii file; a temporary file is renamed at the end,
+# so an interrupted sink never leaves a truncated .nii.gz
+def gzip_nifti(path, compress_level=6):
+    out_path = path + ".gz"
+    temp = "%s.%d.tmp" % (out_path, os.getpid())
+    with open(path, "rb") as f_in, gzip.open(temp, "wb", compresslevel=compress_level) as f_out:
+        shutil.copyfileobj(f_in, f_out, 2 ** 20)
+    os.replace(temp, out_path)
+    os.remove(path)
+    return out_path
+
+
+# True if the .nii.gz saved from a .nii source is at least as new as the source
+def is_up_to_date(gz_path, source):
+    return os.path.isfile(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(source)
+
+
+## SUBSTITUTIONS ##
+# All substitutions are compiled to one regular expression (longest keys first) and a mapping of the keys to their
+# replacements. One pass gives the same names as the replacements one after the other (DataSink) if no replacement
+# contains or is part of a key, i.e. ("_output_brain", "_NUC_BET") instead of ("_output", "_NUC") followed by ("_NUC_brain", "_NUC_BET").
+# Compiled substitutions are cached, so the cost per path does not grow with the number of substitutions.
+@functools.lru_cache(maxsize=None)
+def compile_substitutions(substitutions):
+    mapping = {}
+    for key, value in substitutions:
+        if not key:
+            raise ValueError("Empty substitution key")
+        # the first substitution of a key is applied, as in the sequential replacement
+        mapping.setdefault(key, value)
+    # a replacement containing a key or being part of a key could create a match for another substitution
+    chained = [(key, value) for value in mapping.values() for key in mapping if key in value or (value and value in key)]
+    if chained:
+        raise ValueError("Chained substitutions (key, replacement) cannot be applied in one pass: %s" % chained)
+    if not mapping:
+        return None, mapping
+    return re.compile("|".join(re.escape(key) for key in sorted(mapping, key=len, reverse=True))), mapping
+
+
+def apply_substitutions(pathstr, substitutions):
+    pattern, mapping = compile_substitutions(tuple(tuple(pair) for pair in substitutions))
+    return pattern.sub(lambda match: mapping[match.group(0)], pathstr) if pattern else pathstr
+
+
+class PipelineDataSinkInputSpec(DataSinkInputSpec):
+    # 6 is the default level of zlib, which FSL uses for NIFTI_GZ
+    compress_level = traits.Range(low=1, high=9, value=6, usedefault=True,
+                                  desc="gzip level of the .nii files saved by the datasink")
+
+
+## PIPELINE DATASINK ##
+# DataSink copies the files first (with the substitutions applied), the copied .nii files are compressed afterwards.
+# .nii files with an up-to-date .nii.gz are taken out of the inputs before the copy and listed with their .nii.gz.
+class PipelineDataSink(DataSink):
+    input_spec = PipelineDataSinkInputSpec
+
+    # file a source of an input is copied to, as in DataSink._list_outputs (local folders only)
+    def _destination(self, key, src):
+        outdir = self.inputs.base_directory if isdefined(self.inputs.base_directory) else "."
+        if isdefined(self.inputs.container):
+            outdir = os.path.join(outdir, self.inputs.container)
+        outdir = os.path.abspath(outdir)
+        for folder in key.split("."):
+            if folder[0] != "@":
+                outdir = os.path.join(outdir, folder)
+        return self._substitute(os.path.join(outdir, self._get_dst(os.path.abspath(src))))
+
+    def _substitute(self, pathstr):
+        if isdefined(self.inputs.substitutions):
+            pathstr = apply_substitutions(pathstr, self.inputs.substitutions)
+        if isdefined(self.inputs.regexp_substitutions):
+            for key, val in self.inputs.regexp_substitutions:
+                pathstr = re.sub(key, val, pathstr)
+        return pathstr
+
+    def _list_outputs(self):
+        # the inputs are changed in place (DataSinkInputSpec keeps them in _outputs) and restored after the copy
+        inputs = dict(self.inputs._outputs)
+        current = []
+        for key, files in inputs.items():
+            if not isdefined(files):
+                continue
+            files = ensure_list(files)
+            if isinstance(files[0], list):
+                files = [item for sublist in files for item in sublist]
+            copied = []
+            for src in files:
+                if src.endswith(".nii") and os.path.isfile(src) and \
+                        is_up_to_date(self._destination(key, src) + ".gz", src):
+                    current.append(self._destination(key, src) + ".gz")
+                else:
+                    copied.append(src)
+            if len(copied) < len(files):
+                self.inputs._outputs[key] = copied if copied else traits.Undefined
+        try:
+            outputs = super(PipelineDataSink, self)._list_outputs()
+        finally:
+            self.inputs._outputs.clear()
+            self.inputs._outputs.update(inputs)
+        outputs["out_file"] = [gzip_nifti(f, self.inputs.compress_level) if f.endswith(".nii") and os.path.isfile(f)
+                               else f for f in outputs["out_file"]] + current
+        return outputs
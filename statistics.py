@@ -1,38 +1,68 @@
-import nibabel as nib
 import numpy as np
 import pandas as pd
 from datetime import datetime
 import itertools
-from sklearn import metrics
-import matplotlib.pyplot as plt
 import glob
+import os
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+import input_cache
+from custom_nodes import strip_name
+# nibabel, sklearn, scipy, matplotlib and the VOI results store are imported where they are used, so the functions
+# (i.e. in worker processes) and the analysis start without loading them
 
 #### DEFINITIONS ####
 run_name = "run01"
 directory = "C:/Users/..." + "/" + run_name
 patient_list = ["PEG0005","PEG0006"]
-#Statistics included in this analysis.This variable is used for generating column names for df (together with mask_list)
-stats= ["_median"]
+#Statistics included in this analysis. This variable is used for generating column names for df
+#Percentiles are given as "_p<percentile>", e.g. "_p25". "_median" and "_mean" are needed for the analysis below
+stats= ["_median", "_mean"]
 # If set to False, confusion matrices and ROC curve include mean and median.
 graphics_median_only = True
-# If load_csv = True, perfusion MTT data is extracted from .csv to df. This only has to be done once.
-load_csv = True
+# Parsed simulation tables and extracted perfusion data are cached in this folder of directory (see input_cache.py)
+# Simulation tables are parsed again if their .csv changed, patients are extracted again if their nifti files changed
+cache_folder = "statistics_cache"
+# If set to True, the cache compares file contents (hashes) instead of modification times
+cache_hash_content = False
+# Number of processes used to extract the perfusion data of the patients in parallel
+n_workers = 4
 save_results = False
 save_as= "statistics"
+# Number of bootstrap resamples of the patients for confidence intervals of AUC, sensitivity, specificity, G-mean and
+# optimal threshold; 0 disables the bootstrap. Resamples are split among bootstrap_workers processes
+n_bootstrap = 10000
+bootstrap_workers = 1
+# Confidence level of the intervals is 1 - ci_alpha
+ci_alpha = 0.05
 
 #### DATA ####
-#Specify which data should be used for analysis corresponding to folder name from nipype pipeline
-file_folder = "25_DSC_parametric_MTT_reor_coreg_gm_VOI"
-file = "DSC_pgui_parametric_MTT_reor_coreg.nii.gz"
-
-#Load simulated perfusion from .csv
+#Specify which data should be used for analysis corresponding to folder names from nipype pipeline
+#Coregistered perfusion maps and triple masks (DSC, GM, VOI) are read from these folders
+maps_folder = "14_DSC_parametermaps_reor_coreg"
+masks_folder = "19_Triple_mask_DSC_GM_VOI"
+#Label volume of the triple masks (bit i = territory i) and the territory names in bit order
+labels_file = "triple_mask_labels.nii.gz"
+labels_names = "triple_mask_labels.json"
+#Perfusion map used for this analysis
+perfusion_map = "DSC_pgui_parametric_MTT"
+#Table with the statistics of all perfusion maps and territories, columns are named <map>_<territory>_<stat>
+perfusion_csv = "perfusion_stats.csv"
+#If set, perfusion data is read from the VOI results store of the nipype pipeline instead of the nifti files,
+#i.e. <results_dir>/<workflow_name>_results/45_Results_VOI_avg/voi_results
+#Only the statistics mean and median (stats) are available in the store; like the nifti extraction, the statistics
+#mean_nonzero and median_nonzero of the store that exclude voxels with value 0 are read
+voi_results_dir = None
+#If set, perfusion data is computed from the histograms of the nipype pipeline instead of the nifti files,
+#i.e. <results_dir>/<workflow_name>_results/45_Results_VOI_avg/voi_histograms
+#All statistics of stats are available (percentiles within one histogram bin); voxels with value 0 are excluded
+histograms_dir = None
+
+#Simulated perfusion is loaded from .csv
+sim_directory = "C:/Users/..."
 bp="MAP70_MCAonly"
 #bp= ["MAP60", "MAP70", "MAP80", "MAP93"]
-sim = pd.read_csv("C:/Users/.../"+bp+".csv", delimiter=";", index_col=0)
-
-#Appends SoS (side of stenosis) data to the sim DataFrame ONLY if indices match. Left = 0, Right = 1
-sos= pd.read_csv("C:/Users/.../Side_of_stenosis.csv", delimiter=";", index_col=0)
-sim['Stenosis_L0_R1'] = sos["Stenosis_L0_R1"].values
 
 #### THRESHOLDS FOR SIMULATION AND PERFUSION ####
 # Set relMTT threshold to denote areas vulnerable to subsequent stroke;
@@ -46,10 +76,49 @@ relMTT_thr = 1.387
 # Rev 1959;39(2):183–238.
 sim_thr = 50
 
+# If threshold_sweep = True, the confusion matrix is evaluated for all pairs of relMTT and simulation thresholds
+# of the grids below (robustness of relMTT_thr and sim_thr)
+threshold_sweep = False
+relMTT_grid = np.round(np.arange(1.0, 2.0001, 0.01), 3)
+sim_grid = np.arange(30, 80.01, 0.5)
+
+#### BATCH EVALUATION ####
+# If batch = True, all combinations of blood pressure scenarios, territories, statistics and perfusion maps are
+# evaluated (confusion matrix and ROC) using batch_workers processes and written to one table
+# <save_as>_<date>_batch.csv in directory. Inputs are loaded once
+batch = False
+batch_bp = ["MAP60", "MAP70", "MAP80", "MAP93"]
+batch_territories = ["ACA", "MCA", "PCA", "hemi"]
+batch_stats = ["_median", "_mean"]
+#Perfusion maps of the batch, None = all maps of the perfusion data
+batch_maps = None
+batch_workers = 4
+#Simulated perfusion pressure of a territory is the minimum of these columns of the simulation .csv ({side}: R or L)
+#Only the MCA columns are used in the analysis below, the others have to be adapted to the simulation files
+sim_territories = {"ACA": ["A2 {side}"],
+                   "MCA": ["M2 sup {side}", "M2 inf {side}"],
+                   "PCA": ["P2 {side}"],
+                   "hemi": ["A2 {side}", "M2 sup {side}", "M2 inf {side}", "P2 {side}"]}
+#Thresholds of the relative values (ipsi/contra) per perfusion parameter (last part of the map name, i.e.
+#DSC_pgui_oSVD_MTT -> MTT). Only relMTT_thr is validated (see above); maps of parameters without a threshold are
+#skipped by the batch evaluation
+batch_thresholds = {"MTT": relMTT_thr}
+#Maps with reduced values in delayed perfusion (i.e. CBF), vulnerable if ipsi/contra <= their threshold of
+#batch_thresholds; their relative values are inverted in the AUC comparison
+reduced_maps = ["CBF"]
+
+#### AUC COMPARISON ####
+# The AUCs of the relative values (ipsi/contra) of these perfusion maps in the MCA territory (mean and median) are
+# compared pairwise with the DeLong test; y_true = simulated vulnerability. Maps missing in the perfusion data are
+# skipped, an empty list disables the comparison. With batch = True all maps are compared per scenario and territory
+delong_maps = ["DSC_pgui_parametric_MTT", "DSC_pgui_oSVD_MTT", "DSC_pgui_sSVD_MTT"]
+
 #### FUNCTIONS ####
+# All thresholds are kept (drop_intermediate=False): the optimal threshold of opt_thr may lie between collinear points
+# of the ROC curve, and the bootstrap (batched_metrics) scans every threshold as well, so both report the same one
 def do_the_ROC (perf_vuln, sim_vuln):
     from sklearn import metrics
-    fpr, tpr, thresholds = metrics.roc_curve(y_true=perf_vuln, y_score=sim_vuln, pos_label=True)
+    fpr, tpr, thresholds = metrics.roc_curve(y_true=perf_vuln, y_score=sim_vuln, pos_label=True, drop_intermediate=False)
     roc_auc = metrics.auc(fpr,tpr)
     return fpr, tpr, thresholds, roc_auc
 
@@ -88,134 +157,594 @@ def opt_thr (roc, name):
     print('Sensitivity/TPR: \t {} \nSpecificity/1-FPR: \t {}'.format(fprOpt, tprOpt))
     return thresholdOpt, gmeanOpt, sensOpt, specOpt
 
+#### BOOTSTRAP ####
+# The metrics are computed for all resamples at once: every row of an index matrix (resamples x patients) is one
+# resample of the patients. Definitions as in the analysis below:
+# AUC, optimal threshold and its G-mean as do_the_ROC/opt_thr with y_true = not perfusion-vulnerable and
+# y_score = simulated perfusion pressure; sens, spec and G-mean as create_confusion_matrix with y_true = perfusion
+# vulnerability and y_pred = simulated vulnerability (positive = vulnerable)
+bootstrap_metrics = ["auc", "sens", "spec", "gmean", "opt_threshold", "opt_gmean"]
+
+# Function computes the metrics of the resamples given by idx (resamples x patients); returns (resamples x metrics)
+def batched_metrics(perf_vuln, sim_vuln, sim_score, idx):
+    from scipy import stats as scipy_stats
+    perf = perf_vuln[idx]
+    pred = sim_vuln[idx]
+    score = sim_score[idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Rank-based AUC (Mann-Whitney U), ties get the average rank
+        pos = ~perf
+        n_pos = pos.sum(axis=1)
+        n_vuln = perf.sum(axis=1)
+        ranks = scipy_stats.rankdata(score, axis=1)
+        auc = ((ranks * pos).sum(axis=1) - n_pos * (n_pos + 1) / 2.0) / (n_pos * n_vuln)
+
+        # Confusion matrix of the simulated vulnerability
+        tp = (perf & pred).sum(axis=1)
+        tn = (~perf & ~pred).sum(axis=1)
+        sens = tp / n_vuln
+        spec = tn / n_pos
+        gmean = np.sqrt(sens * spec)
+
+        # ROC of every resample from the scores sorted in descending order; only the last position of tied scores is a
+        # threshold. The first threshold with the highest G-mean is optimal (as np.argmax in opt_thr, which also uses
+        # all thresholds, see do_the_ROC)
+        order = np.argsort(-score, axis=1, kind="stable")
+        sorted_score = np.take_along_axis(score, order, axis=1)
+        sorted_pos = np.take_along_axis(pos, order, axis=1)
+        tpr = np.cumsum(sorted_pos, axis=1) / n_pos[:, np.newaxis]
+        fpr = np.cumsum(~sorted_pos, axis=1) / n_vuln[:, np.newaxis]
+        roc_gmean = np.sqrt(tpr * (1 - fpr))
+        last_of_ties = np.ones(score.shape, dtype=bool)
+        last_of_ties[:, :-1] = sorted_score[:, :-1] != sorted_score[:, 1:]
+        roc_gmean = np.where(last_of_ties & np.isfinite(roc_gmean), roc_gmean, -1.0)
+        best = np.argmax(roc_gmean, axis=1)
+        rows = np.arange(len(idx))
+        opt_gmean = np.where(roc_gmean[rows, best] >= 0, roc_gmean[rows, best], np.nan)
+        opt_threshold = np.where(np.isfinite(opt_gmean), sorted_score[rows, best], np.nan)
+    return np.column_stack([auc, sens, spec, gmean, opt_threshold, opt_gmean])
+
+# Function for worker processes: metrics of resamples drawn from a seed
+def _bootstrap_chunk(perf_vuln, sim_vuln, sim_score, n_resamples, seed):
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(perf_vuln), size=(n_resamples, len(perf_vuln)))
+    return batched_metrics(perf_vuln, sim_vuln, sim_score, idx)
+
+# Function returns percentile and BCa (bias-corrected and accelerated) bootstrap intervals of the metrics
+# perf_vuln, sim_vuln: boolean vulnerabilities (i.e. df['_MCA_median_vuln'], sim['MCA_vuln']),
+# sim_score: simulated perfusion pressure (i.e. sim['M2_ipsi']). The acceleration of BCa is estimated by the jackknife
+# (all leave-one-out samples in one batch). Resamples without vulnerable or without non-vulnerable patients are NaN
+# and left out of the intervals
+def bootstrap_ci(perf_vuln, sim_vuln, sim_score, n_boot=10000, alpha=0.05, seed=0, n_workers=1, chunk_size=1000):
+    from scipy import stats as scipy_stats
+    perf_vuln = np.asarray(perf_vuln, dtype=bool)
+    sim_vuln = np.asarray(sim_vuln, dtype=bool)
+    sim_score = np.asarray(sim_score, dtype=float)
+    n = len(perf_vuln)
+    estimate = batched_metrics(perf_vuln, sim_vuln, sim_score, np.arange(n)[np.newaxis, :])[0]
+
+    chunks = [min(chunk_size, n_boot - start) for start in range(0, n_boot, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [itertools.repeat(perf_vuln), itertools.repeat(sim_vuln), itertools.repeat(sim_score), chunks, seeds]
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            boot = np.vstack(list(pool.map(_bootstrap_chunk, *args)))
+    else:
+        boot = np.vstack(list(map(_bootstrap_chunk, *args)))
+
+    # jackknife: row i leaves out patient i
+    jack_idx = np.array([np.delete(np.arange(n), i) for i in range(n)])
+    jack = batched_metrics(perf_vuln, sim_vuln, sim_score, jack_idx)
+
+    z_alpha = scipy_stats.norm.ppf([alpha / 2, 1 - alpha / 2])
+    rows = []
+    for m, name in enumerate(bootstrap_metrics):
+        values = boot[:, m][np.isfinite(boot[:, m])]
+        row = {"estimate": estimate[m], "n_valid": len(values)}
+        if len(values) == 0 or not np.isfinite(estimate[m]):
+            rows.append(pd.Series(row, name=name))
+            continue
+        row["pct_low"], row["pct_high"] = np.percentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+        # bias correction z0 (ties count half) and acceleration a
+        z0 = scipy_stats.norm.ppf((np.sum(values < estimate[m]) + 0.5 * np.sum(values == estimate[m])) / len(values))
+        jack_values = jack[:, m][np.isfinite(jack[:, m])]
+        diff = jack_values.mean() - jack_values
+        denominator = 6 * np.sum(diff ** 2) ** 1.5
+        a = np.sum(diff ** 3) / denominator if denominator > 0 else 0.0
+        if np.isfinite(z0):
+            levels = scipy_stats.norm.cdf(z0 + (z0 + z_alpha) / (1 - a * (z0 + z_alpha)))
+            row["bca_low"], row["bca_high"] = np.percentile(values, 100 * levels)
+        rows.append(pd.Series(row, name=name))
+    columns = ["estimate", "pct_low", "pct_high", "bca_low", "bca_high", "n_valid"]
+    return pd.DataFrame(rows).reindex(columns=columns).astype({"n_valid": int})
+
+#### THRESHOLD SWEEP ####
+# Function evaluates the confusion matrix of perfusion vulnerability (relMTT >= relMTT threshold) and simulated
+# vulnerability (pressure < simulation threshold) for all pairs of thresholds in one pass. Patients are sorted by
+# relMTT, so the perfusion-vulnerable patients of every relMTT threshold are the first k patients (searchsorted);
+# a cumulative count over patients and simulation thresholds gives tp of all pairs. NaN values are never vulnerable.
+# Returns one row per pair with the columns of create_confusion_matrix
+def sweep_thresholds(rel, pressure, rel_thresholds, sim_thresholds):
+    rel = np.asarray(rel, dtype=float)
+    pressure = np.asarray(pressure, dtype=float)
+    rel_thresholds = np.sort(np.asarray(rel_thresholds, dtype=float))
+    sim_thresholds = np.sort(np.asarray(sim_thresholds, dtype=float))
+    n = len(rel)
+
+    order = np.argsort(-np.where(np.isnan(rel), -np.inf, rel), kind="stable")
+    rel_sorted = np.sort(np.where(np.isnan(rel), -np.inf, rel))
+    # number of perfusion-vulnerable patients of every relMTT threshold
+    k = n - np.searchsorted(rel_sorted, rel_thresholds, side="left")
+
+    # patient i is simulated vulnerable from the first simulation threshold above its pressure on
+    first = np.searchsorted(sim_thresholds, np.where(np.isnan(pressure), np.inf, pressure)[order], side="right")
+    counts = np.zeros((n + 1, len(sim_thresholds) + 1), dtype=np.int64)
+    counts[np.arange(1, n + 1), first] = 1
+    counts = np.cumsum(np.cumsum(counts, axis=1), axis=0)[:, :-1]
+
+    tp = counts[k]
+    fp = counts[n][np.newaxis, :] - tp
+    fn = k[:, np.newaxis] - tp
+    tn = n - tp - fp - fn
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sens = tp / (tp + fn)
+        spec = tn / (tn + fp)
+        surface = {"tn": tn, "fp": fp, "fn": fn, "tp": tp, "accuracy": (tn + tp) / n, "sens": sens, "spec": spec,
+                   "gmean": np.sqrt(sens * spec), "f1-score": 2 * tp / (2 * tp + fp + fn)}
+    grid = pd.MultiIndex.from_product([rel_thresholds, sim_thresholds], names=["relMTT_thr", "sim_thr"])
+    return pd.DataFrame({name: values.reshape(-1) for name, values in surface.items()}, index=grid)
+
+# Function returns the Pareto-optimal pairs of a sweep: no other pair has higher sensitivity and specificity
+# (one of them strictly higher). Pairs with the same sensitivity and specificity are all kept
+def pareto_pairs(sweep):
+    valid = sweep.dropna(subset=["sens", "spec"])
+    best = valid.groupby("sens")["spec"].max().sort_index(ascending=False)
+    # highest specificity among the pairs with a strictly higher sensitivity
+    best_above = best.cummax().shift(1, fill_value=-np.inf)
+    front = best[best > best_above]
+    keep = valid["spec"].to_numpy() == valid["sens"].map(front).to_numpy()
+    return valid[keep].sort_values(["sens", "spec"], ascending=[False, True])
+
+#### BATCH ####
+# Function loads the simulated perfusion pressures of one blood pressure scenario with the side of stenosis
+# Index names are set equal to those of the perfusion data (PEG_005 -> PEG0005)
+# Also computes the lower pressure of M2 sup and M2 inf per side and on the side of the stenosis (M2_ipsi)
+def load_simulation(bp):
+    sim = pd.read_csv(sim_directory + "/" + bp + ".csv", delimiter=";", index_col=0)
+    #Appends SoS (side of stenosis) data to the sim DataFrame ONLY if indices match. Left = 0, Right = 1
+    sos = pd.read_csv(sim_directory + "/" + "Side_of_stenosis.csv", delimiter=";", index_col=0)
+    sim['Stenosis_L0_R1'] = sos["Stenosis_L0_R1"].values
+    sim.index = sim.index.str.replace('_','0')
+
+    #Only take lower perfusion pressure of either M2 sup or M2 inf into consideration
+    sim['M2 R min'] = sim[['M2 sup R','M2 inf R']].min(axis=1)
+    sim['M2 L min'] = sim[['M2 sup L', 'M2 inf L']].min(axis=1)
+    # Account for side of stenosis
+    sim['M2_ipsi'] = np.where(sim['Stenosis_L0_R1'] == 0, sim['M2 L min'].values, sim['M2 R min'].values)
+    return sim
+
+# Function returns the simulation table of load_simulation from the cache in directory; it is parsed again if the
+# simulation .csv or Side_of_stenosis.csv changed
+def cached_simulation(bp, cache_dir):
+    sources = [sim_directory + "/" + bp + ".csv", sim_directory + "/" + "Side_of_stenosis.csv"]
+    return input_cache.cached(cache_dir, "simulation_" + bp, sources, lambda: load_simulation(bp),
+                              hash_content=cache_hash_content)
+
+# Function returns the simulated perfusion pressure of a territory on the side of the stenosis (see sim_territories)
+def ipsi_pressure(sim, territory):
+    right = sim[[column.format(side="R") for column in sim_territories[territory]]].min(axis=1)
+    left = sim[[column.format(side="L") for column in sim_territories[territory]]].min(axis=1)
+    return pd.Series(np.where(sim['Stenosis_L0_R1'] == 0, left.values, right.values), index=sim.index)
+
+# Function returns the perfusion maps of a table with columns <map>_<territory>_<side><stat>
+def perfusion_maps(df_all):
+    return sorted({match.group(1) for match in map(re.compile(r"^(.+)_[^_]+_(?:ipsi|contra)_[^_]+$").match,
+                                                   df_all.columns) if match})
+
+# Function evaluates one combination: perf_vuln (boolean) and sim_score (simulated pressure) as arrays
+# Returns the statistics of create_confusion_matrix (simulated vulnerability: sim_score < sim_thr) and of
+# do_the_ROC/opt_thr; ROC statistics are NaN if all patients belong to one class. Patients without a simulated
+# pressure (NaN) are not simulated vulnerable and are left out of the ROC
+def evaluate_combination(perf_vuln, sim_score, sim_thr):
+    from sklearn import metrics
+    sim_vuln = sim_score < sim_thr
+    tn, fp, fn, tp = metrics.confusion_matrix(perf_vuln, sim_vuln, labels=[False, True]).ravel()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sens = np.float64(tp) / (tp + fn)
+        spec = np.float64(tn) / (tn + fp)
+        row = {'tn': tn, 'fp': fp, 'fn': fn, 'tp': tp, 'accuracy': (tn + tp) / len(perf_vuln), 'sens': sens,
+               'spec': spec, 'gmean': np.sqrt(sens * spec), 'f1-score': np.float64(2 * tp) / (2 * tp + fp + fn),
+               'auc': np.nan, 'opt_threshold': np.nan, 'opt_gmean': np.nan, 'opt_sens': np.nan, 'opt_spec': np.nan}
+    scored = ~np.isnan(sim_score)
+    if 0 < perf_vuln[scored].sum() < scored.sum():
+        fpr, tpr, thresholds, roc_auc = do_the_ROC(~perf_vuln[scored], sim_score[scored])
+        gmean = np.sqrt(tpr * (1 - fpr))
+        index = np.argmax(gmean)
+        row.update({'auc': roc_auc, 'opt_threshold': thresholds[index], 'opt_gmean': gmean[index],
+                    'opt_sens': tpr[index], 'opt_spec': 1 - fpr[index]})
+    return row
+
+def _evaluate_task(task):
+    return evaluate_combination(*task)
+
+# Function evaluates all combinations of blood pressure scenarios, territories, statistics and perfusion maps
+# df_all: perfusion data of all maps, sims: {bp: simulation DataFrame of load_simulation}
+# thresholds: {parameter: threshold} (default batch_thresholds), maps of parameters without a threshold are skipped
+# Perfusion vulnerability: ipsi/contra >= threshold (<= threshold for reduced_maps), missing values are not
+# vulnerable. Returns one row per combination
+def batch_evaluation(df_all, sims, territories, stats, maps=None, n_workers=1, thresholds=None):
+    maps = perfusion_maps(df_all) if maps is None else maps
+    thresholds = batch_thresholds if thresholds is None else thresholds
+    skipped = [map_name for map_name in maps if map_name.split("_")[-1] not in thresholds]
+    if skipped:
+        print("No relative threshold for", ", ".join(skipped), "- skipped")
+    maps = [map_name for map_name in maps if map_name not in skipped]
+    keys, tasks = [], []
+    for bp_name, sim in sims.items():
+        for territory in territories:
+            if not all(column.format(side=side) in sim.columns
+                       for column in sim_territories[territory] for side in ("R", "L")):
+                print("Simulation", bp_name, "has no columns for", territory, "- skipped")
+                continue
+            #patients are matched by their IDs, patients missing in the simulation have no pressure (never vulnerable)
+            pressure = ipsi_pressure(sim, territory).reindex(df_all.index).to_numpy(dtype=float)
+            for stat, map_name in itertools.product(stats, maps):
+                column = map_name + "_" + territory + "_{}" + stat
+                if column.format("ipsi") not in df_all.columns:
+                    continue
+                rel = (df_all[column.format("ipsi")] / df_all[column.format("contra")]).to_numpy(dtype=float)
+                threshold = thresholds[map_name.split("_")[-1]]
+                if any(name in map_name for name in reduced_maps):
+                    perf_vuln = rel <= threshold
+                else:
+                    perf_vuln = rel >= threshold
+                keys.append((bp_name, territory, stat[1:], map_name))
+                tasks.append((perf_vuln, pressure, sim_thr))
+
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            rows = list(pool.map(_evaluate_task, tasks, chunksize=max(1, len(tasks) // (4 * n_workers))))
+    else:
+        rows = [_evaluate_task(task) for task in tasks]
+    index = pd.MultiIndex.from_tuples(keys, names=['bp', 'territory', 'stat', 'map'])
+    return pd.DataFrame(rows, index=index).reset_index()
+
+#### DELONG ####
+# Fast DeLong test (Sun X, Xu W. Fast implementation of DeLong's algorithm for comparing the areas under correlated
+# receiver operating characteristic curves. IEEE Signal Process Lett 2014;21(11):1389–93)
+# y_true: boolean (positive = True), scores: DataFrame with one column per score (higher = more likely positive)
+# All score columns are ranked at once (midranks, O(n log n)); the covariance of the AUCs gives the standard errors
+# and two-sided p-values of all pairwise differences. Patients with a missing score are excluded from all columns
+# Returns the AUCs and the matrices of differences (row - column), standard errors and p-values
+def delong_test(y_true, scores):
+    from scipy import stats as scipy_stats
+    scores = pd.DataFrame(scores)
+    valid = scores.notna().all(axis=1).to_numpy()
+    y_true = np.asarray(y_true, dtype=bool)[valid]
+    values = scores.to_numpy(dtype=float)[valid].T
+    positives, negatives = values[:, y_true], values[:, ~y_true]
+    m, n = positives.shape[1], negatives.shape[1]
+    names = scores.columns
+    if m == 0 or n == 0:
+        nan = pd.DataFrame(np.nan, index=names, columns=names)
+        return pd.Series(np.nan, index=names), nan, nan.copy(), nan.copy()
+
+    ranks = scipy_stats.rankdata(np.concatenate([positives, negatives], axis=1), axis=1)
+    ranks_pos = scipy_stats.rankdata(positives, axis=1)
+    ranks_neg = scipy_stats.rankdata(negatives, axis=1)
+    auc = ranks[:, :m].sum(axis=1) / (m * n) - (m + 1.0) / (2.0 * n)
+    # structural components of the positives and negatives
+    v10 = (ranks[:, :m] - ranks_pos) / n
+    v01 = 1.0 - (ranks[:, m:] - ranks_neg) / m
+    cov = np.atleast_2d(np.cov(v10, ddof=1)) / m + np.atleast_2d(np.cov(v01, ddof=1)) / n
+
+    variance = np.diag(cov)[:, np.newaxis] + np.diag(cov)[np.newaxis, :] - 2 * cov
+    diff = auc[:, np.newaxis] - auc[np.newaxis, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se = np.sqrt(np.maximum(variance, 0))
+        p = 2 * scipy_stats.norm.sf(np.abs(diff) / se)
+    # identical scores (i.e. the diagonal) have no difference
+    p = np.where(se > 0, p, 1.0)
+    return (pd.Series(auc, index=names), pd.DataFrame(diff, index=names, columns=names),
+            pd.DataFrame(se, index=names, columns=names), pd.DataFrame(p, index=names, columns=names))
+
+# Function returns the relative values (ipsi/contra) of the given maps and statistics in one territory as scores of
+# delong_test (columns <map><stat>); reduced_maps are inverted, so higher values are more vulnerable for all maps
+def relative_scores(df_all, maps, territory, stats):
+    scores = {}
+    for map_name, stat in itertools.product(maps, stats):
+        column = map_name + "_" + territory + "_{}" + stat
+        if column.format("ipsi") not in df_all.columns:
+            continue
+        rel = df_all[column.format("ipsi")] / df_all[column.format("contra")]
+        scores[map_name + stat] = 1 / rel if any(name in map_name for name in reduced_maps) else rel
+    return pd.DataFrame(scores, index=df_all.index)
+
+# Function compares all maps and statistics per blood pressure scenario and territory (see batch_evaluation)
+# Returns one row per pair of scores with their AUCs, the difference, its standard error and p-value
+def batch_delong(df_all, sims, territories, stats, maps=None):
+    maps = perfusion_maps(df_all) if maps is None else maps
+    tables = []
+    for bp_name, sim in sims.items():
+        for territory in territories:
+            if not all(column.format(side=side) in sim.columns
+                       for column in sim_territories[territory] for side in ("R", "L")):
+                continue
+            sim_vuln = ipsi_pressure(sim, territory).reindex(df_all.index) < sim_thr
+            scores = relative_scores(df_all, maps, territory, stats)
+            if scores.shape[1] < 2:
+                continue
+            auc, diff, se, p = delong_test(sim_vuln, scores)
+            pairs = np.triu_indices(len(auc), k=1)
+            tables.append(pd.DataFrame({'bp': bp_name, 'territory': territory,
+                                        'score_a': auc.index[pairs[0]], 'score_b': auc.index[pairs[1]],
+                                        'auc_a': auc.to_numpy()[pairs[0]], 'auc_b': auc.to_numpy()[pairs[1]],
+                                        'diff': diff.to_numpy()[pairs], 'se': se.to_numpy()[pairs],
+                                        'p': p.to_numpy()[pairs]}))
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+# Function takes a patient ID and extracts the statistics (see stats) of all perfusion maps in all territories
+# Each perfusion map and each mask is read only once. Only non-zero values of a perfusion map inside a mask are used
+# Returns a pd.Series with index <map>_<territory><stat>, i.e. DSC_pgui_parametric_MTT_MCA_ipsi_median
+def extract_patient(patient, directory, stats):
+    import nibabel as nib
+    with open(os.path.join(directory, masks_folder, patient, labels_names)) as f:
+        territories = json.load(f)["territories"]
+    labels = np.asanyarray(nib.load(os.path.join(directory, masks_folder, patient, labels_file)).dataobj)
+    labels = labels.astype(np.uint8, copy=False).reshape(-1)
+    masks = {territory: np.flatnonzero(labels & (1 << bit)) for bit, territory in enumerate(territories)}
+
+    #mean is computed separately, all percentiles (median = 50th percentile) in one call per territory
+    percentiles = [50.0 if stat == "_median" else float(stat[2:]) for stat in stats if stat != "_mean"]
+    values = {}
+    for path in sorted(glob.glob(os.path.join(directory, maps_folder, patient, "**", "*.nii*"), recursive=True)):
+        #i.e. DSC_pgui_parametric_MTT_reor_coreg.nii.gz and DSC_pgui_parametric_MTT_coreg.nii.gz (without
+        #reorientation) -> DSC_pgui_parametric_MTT
+        map_name = strip_name(path)
+        data = np.asanyarray(nib.load(path).dataobj, dtype=np.float32).reshape(-1)
+        for territory, index in masks.items():
+            voxels = data[index]
+            voxels = voxels[voxels != 0]
+            column = map_name + "_" + territory
+            if voxels.size == 0:
+                values.update({column + stat: np.nan for stat in stats})
+                continue
+            results = iter(np.percentile(voxels, percentiles)) if percentiles else iter(())
+            for stat in stats:
+                values[column + stat] = voxels.mean(dtype=np.float64) if stat == "_mean" else next(results)
+    print("Extracted perfusion data of", patient)
+    return pd.Series(values, name=patient, dtype=float)
+
+# Function returns the files (perfusion maps, label volume and territory names) a patient is extracted from
+def patient_files(patient, directory):
+    return [f for folder in (maps_folder, masks_folder)
+            for f in glob.glob(os.path.join(directory, folder, patient, "**", "*"), recursive=True) if os.path.isfile(f)]
+
+# Function extracts the perfusion data of all patients using n_workers processes and saves it to one .csv
+# The rows of the patients are cached with a fingerprint of their files (cache_dir, default <directory>/cache_folder)
+# and only extracted again if their files changed or other statistics are requested
+# Patients without files keep their cached rows, patients without files and cached rows get an empty row
+def extract_cohort(patients, directory, stats, n_workers=1, cache_dir=None):
+    cache_dir = cache_dir or os.path.join(directory, cache_folder)
+    key = "".join(stats)
+    rows = input_cache.load_entry(cache_dir, "perfusion", key) or {}
+    fingerprints = {}
+    missing = []
+    for patient in patients:
+        files = patient_files(patient, directory)
+        if files:
+            fingerprints[patient] = input_cache.fingerprint(files, cache_hash_content)
+        elif patient in rows:
+            print("No files of", patient, "found, cached perfusion data is used")
+        else:
+            print("No files of", patient, "found in", os.path.join(directory, maps_folder), "and",
+                  os.path.join(directory, masks_folder), "- skipped")
+            missing.append(patient)
+    todo = [patient for patient in fingerprints if patient not in rows or rows[patient][0] != fingerprints[patient]]
+
+    if todo:
+        if n_workers > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                extracted = list(pool.map(extract_patient, todo, itertools.repeat(directory), itertools.repeat(stats)))
+        else:
+            extracted = [extract_patient(patient, directory, stats) for patient in todo]
+        rows.update({patient: (fingerprints[patient], row) for patient, row in zip(todo, extracted)})
+        input_cache.store_entry(cache_dir, "perfusion", key, rows)
+    df = pd.DataFrame([pd.Series(name=patient, dtype=float) if patient in missing else rows[patient][1]
+                       for patient in patients])
+    df.to_csv(os.path.join(directory, perfusion_csv))
+    return df
+
+# Function reads the statistics (see stats) of the given perfusion maps (None = all maps of the store) and patients
+# from the VOI results store. Only the needed rows and columns are read; columns are named like the ones of
+# extract_cohort. The _nonzero statistics of the store are read, they exclude voxels with value 0 (see voi_statistics
+# of custom_nodes.py) like extract_patient and read_sketch_table, so all three sources give the same table
+def read_voi_results_table(store_dir, patients, stats, maps=None):
+    from voi_results import read_voi_results, to_wide
+    filters = [("subject", "in", list(patients)), ("statistic", "in", [stat[1:] + "_nonzero" for stat in stats])]
+    if maps is not None:
+        filters.append(("map", "in", list(maps)))
+    table = read_voi_results(store_dir, columns=["subject", "map", "territory", "side", "statistic", "value"],
+                             filters=filters)
+    table["statistic"] = table["statistic"].astype(str).str[:-len("_nonzero")]
+    return to_wide(table).reindex(list(patients))
+
+
+#Perfusion DataFrame of the given perfusion maps (None = all maps) from the histogram store (see voi_histograms.py),
+#zeros are excluded as in extract_patient
+def read_sketch_table(store_dir, patients, stats, maps=None):
+    from voi_histograms import sketch_table
+    from voi_results import from_long_rows, to_wide
+    rows = sketch_table(store_dir, patients, [stat[1:] for stat in stats], include_zeros=False)
+    if maps is not None:
+        rows = rows[rows["map"].isin(list(maps))]
+    return to_wide(from_long_rows(rows)).reindex(list(patients))
+
+
+#### MAIN ####
+# The analysis only runs if this file is executed as a script, so that worker processes can import the functions
+if __name__ == "__main__":
+    from sklearn import metrics
+    import matplotlib.pyplot as plt
 
-#### Fill Perfusion DataFrame df ####
-    #Loops to fill df with statistics data from the given nifti files
-if (load_csv==True):
-    df = pd.read_csv(directory + "/" + "mtt_mca.csv", na_values='--', delimiter=",", index_col=0)
-    df = df.astype(float)
-else:
-    mask_list = ["_MCA_ipsi", "_MCA_contra"]
-    columns = list(''.join(e) for e in itertools.product(mask_list, stats))
-    df = pd.DataFrame(index=patient_list, columns=columns)
-
-    #Use masking to only consider non-zero values of Nifti images
-    for patient in patient_list:
-        for mask in mask_list:
-            path = directory + "/" + file_folder + "/" + patient + "/" + mask + "/" + file
-            img = nib.load(path)
-            img_data = img.get_fdata()
-            m = np.ma.masked_equal(img_data, 0)
-            median_value = np.ma.median(m)
-            mean_value = np.ma.mean(m)
-            df.loc[patient, mask + stats[0]] = median_value
-            df.loc[patient, mask + stats[1]] = mean_value
-            print(df)
-
-    # Check if file with same name exists already. If not, save to .csv
-        file_name = "mtt_mca.csv"
-        files_present = glob.glob(file_name)
-        if not files_present: df.to_csv(directory + "/" + file_name)
-
-
-# Set index names of sim equal to those of df
-# Might be prone to ID changes of only df or sim
-sim.index = sim.index.str.replace('_','0')
-
-#### Perfusion vulnerability analysis
-#Create new Column with side-normalized values
-df['_MCA_median_relMTT']=df._MCA_ipsi_median/df._MCA_contra_median
-df['_MCA_mean_relMTT']=df._MCA_ipsi_mean/df._MCA_contra_mean
-
-#Check if relMTT surpasses vulnerability threshold 1.387
-df['_MCA_median_vuln'] = np.where(df._MCA_median_relMTT >= relMTT_thr, True, False)
-df['_MCA_mean_vuln'] = np.where(df._MCA_mean_relMTT >= relMTT_thr, True, False)
-
-
-#### Simulation vulnerability analysis
-#Vulnerability of each region is saved as boolean value in columns 'ACA_vuln', 'MCA_vuln', 'PCA_vuln', 'hemi_vuln'
-
-#Only take lower perfusion pressure of either M2 sup or M2 inf into consideration
-sim['M2 R min'] = sim[['M2 sup R','M2 inf R']].min(axis=1)
-sim['M2 L min'] = sim[['M2 sup L', 'M2 inf L']].min(axis=1)
-
-
-# Account for side of stenosis
-sim['M2_ipsi'] = np.where(sim['Stenosis_L0_R1'] == 0, sim['M2 L min'].values, sim['M2 R min'].values)
-
-# Create columns for simulated vulnerabilities Sim_vuln according to simulation threshold
-sim['MCA_vuln'] = np.where(sim['M2_ipsi'] < sim_thr, True, False)
-
-
-#### Sensitivity and specificity analysis ####
-#Create a results DataFrame to save all statistics
-results = pd.DataFrame(columns=['tn', 'fp', 'fn', 'tp', 'accuracy', 'sens', 'spec', 'gmean', 'f1-score'])
-
-
-if (graphics_median_only == True):
-    cm_MCA_median = create_confusion_matrix(df['_MCA_median_vuln'], sim['MCA_vuln'])
-    results.loc['MCA_median'] = cm_MCA_median[1]
-    print('Summary of Confusion Matrices:\n', results)
-else:
-    cm_MCA_median = create_confusion_matrix(df['_MCA_median_vuln'],sim['MCA_vuln'])
-    results.loc['MCA_median'] = cm_MCA_median[1]
-    cm_MCA_mean = create_confusion_matrix(df['_MCA_mean_vuln'],sim['MCA_vuln'])
-    results.loc['MCA_mean'] = cm_MCA_mean[1]
-    print('Summary of Confusion Matrices:\n', results)
-
-
-#### ROC Analysis
-
-# Set parameters for all ROC plots
-plt.figure(figsize=(5, 5))
-plt.axline((0, 0), slope=1, color="grey", linestyle=(0, (5, 5)))
-plt.ylabel('True Positive Rate')
-plt.xlabel('False Positive Rate')
-plt.rcParams['figure.dpi'] = 300
-plt.rcParams['savefig.dpi'] = 300
-
-if (graphics_median_only == True):
-    roc_MCA_median = do_the_ROC(1 - df['_MCA_median_vuln'], sim['M2_ipsi'])
-    plt.plot(roc_MCA_median[0], roc_MCA_median[1], label="Frey et al. 2021, auc=" + str(roc_MCA_median[3])[0:5])
-    plt.legend(loc=0)
-    disp_roc_MCA_median = metrics.RocCurveDisplay(fpr=roc_MCA_median[0], tpr=roc_MCA_median[1],
-                                                  roc_auc=roc_MCA_median[3], estimator_name='example estimator')
-
-else:
-    roc_MCA_median = do_the_ROC(1-df['_MCA_median_vuln'], sim['M2_ipsi'])
-    roc_MCA_mean = do_the_ROC(1-df['_MCA_mean_vuln'], sim['M2_ipsi'])
-
-    plt.plot(roc_MCA_median[0], roc_MCA_median[1], label="MCA median, auc="+str(roc_MCA_median[3])[0:5])
-    plt.plot(roc_MCA_mean[0], roc_MCA_mean[1], label="MCA mean, auc="+str(roc_MCA_mean[3])[0:5])
-
-    plt.legend(loc=0)
-
-    disp_roc_MCA_median = metrics.RocCurveDisplay(fpr=roc_MCA_median[0], tpr=roc_MCA_median[1], roc_auc=roc_MCA_median[3], estimator_name = 'example estimator')
-    disp_roc_MCA_mean = metrics.RocCurveDisplay(fpr=roc_MCA_mean[0], tpr=roc_MCA_mean[1], roc_auc=roc_MCA_mean[3], estimator_name = 'example estimator')
-
-
-#### Measures for imbalanced data: G-mean, F1-Score ####
-if (graphics_median_only == True):
-    # Calculate the G-mean
-    gmean_MCA_median = np.sqrt(roc_MCA_median[1] * (1 - roc_MCA_median[0]))
-    # Find the optimal threshold
-    gmeanOpt_MCA_median = opt_thr(roc_MCA_median, 'MCA_median')
-
-else:
-    # Calculate the G-mean
-    gmean_MCA_median = np.sqrt(roc_MCA_median[1] * (1 - roc_MCA_median[0]))
-    gmean_MCA_mean = np.sqrt(roc_MCA_mean[1] * (1 - roc_MCA_mean[0]))
-
-    # Find the optimal threshold
-    gmeanOpt_MCA_median = opt_thr(roc_MCA_median, 'MCA_median')
-    gmeanOpt_MCA_mean = opt_thr(roc_MCA_mean, 'MCA_mean')
-
-# Save statistics as .csv file using the current date
-if (save_results==True):
-    date = datetime.now().strftime("_%Y_%m_%d_%I_%M")
-    df.to_csv(directory + "/" + save_as + "_" + date + "_dataframe.csv")
-    sim.to_csv(directory + "/" + save_as + "_" + date + "_simulation.csv")
-    results.to_csv(directory + "/" + save_as + "_" + date + "_results.csv")
-    print("DataFrame", save_as + "_"+ date + ".csv", "created and saved to", directory)
-
-plt.show()
\ No newline at end of file
+    #### Load simulation data ####
+    # Index names of sim are set equal to those of df
+    # Might be prone to ID changes of only df or sim
+    cache_dir = os.path.join(directory, cache_folder)
+    for name in input_cache.prune(cache_dir):
+        print("Removed cache entry", name, "(source files no longer exist)")
+    sim = cached_simulation(bp, cache_dir)
+
+
+    #### Fill Perfusion DataFrame df ####
+        #Perfusion data is read from the VOI results store, computed from the histograms or extracted from the given
+        #nifti files (cached)
+    if voi_results_dir is not None:
+        df_all = read_voi_results_table(voi_results_dir, patient_list, stats)
+    elif histograms_dir is not None:
+        df_all = read_sketch_table(histograms_dir, patient_list, stats)
+    else:
+        df_all = extract_cohort(patient_list, directory, stats, n_workers, cache_dir)
+
+    #### Batch evaluation ####
+    # All blood pressure scenarios, territories, statistics and perfusion maps in one table
+    if (batch == True):
+        sims = {bp_name: cached_simulation(bp_name, cache_dir) for bp_name in batch_bp}
+        batch_results = batch_evaluation(df_all, sims, batch_territories, batch_stats, batch_maps, batch_workers)
+        batch_file = directory + "/" + save_as + "_" + datetime.now().strftime("_%Y_%m_%d_%I_%M") + "_batch.csv"
+        batch_results.to_csv(batch_file, index=False)
+        print("Batch evaluation of", len(batch_results), "combinations saved to", batch_file)
+        batch_comparison = batch_delong(df_all, sims, batch_territories, batch_stats, batch_maps)
+        batch_comparison.to_csv(batch_file[:-len(".csv")] + "_delong.csv", index=False)
+
+    #Only the chosen perfusion map is used, i.e. column DSC_pgui_parametric_MTT_MCA_ipsi_median -> _MCA_ipsi_median
+    columns = [column for column in df_all.columns if column.startswith(perfusion_map + "_")]
+    df = df_all[columns].rename(columns=lambda column: column[len(perfusion_map):])
+
+    #### Perfusion vulnerability analysis
+    #Create new Column with side-normalized values
+    df['_MCA_median_relMTT']=df._MCA_ipsi_median/df._MCA_contra_median
+    df['_MCA_mean_relMTT']=df._MCA_ipsi_mean/df._MCA_contra_mean
+
+    #Check if relMTT surpasses vulnerability threshold 1.387
+    df['_MCA_median_vuln'] = np.where(df._MCA_median_relMTT >= relMTT_thr, True, False)
+    df['_MCA_mean_vuln'] = np.where(df._MCA_mean_relMTT >= relMTT_thr, True, False)
+
+
+    #### Simulation vulnerability analysis
+    #Vulnerability of each region is saved as boolean value in columns 'ACA_vuln', 'MCA_vuln', 'PCA_vuln', 'hemi_vuln'
+
+    #Lower perfusion pressure of M2 sup and M2 inf on the side of the stenosis (M2_ipsi) see load_simulation
+
+    # Create columns for simulated vulnerabilities Sim_vuln according to simulation threshold
+    sim['MCA_vuln'] = np.where(sim['M2_ipsi'] < sim_thr, True, False)
+
+
+    #### Sensitivity and specificity analysis ####
+    #Create a results DataFrame to save all statistics
+    results = pd.DataFrame(columns=['tn', 'fp', 'fn', 'tp', 'accuracy', 'sens', 'spec', 'gmean', 'f1-score'])
+
+
+    if (graphics_median_only == True):
+        cm_MCA_median = create_confusion_matrix(df['_MCA_median_vuln'], sim['MCA_vuln'])
+        results.loc['MCA_median'] = cm_MCA_median[1]
+        print('Summary of Confusion Matrices:\n', results)
+    else:
+        cm_MCA_median = create_confusion_matrix(df['_MCA_median_vuln'],sim['MCA_vuln'])
+        results.loc['MCA_median'] = cm_MCA_median[1]
+        cm_MCA_mean = create_confusion_matrix(df['_MCA_mean_vuln'],sim['MCA_vuln'])
+        results.loc['MCA_mean'] = cm_MCA_mean[1]
+        print('Summary of Confusion Matrices:\n', results)
+
+
+    #### ROC Analysis
+
+    # Set parameters for all ROC plots
+    plt.figure(figsize=(5, 5))
+    plt.axline((0, 0), slope=1, color="grey", linestyle=(0, (5, 5)))
+    plt.ylabel('True Positive Rate')
+    plt.xlabel('False Positive Rate')
+    plt.rcParams['figure.dpi'] = 300
+    plt.rcParams['savefig.dpi'] = 300
+
+    if (graphics_median_only == True):
+        roc_MCA_median = do_the_ROC(1 - df['_MCA_median_vuln'], sim['M2_ipsi'])
+        plt.plot(roc_MCA_median[0], roc_MCA_median[1], label="Frey et al. 2021, auc=" + str(roc_MCA_median[3])[0:5])
+        plt.legend(loc=0)
+        disp_roc_MCA_median = metrics.RocCurveDisplay(fpr=roc_MCA_median[0], tpr=roc_MCA_median[1],
+                                                      roc_auc=roc_MCA_median[3], estimator_name='example estimator')
+
+    else:
+        roc_MCA_median = do_the_ROC(1-df['_MCA_median_vuln'], sim['M2_ipsi'])
+        roc_MCA_mean = do_the_ROC(1-df['_MCA_mean_vuln'], sim['M2_ipsi'])
+
+        plt.plot(roc_MCA_median[0], roc_MCA_median[1], label="MCA median, auc="+str(roc_MCA_median[3])[0:5])
+        plt.plot(roc_MCA_mean[0], roc_MCA_mean[1], label="MCA mean, auc="+str(roc_MCA_mean[3])[0:5])
+
+        plt.legend(loc=0)
+
+        disp_roc_MCA_median = metrics.RocCurveDisplay(fpr=roc_MCA_median[0], tpr=roc_MCA_median[1], roc_auc=roc_MCA_median[3], estimator_name = 'example estimator')
+        disp_roc_MCA_mean = metrics.RocCurveDisplay(fpr=roc_MCA_mean[0], tpr=roc_MCA_mean[1], roc_auc=roc_MCA_mean[3], estimator_name = 'example estimator')
+
+
+    #### Measures for imbalanced data: G-mean, F1-Score ####
+    if (graphics_median_only == True):
+        # Calculate the G-mean
+        gmean_MCA_median = np.sqrt(roc_MCA_median[1] * (1 - roc_MCA_median[0]))
+        # Find the optimal threshold
+        gmeanOpt_MCA_median = opt_thr(roc_MCA_median, 'MCA_median')
+
+    else:
+        # Calculate the G-mean
+        gmean_MCA_median = np.sqrt(roc_MCA_median[1] * (1 - roc_MCA_median[0]))
+        gmean_MCA_mean = np.sqrt(roc_MCA_mean[1] * (1 - roc_MCA_mean[0]))
+
+        # Find the optimal threshold
+        gmeanOpt_MCA_median = opt_thr(roc_MCA_median, 'MCA_median')
+        gmeanOpt_MCA_mean = opt_thr(roc_MCA_mean, 'MCA_mean')
+
+    #### Threshold sweep ####
+    # Surface of the confusion matrix statistics over relMTT and simulation thresholds and its Pareto-optimal pairs
+    if (threshold_sweep == True):
+        sweeps = {'MCA_median': sweep_thresholds(df['_MCA_median_relMTT'], sim['M2_ipsi'], relMTT_grid, sim_grid)}
+        if (graphics_median_only == False):
+            sweeps['MCA_mean'] = sweep_thresholds(df['_MCA_mean_relMTT'], sim['M2_ipsi'], relMTT_grid, sim_grid)
+        for name, sweep in sweeps.items():
+            print('\nPareto-optimal threshold pairs', name, ':\n', pareto_pairs(sweep).round(4))
+            print('Best G-mean', name, ':\n', sweep.loc[sweep['gmean'].idxmax()].round(4))
+
+    #### Bootstrap confidence intervals ####
+    if n_bootstrap > 0:
+        ci = {'MCA_median': bootstrap_ci(df['_MCA_median_vuln'], sim['MCA_vuln'], sim['M2_ipsi'], n_bootstrap, ci_alpha,
+                                         n_workers=bootstrap_workers)}
+        if (graphics_median_only == False):
+            ci['MCA_mean'] = bootstrap_ci(df['_MCA_mean_vuln'], sim['MCA_vuln'], sim['M2_ipsi'], n_bootstrap, ci_alpha,
+                                          n_workers=bootstrap_workers)
+        ci = pd.concat(ci, names=['analysis', 'metric'])
+        print('\nBootstrap confidence intervals (', n_bootstrap, 'resamples,', 100 * (1 - ci_alpha), '%):\n', ci.round(4))
+
+    #### AUC comparison of perfusion maps (DeLong) ####
+    delong_scores = relative_scores(df_all, delong_maps, "MCA", ["_median", "_mean"])
+    if delong_scores.shape[1] > 1:
+        delong = delong_test(sim['MCA_vuln'], delong_scores)
+        print('\nAUC (y_true = simulated vulnerability, y_score = relative value of MCA):\n', delong[0].round(4))
+        print('AUC differences (row - column):\n', delong[1].round(4))
+        print('DeLong p-values:\n', delong[3].round(4))
+
+    # Save statistics as .csv file using the current date
+    if (save_results==True):
+        date = datetime.now().strftime("_%Y_%m_%d_%I_%M")
+        df.to_csv(directory + "/" + save_as + "_" + date + "_dataframe.csv")
+        sim.to_csv(directory + "/" + save_as + "_" + date + "_simulation.csv")
+        results.to_csv(directory + "/" + save_as + "_" + date + "_results.csv")
+        if (threshold_sweep == True):
+            for name, sweep in sweeps.items():
+                sweep.to_csv(directory + "/" + save_as + "_" + date + "_sweep_" + name + ".csv")
+        if delong_scores.shape[1] > 1:
+            pd.concat({'auc': delong[0].to_frame('auc').T, 'diff': delong[1], 'se': delong[2], 'p': delong[3]}).to_csv(
+                directory + "/" + save_as + "_" + date + "_delong.csv")
+        if n_bootstrap > 0:
+            ci.to_csv(directory + "/" + save_as + "_" + date + "_bootstrap_ci.csv")
+        print("DataFrame", save_as + "_"+ date + ".csv", "created and saved to", directory)
+
+    plt.show()
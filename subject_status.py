@@ -0,0 +1,103 @@
+############################## SUBJECT STATUS ##################################
+# Status of every subject of the cohort runs of nipype_pipeline.py, kept in a JSON file in the results directory,
+# and the crash files of failed subjects.
+# A failing node only stops the nodes of its own subject: the other subjects of the run are completed, the crash
+# files of the failed subject are moved to a quarantine folder (one folder per subject) and the subject is marked
+# as failed. "python nipype_pipeline.py resume" runs the failed and incomplete subjects again.
+#
+# Entries of the status file, one per subject:
+#   status     "running" (started, not finished, i.e. the run was killed), "complete" or "failed"
+#   stage      stage of the last run, "preprocess" or "extract"; only subjects complete in "extract" have VOI statistics
+#   attempts   number of runs of the subject since it was last complete
+#   error      last line of the traceback of the first crash file (failed subjects)
+#   crashes    crash files in the quarantine folder (failed subjects)
+#   updated    time of the last change (ISO format)
+
+import datetime
+import glob
+import json
+import os
+import re
+import shutil
+
+
+## STATUS FILE ##
+def read_status(status_file):
+    if not os.path.exists(status_file):
+        return {}
+    with open(status_file) as f:
+        return json.load(f)
+
+
+# the file is replaced in one step, so readers never see a partly written status
+def write_status(status_file, status):
+    os.makedirs(os.path.dirname(status_file) or ".", exist_ok=True)
+    temp = status_file + ".tmp%d" % os.getpid()
+    with open(temp, "w") as f:
+        json.dump(status, f, indent=1, sort_keys=True)
+    os.replace(temp, status_file)
+
+
+def set_status(status, subjects, state, **fields):
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    for subject in subjects:
+        entry = status.setdefault(subject, {"attempts": 0})
+        entry.update(fields, status=state, updated=now)
+        if state == "running":
+            entry["attempts"] = entry.get("attempts", 0) + 1
+        if state != "failed":
+            entry.pop("error", None)
+            entry.pop("crashes", None)
+        if state == "complete":
+            entry["attempts"] = 0
+    return status
+
+
+# subjects that failed, did not finish (i.e. a killed run) or were only pre-processed
+def unfinished_subjects(status):
+    return sorted(subject for subject, entry in status.items()
+                  if entry["status"] != "complete" or entry.get("stage") != "extract")
+
+
+## CRASH FILES ##
+# crash files (text format) of a crash folder by subject; the subject is taken from the working directory of the
+# node, crash files of nodes outside the subject iterables are listed under ""
+def crash_files_by_subject(crash_dir):
+    crashes = {}
+    for path in sorted(glob.glob(os.path.join(crash_dir, "crash-*.txt"))):
+        with open(path, errors="replace") as f:
+            match = re.search(r"^Working directory: .*?_subject_id_([^/\\\n]+)", f.read(), re.MULTILINE)
+        crashes.setdefault(match.group(1) if match else "", []).append(path)
+    return crashes
+
+
+# last line of the traceback of a crash file, i.e. "RuntimeError: Command: bet ..."
+def crash_error(path):
+    with open(path, errors="replace") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return lines[-1] if lines else ""
+
+
+# True if the tracebacks of all crash files match one of the patterns of transient errors (regular expressions);
+# the node inputs written before the traceback are not searched
+def is_transient(crash_files, patterns):
+    if not crash_files or not patterns:
+        return False
+    pattern = re.compile("|".join("(?:%s)" % p for p in patterns))
+    for path in crash_files:
+        with open(path, errors="replace") as f:
+            text = f.read()
+        if not pattern.search(text[text.find("Traceback"):]):
+            return False
+    return True
+
+
+# moves the crash files of a subject to <quarantine_dir>/<subject>; returns the new paths
+def quarantine(crash_files, quarantine_dir, subject):
+    target = os.path.join(quarantine_dir, subject or "_workflow")
+    os.makedirs(target, exist_ok=True)
+    moved = []
+    for path in crash_files:
+        moved.append(os.path.join(target, os.path.basename(path)))
+        shutil.move(path, moved[-1])
+    return moved
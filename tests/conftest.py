@@ -0,0 +1,20 @@
+# The modules of the repository are flat scripts in the repository folder
+import importlib.util
+import os
+import sys
+
+import pytest
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+# statistics.py has the name of a module of the standard library and is loaded from its path
+@pytest.fixture(scope="session")
+def statistics_module():
+    spec = importlib.util.spec_from_file_location("icad_statistics", os.path.join(repository, "statistics.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["icad_statistics"] = module
+    spec.loader.exec_module(module)
+    return module
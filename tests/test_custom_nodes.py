@@ -0,0 +1,356 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from custom_nodes import apply_flirt_matrix, update_manifest
+
+
+def voi_table(directory, value):
+    path = os.path.join(str(directory), "voi_statistics.csv")
+    pd.DataFrame({"map": ["DSC_pgui_parametric_MTT"], "territory": ["MCA_ipsi"], "mean": [value],
+                  "median": [value], "n_voxels": [10]}).to_csv(path, index=False)
+    return path
+
+
+def append_subject(args):
+    table, subject, manifest_file = args
+    update_manifest([table], subject, manifest_file)
+
+
+## MANIFEST ##
+# a process killed while holding the lock does not block later subjects
+def test_update_manifest_after_killed_run(tmp_path):
+    manifest_file = str(tmp_path / "manifest.csv")
+    holder = subprocess.Popen([sys.executable, "-c", "import fcntl, time\n"
+                               "f = open(%r, 'a')\nfcntl.flock(f, fcntl.LOCK_EX)\nprint('locked', flush=True)\n"
+                               "time.sleep(60)" % (manifest_file + ".lock")], stdout=subprocess.PIPE, text=True)
+    assert holder.stdout.readline().strip() == "locked"
+    holder.kill()
+    holder.wait()
+
+    update_manifest([voi_table(tmp_path, 1.0)], "PEG0001", manifest_file)
+    assert pd.read_csv(manifest_file)["subject"].tolist() == ["PEG0001"] * 3
+
+
+def test_update_manifest_concurrent_subjects(tmp_path):
+    manifest_file = str(tmp_path / "manifest.csv")
+    tasks = []
+    for i in range(8):
+        directory = tmp_path / ("PEG%04d" % i)
+        directory.mkdir()
+        tasks.append((voi_table(directory, float(i)), "PEG%04d" % i, manifest_file))
+    with multiprocessing.Pool(4) as pool:
+        pool.map(append_subject, tasks)
+    manifest = pd.read_csv(manifest_file)
+    assert len(manifest) == 8 * 3
+    assert sorted(manifest["subject"].unique()) == ["PEG%04d" % i for i in range(8)]
+
+
+# rows of subjects to run again are removed under the lock, after a subject holding it has appended its rows
+def test_update_manifest_remove_subjects(tmp_path):
+    import fcntl
+    import threading
+    manifest_file = str(tmp_path / "manifest.csv")
+    for i in range(3):
+        directory = tmp_path / ("PEG%04d" % i)
+        directory.mkdir()
+        update_manifest([voi_table(directory, float(i))], "PEG%04d" % i, manifest_file)
+
+    with open(manifest_file + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        remover = threading.Thread(target=update_manifest, args=([], None, manifest_file),
+                                   kwargs={"remove_subjects": ["PEG0000", "PEG0002"]})
+        remover.start()
+        remover.join(0.5)
+        assert remover.is_alive()
+        assert len(pd.read_csv(manifest_file)) == 3 * 3
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    remover.join(10)
+    assert pd.read_csv(manifest_file)["subject"].tolist() == ["PEG0001"] * 3
+
+    # removing and adding the rows of a subject in one call
+    update_manifest([voi_table(tmp_path / "PEG0001", 5.0)], "PEG0001", manifest_file, remove_subjects=["PEG0001"])
+    manifest = pd.read_csv(manifest_file)
+    assert manifest["subject"].tolist() == ["PEG0001"] * 3
+    assert (manifest["value"][manifest["statistic"] != "n_voxels"] == 5.0).all()
+
+
+## FLIRT MATRIX ##
+def save_image(path, data, affine):
+    import nibabel as nib
+    nib.save(nib.Nifti1Image(np.asarray(data, dtype=np.float32), affine), str(path))
+    return str(path)
+
+
+def translation(x=0.0, y=0.0, z=0.0):
+    matrix = np.eye(4)
+    matrix[:3, 3] = [x, y, z]
+    return matrix
+
+
+# ramp along x on a grid of 2 x 3 x 4 mm voxels; the affine has a positive determinant, so FSL flips the x axis of
+# its scaled-mm coordinates (x_mm = (nx - 1 - i) * 2)
+def flipped_ramp(tmp_path):
+    affine = np.diag([2.0, 3.0, 4.0, 1.0])
+    data = np.broadcast_to(np.arange(6, dtype=np.float32)[:, np.newaxis, np.newaxis] * 10, (6, 5, 4))
+    return save_image(tmp_path / "ramp.nii.gz", data, affine), save_image(tmp_path / "mask.nii.gz", data > 0, affine)
+
+
+# Reference outputs of FLIRT -applyxfm on a flipped x axis: a matrix translating the input by +2 mm (one voxel) in
+# scaled-mm moves the image towards lower x indices, i.e. output[i] = input[i + 1]; reference voxels mapped outside
+# of the input (beyond index 5) are 0. Half a voxel (+1 mm) interpolates between neighbours.
+@pytest.mark.parametrize("shift_mm, expected", [
+    (2.0, [10, 20, 30, 40, 50, 0]),
+    (1.0, [5, 15, 25, 35, 45, 0]),
+    (-2.0, [0, 0, 10, 20, 30, 40]),
+])
+def test_apply_flirt_matrix_flipped_x(tmp_path, monkeypatch, shift_mm, expected):
+    monkeypatch.chdir(tmp_path)
+    ramp, mask = flipped_ramp(tmp_path)
+    matrix = str(tmp_path / "shift.mat")
+    np.savetxt(matrix, translation(x=shift_mm))
+    (out_file,), _ = apply_flirt_matrix([ramp], mask, matrix, ramp)
+    import nibabel as nib
+    out = np.asanyarray(nib.load(out_file).dataobj)
+    np.testing.assert_allclose(out[:, 2, 1], expected, atol=1e-4)
+
+
+# without the flip (negative determinant) the same matrix moves the image towards higher x indices
+def test_apply_flirt_matrix_unflipped_x(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    affine = np.diag([-2.0, 3.0, 4.0, 1.0])
+    data = np.broadcast_to(np.arange(6, dtype=np.float32)[:, np.newaxis, np.newaxis] * 10, (6, 5, 4))
+    ramp = save_image(tmp_path / "ramp.nii.gz", data, affine)
+    mask = save_image(tmp_path / "mask.nii.gz", data > 0, affine)
+    matrix = str(tmp_path / "shift.mat")
+    np.savetxt(matrix, translation(x=2.0))
+    (out_file,), _ = apply_flirt_matrix([ramp], mask, matrix, ramp)
+    import nibabel as nib
+    np.testing.assert_allclose(np.asanyarray(nib.load(out_file).dataobj)[:, 2, 1], [0, 0, 10, 20, 30, 40], atol=1e-4)
+
+
+# images of the same shape on another grid would be resampled with the mapping of the first image
+@pytest.mark.parametrize("affine", [np.diag([2.0, 3.0, 4.0, 1.0]) @ translation(x=1.0),
+                                    np.diag([2.0, 3.0, 5.0, 1.0])])
+def test_apply_flirt_matrix_rejects_other_grids(tmp_path, monkeypatch, affine):
+    monkeypatch.chdir(tmp_path)
+    ramp, _ = flipped_ramp(tmp_path)
+    other = save_image(tmp_path / "other.nii.gz", np.ones((6, 5, 4)), affine)
+    matrix = str(tmp_path / "identity.mat")
+    np.savetxt(matrix, np.eye(4))
+    with pytest.raises(ValueError, match="Grid of"):
+        apply_flirt_matrix([ramp], other, matrix, ramp)
+    with pytest.raises(ValueError, match="Grid of"):
+        apply_flirt_matrix([ramp, other], ramp, matrix, ramp)
+
+
+# comparison with FLIRT itself, only if FSL is installed
+@pytest.mark.skipif(shutil.which("flirt") is None, reason="FSL flirt not installed")
+def test_apply_flirt_matrix_matches_flirt(tmp_path, monkeypatch):
+    import nibabel as nib
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    image = save_image(tmp_path / "map.nii.gz", rng.random((20, 18, 12)) * 100, np.diag([2.0, 2.5, 4.0, 1.0]))
+    reference = save_image(tmp_path / "reference.nii.gz", np.zeros((30, 28, 16)), np.diag([1.5, 1.6, 3.0, 1.0]))
+    angle = np.deg2rad(5)
+    matrix = np.array([[np.cos(angle), -np.sin(angle), 0, 3.0], [np.sin(angle), np.cos(angle), 0, -2.0],
+                       [0, 0, 1, 1.5], [0, 0, 0, 1]])
+    np.savetxt(str(tmp_path / "rotation.mat"), matrix)
+    subprocess.check_call(["flirt", "-in", image, "-ref", reference, "-applyxfm", "-init",
+                           str(tmp_path / "rotation.mat"), "-interp", "trilinear", "-out",
+                           str(tmp_path / "fsl.nii.gz")])
+    (out_file,), _ = apply_flirt_matrix([image], image, str(tmp_path / "rotation.mat"), reference)
+    ours = np.asanyarray(nib.load(out_file).dataobj)
+    fsl = np.asanyarray(nib.load(str(tmp_path / "fsl.nii.gz")).dataobj)
+    # voxels at the border of the input are treated differently by FLIRT
+    interior = (ours != 0) & (fsl != 0)
+    np.testing.assert_allclose(ours[interior], fsl[interior], atol=1e-2 * 100)
+
+
+## VOI STATISTICS ##
+# mean, median and n_voxels include zero voxels like fslmeants, the _nonzero statistics exclude them
+def test_voi_statistics_with_and_without_zeros(tmp_path, monkeypatch):
+    import json
+    from custom_nodes import voi_statistics
+    monkeypatch.chdir(tmp_path)
+    labels = np.zeros((4, 4, 2), dtype=np.uint8)
+    labels[:2] = 1
+    data = np.arange(1, 33, dtype=np.float32).reshape(4, 4, 2)
+    data[0, 0] = 0
+    save_image(str(tmp_path / "labels.nii.gz"), labels, np.eye(4))
+    save_image(str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz"), data, np.eye(4))
+    with open(str(tmp_path / "labels.json"), "w") as f:
+        json.dump({"territories": ["MCA_ipsi"]}, f)
+    table = voi_statistics([str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz")], str(tmp_path / "labels.nii.gz"),
+                           str(tmp_path / "labels.json"))[0]
+    row = pd.read_csv(table).iloc[0]
+    territory = data[:2].reshape(-1)
+    assert row["n_voxels"] == 16 and row["n_nonzero"] == 14
+    assert row["mean"] == pytest.approx(territory.mean())
+    assert row["median"] == pytest.approx(np.median(territory))
+    assert row["mean_nonzero"] == pytest.approx(territory[territory != 0].mean())
+    assert row["median_nonzero"] == pytest.approx(np.median(territory[territory != 0]))
+
+
+# contralateral voxels above the threshold (relative to their own median) are not vulnerable
+def test_vulnerability_mask_only_ipsilateral(tmp_path, monkeypatch):
+    import json
+    import nibabel as nib
+    from custom_nodes import voi_statistics
+    monkeypatch.chdir(tmp_path)
+    labels = np.zeros((4, 4, 2), dtype=np.uint8)
+    labels[:2] = 1
+    labels[2:] = 2
+    # contra (bit 0) has a median of 4 and outliers of 8 (relative 2.0), ipsi (bit 1) is at 4.4 (relative 1.1)
+    data = np.where(labels == 1, 4.0, 4.4).astype(np.float32)
+    data[0, :2, 0] = 8.0
+    save_image(str(tmp_path / "labels.nii.gz"), labels, np.eye(4))
+    save_image(str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz"), data, np.eye(4))
+    with open(str(tmp_path / "labels.json"), "w") as f:
+        json.dump({"territories": ["MCA_contra", "MCA_ipsi"]}, f)
+    outputs = voi_statistics([str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz")], str(tmp_path / "labels.nii.gz"),
+                             str(tmp_path / "labels.json"), write_relative=True)
+    relative = np.asanyarray(nib.load(outputs[3][0]).dataobj)
+    assert relative[0, 0, 0] == pytest.approx(2.0)
+    assert not np.asanyarray(nib.load(outputs[4][0]).dataobj).any()
+
+    data[2, 0, 0] = 6.0
+    save_image(str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz"), data, np.eye(4))
+    outputs = voi_statistics([str(tmp_path / "DSC_pgui_parametric_MTT.nii.gz")], str(tmp_path / "labels.nii.gz"),
+                             str(tmp_path / "labels.json"), write_relative=True)
+    assert np.argwhere(np.asanyarray(nib.load(outputs[4][0]).dataobj)).tolist() == [[2, 0, 0]]
+
+
+## TRIPLE MASK LABELS ##
+# DSC mask and GM of an LPS grid and VOI masks saved in LPI; returns the VOI mask files
+def triple_mask_inputs(tmp_path, vois):
+    from phantom import lps_affine, save_oriented
+    affine = lps_affine((6, 4, 4), (2.0, 2.0, 2.0))
+    dsc = np.ones((6, 4, 4), dtype=np.uint8)
+    dsc[5] = 0
+    gm = np.ones((6, 4, 4), dtype=np.uint8)
+    gm[:, 0] = 0
+    save_oriented(dsc, affine, str(tmp_path / "dsc_mask.nii.gz"), "LPS")
+    save_oriented(gm, affine, str(tmp_path / "gm.nii.gz"), "LPS")
+    files = []
+    for name, voi in vois.items():
+        files.append(save_oriented(voi.astype(np.uint8), affine, str(tmp_path / (name + "_mask.nii.gz")), "LPI"))
+    return files
+
+
+# bit i of a voxel is set if it lies in the DSC mask, in GM and in VOI i (territories sorted by name, may overlap)
+def test_triple_mask_bit_layout(tmp_path, monkeypatch):
+    import json
+    import nibabel as nib
+    from custom_nodes import build_triple_mask_labels
+    monkeypatch.chdir(tmp_path)
+    hemi = np.zeros((6, 4, 4), dtype=bool)
+    hemi[3:] = True
+    mca = np.zeros((6, 4, 4), dtype=bool)
+    mca[4:, 2:] = True
+    aca = np.zeros((6, 4, 4), dtype=bool)
+    aca[:2, :, :2] = True
+    files = triple_mask_inputs(tmp_path, {"hemi_ipsi": hemi, "MCA_ipsi": mca, "ACA_contra": aca})
+    label_file, label_names, _ = build_triple_mask_labels(str(tmp_path / "dsc_mask.nii.gz"), str(tmp_path / "gm.nii.gz"),
+                                                          files, orientation="LPS")
+    with open(label_names) as f:
+        assert json.load(f)["territories"] == ["ACA_contra", "MCA_ipsi", "hemi_ipsi"]
+    labels = np.asanyarray(nib.load(label_file).dataobj)
+    inside = np.ones((6, 4, 4), dtype=bool)
+    inside[5] = False
+    inside[:, 0] = False
+    expected = (aca & inside) * 1 + (mca & inside) * 2 + (hemi & inside) * 4
+    np.testing.assert_array_equal(labels, expected)
+    assert labels[4, 2, 0] == 6
+
+
+def test_triple_mask_limits(tmp_path, monkeypatch):
+    import nibabel as nib
+    from custom_nodes import build_triple_mask_labels
+    monkeypatch.chdir(tmp_path)
+    voi = np.ones((6, 4, 4), dtype=bool)
+    files = triple_mask_inputs(tmp_path, {"VOI%d" % i: voi for i in range(9)})
+    with pytest.raises(ValueError, match="at most 8 territories"):
+        build_triple_mask_labels(str(tmp_path / "dsc_mask.nii.gz"), str(tmp_path / "gm.nii.gz"), files, "LPS")
+    # a mask of the same shape on another grid
+    image = nib.load(files[0])
+    nib.save(nib.Nifti1Image(np.asanyarray(image.dataobj), image.affine @ translation(x=1.0)), files[0])
+    with pytest.raises(ValueError, match="Grid of"):
+        build_triple_mask_labels(str(tmp_path / "dsc_mask.nii.gz"), str(tmp_path / "gm.nii.gz"), files[:8], "LPS")
+
+
+## FIRST VOLUME OF DSC_SOURCE ##
+# the first volume of 3D, 4D and 5D series is read through the array proxy and saved next to the source
+@pytest.mark.parametrize("shape", [(4, 3, 2), (4, 3, 2, 5), (4, 3, 2, 5, 2)])
+def test_first_volume(tmp_path, shape):
+    import nibabel as nib
+    from custom_nodes import get_first_image_of_time_series
+    data = np.arange(np.prod(shape), dtype=np.float32).reshape(shape)
+    source = save_image(tmp_path / "DSC_Source.nii.gz", data, np.diag([2.0, 2.0, 3.0, 1.0]))
+    out_file = get_first_image_of_time_series(source)
+    assert out_file == str(tmp_path / "DSC_Source_0.nii.gz")
+    image = nib.load(out_file)
+    np.testing.assert_array_equal(np.asanyarray(image.dataobj), data[(slice(None),) * 3 + (0,) * (len(shape) - 3)])
+    np.testing.assert_array_equal(image.affine, np.diag([2.0, 2.0, 3.0, 1.0]))
+
+
+# the volume is written to a temporary file that replaces the target, later calls reuse it until the source changes
+def test_first_volume_cache(tmp_path, monkeypatch):
+    from custom_nodes import get_first_image_of_time_series
+    source = save_image(tmp_path / "DSC_Source.nii.gz", np.ones((4, 3, 2, 3)), np.eye(4))
+    replaced = []
+    replace = os.replace
+    monkeypatch.setattr(os, "replace", lambda src, dst: replaced.append((src, dst)) or replace(src, dst))
+    out_file = get_first_image_of_time_series(source)
+    assert [dst for _, dst in replaced] == [out_file]
+    assert os.path.dirname(replaced[0][0]) == str(tmp_path) and replaced[0][0] != out_file
+    assert sorted(os.listdir(str(tmp_path))) == ["DSC_Source.nii.gz", "DSC_Source_0.nii.gz"]
+
+    assert get_first_image_of_time_series(source) == out_file
+    assert len(replaced) == 1
+    newer = os.path.getmtime(out_file) + 10
+    os.utime(source, (newer, newer))
+    get_first_image_of_time_series(source)
+    assert len(replaced) == 2
+
+
+## IN-MEMORY REORIENTATION ##
+# reorienting the maps in memory before the FLIRT step gives the image of reorienting them on disk first
+# (nipype Reorient) and applying the matrix to the LPS file
+@pytest.mark.parametrize("orientation", ["LPS", "RAS"])
+def test_reorientation_in_memory(tmp_path, monkeypatch, orientation):
+    import nibabel as nib
+    from phantom import flirt_matrix, lps_affine, save_oriented
+    rng = np.random.default_rng(3)
+    affine = lps_affine((10, 8, 6), (2.0, 2.0, 3.0))
+    stored = save_oriented(rng.random((10, 8, 6)).astype(np.float32), affine,
+                           str(tmp_path / "DSC_pgui_TTP.nii.gz"), orientation)
+    image = nib.load(stored)
+    os.makedirs(str(tmp_path / "reoriented"))
+    on_disk = str(tmp_path / "reoriented" / "DSC_pgui_TTP.nii.gz")
+    nib.save(image.as_reoriented(nib.orientations.ornt_transform(nib.io_orientation(image.affine),
+                                                                 nib.orientations.axcodes2ornt("LPS"))), on_disk)
+    mask = save_oriented(np.ones((10, 8, 6)), affine, str(tmp_path / "mask.nii.gz"), "LPS")
+    reference = save_oriented(np.zeros((12, 12, 8)), lps_affine((12, 12, 8), (1.5, 1.5, 2.5)),
+                              str(tmp_path / "reference.nii.gz"), "LPS")
+    matrix = str(tmp_path / "matrix.mat")
+    np.savetxt(matrix, translation(1.3, -0.7, 0.4) @ flirt_matrix(on_disk, reference))
+
+    outputs = {}
+    for name, in_file, target in (("memory", stored, "LPS"), ("disk", on_disk, None)):
+        os.makedirs(str(tmp_path / name))
+        monkeypatch.chdir(tmp_path / name)
+        (out_file, _), _ = apply_flirt_matrix([in_file, in_file], mask, matrix, reference, orientation=target)
+        outputs[name] = out_file
+    expected = "DSC_pgui_TTP_flirt.nii.gz" if orientation == "LPS" else "DSC_pgui_TTP_lps_flirt.nii.gz"
+    assert os.path.basename(outputs["memory"]) == expected
+    memory, disk = nib.load(outputs["memory"]), nib.load(outputs["disk"])
+    assert np.asanyarray(disk.dataobj).any()
+    np.testing.assert_allclose(np.asanyarray(memory.dataobj), np.asanyarray(disk.dataobj), atol=1e-6)
+    np.testing.assert_allclose(memory.affine, disk.affine)
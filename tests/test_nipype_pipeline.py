@@ -0,0 +1,308 @@
+import os
+
+import pytest
+
+pytest.importorskip("nipype")
+import nipype_pipeline
+
+
+def settings(tmp_path, **changes):
+    (tmp_path / "data").mkdir(exist_ok=True)
+    settings = nipype_pipeline.load_settings()
+    settings.update(experiment_dir=str(tmp_path / "data"), results_dir=str(tmp_path / "results"),
+                    result_store_dir=str(tmp_path / "store"))
+    settings.update(changes)
+    return settings
+
+
+def node_names(wf):
+    return sorted(node.name for node in wf._create_flat_graph().nodes())
+
+
+# building the workflow creates every interface, i.e. invalid interface inputs raise a TraitError here
+def test_build_workflow(tmp_path):
+    wf = nipype_pipeline.build_workflow(settings(tmp_path), ["PEG0005", "PEG0006"])
+    names = node_names(wf)
+    assert len(names) == 16
+    assert {"BETnode_MPRAGE", "BETnode_DSC", "voi_statistics", "datasink", "manifest"} <= set(names)
+
+
+def test_build_workflow_preprocess(tmp_path):
+    wf = nipype_pipeline.build_workflow(settings(tmp_path), ["PEG0005"], extract=False)
+    assert "voi_statistics" not in node_names(wf)
+    assert len(node_names(wf)) == 12
+
+
+def test_build_workflow_optional_outputs(tmp_path):
+    wf = nipype_pipeline.build_workflow(settings(tmp_path, write_reoriented_images=True, write_triple_masks=True,
+                                                 write_relative_maps=True, result_store_dir=None), ["PEG0005"])
+    assert len(node_names(wf)) == 18
+
+
+# memory and thread estimates are passed to the nodes when they are built, limited to the budget of the plugin
+def test_build_workflow_resources(tmp_path):
+    resources = {"NUC": (1.5, 1), "NUC_2": (0.5, 1), "segmentation": (12.0, 16), "reorient_image": (0.7, 1)}
+    wf = nipype_pipeline.build_workflow(settings(tmp_path, memory_gb=8, write_reoriented_images=True), ["PEG0005"],
+                                        resources=resources)
+    nodes = {node.name: node for node in wf._graph.nodes()}
+    assert (nodes["NUC"].mem_gb, nodes["NUC_2"].mem_gb) == (1.5, 0.5)
+    assert nodes["NUC_2"].inputs.iterations == 6
+    assert (nodes["segmentation"].mem_gb, nodes["segmentation"].n_procs) == (8, 8)
+    assert nodes["reorient_image"].mem_gb == 0.7
+    assert nodes["fsl_reg"].mem_gb == 0.2
+
+
+# a changed subject whose rerun failed has no rows in the manifest: its old results are removed from the stores
+# and it is not recorded as processed, so it runs again
+def test_aggregate_drops_stale_results_of_failed_subjects(tmp_path):
+    import pandas as pd
+    from voi_results import from_long_rows, write_subject, stored_subjects
+
+    run_settings = settings(tmp_path)
+    paths = nipype_pipeline.result_paths(run_settings)
+    rows = pd.DataFrame({"subject": "PEG0001", "map": "DSC_pgui_parametric_MTT", "territory": "MCA_ipsi",
+                         "statistic": ["mean", "median", "n_voxels"], "value": [4.0, 3.5, 10],
+                         "path": str(tmp_path / "voi_statistics.csv")})
+    os.makedirs(paths["results_directory"])
+    rows.to_csv(paths["manifest_file"], index=False)
+    write_subject(paths["voi_results_directory"], "PEG0002", from_long_rows(rows.assign(subject="PEG0002")))
+    pd.Series({"PEG0002": "old"}, name="fingerprint").rename_axis("subject").to_csv(paths["subjects_file"])
+
+    nipype_pipeline.aggregate(run_settings, {"PEG0001": "a", "PEG0002": "new"}, ["PEG0001", "PEG0002"])
+    assert stored_subjects(paths["voi_results_directory"]) == ["PEG0001"]
+    assert nipype_pipeline.processed_subjects(paths["subjects_file"]) == {"PEG0001": "a"}
+
+
+# a subject with a missing input file is marked as failed, the other subjects are run
+def test_subject_with_missing_inputs_is_failed(tmp_path):
+    from subject_status import read_status
+    run_settings = settings(tmp_path, subject_list=["PEG0001", "PEG0002"], incremental=False)
+    for subject in ["PEG0001", "PEG0002"]:
+        (tmp_path / "data" / subject).mkdir()
+        (tmp_path / "data" / subject / "DSC_Source.nii.gz").write_bytes(b"")
+    (tmp_path / "data" / "PEG0001" / "MPRAGE.nii.gz").write_bytes(b"")
+    fingerprints, run_list = nipype_pipeline.subjects_to_run(run_settings)
+    assert run_list == ["PEG0001"] and list(fingerprints) == ["PEG0001"]
+    status = read_status(nipype_pipeline.result_paths(run_settings)["status_file"])
+    assert status["PEG0002"]["status"] == "failed"
+    assert status["PEG0002"]["error"].startswith("input files not readable")
+
+
+## FAULT ISOLATION ##
+# node of the test workflows: PEG0002 always fails, PEG0003 fails once with a transient error
+def subject_work(subject_id, flag_dir):
+    import os
+    if subject_id == "PEG0002":
+        raise ValueError("bad header in DSC_Source.nii.gz")
+    if subject_id == "PEG0003" and not os.path.exists(os.path.join(flag_dir, "tried")):
+        open(os.path.join(flag_dir, "tried"), "w").close()
+        raise OSError("[Errno 116] Stale file handle")
+    return subject_id
+
+
+# infosource -> work -> datasink of every subject, named like the nodes of the pipeline
+def fault_workflow(tmp_path, subjects):
+    from nipype import Function, IdentityInterface, Node, Workflow
+    from nipype.interfaces.io import DataSink
+    infosource = Node(IdentityInterface(fields=["subject_id"]), name="infosource")
+    infosource.iterables = [("subject_id", subjects)]
+    work = Node(Function(input_names=["subject_id", "flag_dir"], output_names=["out"], function=subject_work),
+                name="work")
+    work.inputs.flag_dir = str(tmp_path)
+    datasink = Node(DataSink(base_directory=str(tmp_path / "sink")), name="datasink")
+    wf = Workflow("run_01", base_dir=str(tmp_path / "work"))
+    wf.connect([(infosource, work, [("subject_id", "subject_id")]), (work, datasink, [("out", "subject")])])
+    return wf
+
+
+# the profile is also written if a subject failed
+def test_profile_of_runs_with_failed_subjects(tmp_path):
+    run_settings = settings(tmp_path, write_profile_report=True, record_resources=False)
+    wf = fault_workflow(tmp_path, ["PEG0001", "PEG0002"])
+    nipype_pipeline.run_attempt(run_settings, wf, ["PEG0001", "PEG0002"], {"n_procs": 2})
+    profiles = list((tmp_path / "results" / "run_01_results" / "46_Profiling").glob("profile_*.csv"))
+    assert len(profiles) == 1
+    import pandas as pd
+    assert "PEG0001" in set(pd.read_csv(profiles[0])["subject"])
+
+
+def run_attempts(run_settings, tmp_path, subjects):
+    attempt = 0
+    while subjects:
+        wf = fault_workflow(tmp_path, subjects)
+        sinks = nipype_pipeline.run_attempt(run_settings, wf, subjects, {"n_procs": 2})
+        subjects = nipype_pipeline.finish_attempt(run_settings, wf, subjects, False, attempt, sinks)
+        attempt += 1
+
+
+# the failed subject is quarantined, the transient failure is run again and only subjects whose results reached the
+# datasink are complete; pre-processed subjects are still unfinished for resume (no VOI statistics yet)
+def test_preprocess_status_from_datasink(tmp_path):
+    from subject_status import read_status, unfinished_subjects
+    run_settings = settings(tmp_path, write_profile_report=False, record_resources=False, max_retries=1)
+    run_attempts(run_settings, tmp_path, ["PEG0001", "PEG0002", "PEG0003"])
+    paths = nipype_pipeline.result_paths(run_settings)
+    status = read_status(paths["status_file"])
+    assert {subject: entry["status"] for subject, entry in status.items()} == {
+        "PEG0001": "complete", "PEG0002": "failed", "PEG0003": "complete"}
+    assert "bad header" in status["PEG0002"]["error"]
+    assert all(os.path.exists(path) for path in status["PEG0002"]["crashes"])
+    assert {entry["stage"] for entry in status.values()} == {"preprocess"}
+    assert unfinished_subjects(status) == ["PEG0001", "PEG0002", "PEG0003"]
+
+
+# a subject without crash files whose datasink did not finish is not complete
+def test_subject_without_datasink_is_failed(tmp_path):
+    from subject_status import read_status
+    run_settings = settings(tmp_path, write_profile_report=False, record_resources=False)
+    wf = fault_workflow(tmp_path, ["PEG0001"])
+    nipype_pipeline.run_attempt(run_settings, wf, ["PEG0001"], {"n_procs": 1})
+    nipype_pipeline.finish_attempt(run_settings, wf, ["PEG0001"], False, 0, set())
+    status = read_status(nipype_pipeline.result_paths(run_settings)["status_file"])
+    assert status["PEG0001"]["status"] == "failed"
+    assert status["PEG0001"]["error"] == "results did not reach the datasink"
+
+
+## STREAMING RESULTS ##
+# node of the streaming test: VOI statistics table and histograms of a subject with the given value
+# (after only orders the nodes)
+def subject_voi_statistics(subject_id, value, after=None):
+    import os
+    import numpy as np
+    import pandas as pd
+    out_table = os.path.join(os.getcwd(), "voi_statistics.csv")
+    pd.DataFrame({"map": ["DSC_pgui_parametric_MTT"], "territory": ["MCA_ipsi"], "mean": [value],
+                  "median": [value], "n_voxels": [10]}).to_csv(out_table, index=False)
+    out_histograms = os.path.join(os.getcwd(), "voi_histograms.npz")
+    np.savez_compressed(out_histograms, n_bins=4, counts=np.full((1, 4), value))
+    return out_table, out_histograms
+
+
+# the VOI statistics of a subject are written to the stores when its voi_statistics node ends; other nodes with the
+# same outputs (running after it, so they would replace its results) and failed subjects are not written
+def test_stream_results(tmp_path):
+    from nipype import Function, Node
+    from voi_results import read_voi_results, stored_subjects
+    run_settings = settings(tmp_path, write_profile_report=False, record_resources=False)
+    paths = nipype_pipeline.result_paths(run_settings)
+    wf = fault_workflow(tmp_path, ["PEG0001", "PEG0002"])
+    nodes = []
+    for name, value in (("voi_statistics", 1.0), ("other_statistics", 99.0)):
+        nodes.append(Node(Function(input_names=["subject_id", "value", "after"],
+                                   output_names=["out_table", "out_histograms"],
+                                   function=subject_voi_statistics), name=name))
+        nodes[-1].inputs.value = value
+        # outputs without connections would be removed by nipype, like in the pipeline they are saved by the datasink
+        wf.connect([(wf.get_node("work"), nodes[-1], [("out", "subject_id")]),
+                    (nodes[-1], wf.get_node("datasink"), [("out_table", name + ".@table"),
+                                                          ("out_histograms", name + ".@histograms")])])
+    wf.connect(nodes[0], "out_table", nodes[1], "after")
+    callback = nipype_pipeline.stream_results(paths["voi_results_directory"], paths["voi_histograms_directory"])
+    nipype_pipeline.run_attempt(run_settings, wf, ["PEG0001", "PEG0002"], {"n_procs": 2, "status_callback": callback})
+
+    assert stored_subjects(paths["voi_results_directory"]) == ["PEG0001"]
+    table = read_voi_results(paths["voi_results_directory"])
+    assert set(table.loc[table["statistic"] != "n_voxels", "value"]) == {1.0}
+    import numpy as np
+    with np.load(os.path.join(paths["voi_histograms_directory"], "PEG0001.npz")) as histograms:
+        assert (histograms["counts"] == 1.0).all()
+    assert not os.path.exists(os.path.join(paths["voi_histograms_directory"], "PEG0002.npz"))
+
+
+## COMMAND LINE ##
+# settings of a config file replace the defaults, unknown settings are rejected
+def test_load_settings(tmp_path):
+    import json
+    config_file = str(tmp_path / "run.json")
+    with open(config_file, "w") as f:
+        json.dump({"cpus": 2, "perfusion_maps": ["TTP"]}, f)
+    loaded = nipype_pipeline.load_settings(config_file)
+    assert (loaded["cpus"], loaded["perfusion_maps"]) == (2, ["TTP"])
+    assert loaded["sides"] == nipype_pipeline.load_settings()["sides"]
+
+    with open(config_file, "w") as f:
+        json.dump({"cpus": 2, "cpu": 4}, f)
+    with pytest.raises(ValueError, match="Unknown settings .*: cpu$"):
+        nipype_pipeline.load_settings(config_file)
+
+
+def test_write_config(tmp_path):
+    import json
+    config_file, out_file = str(tmp_path / "run.json"), str(tmp_path / "written.json")
+    with open(config_file, "w") as f:
+        json.dump({"max_retries": 0}, f)
+    nipype_pipeline.main(["--config", config_file, "--write-config", out_file])
+    with open(out_file) as f:
+        written = json.load(f)
+    assert sorted(written) == sorted(nipype_pipeline.SETTINGS)
+    assert written["max_retries"] == 0
+
+
+# stages called by main, with the workflow, graph and aggregation replaced by recorders
+@pytest.fixture
+def stage_calls(monkeypatch):
+    calls = []
+
+    class Graph:
+        def write_graph(self, graph2use):
+            calls.append(("write_graph", graph2use))
+
+    def run_workflow(settings, run_list, extract=True):
+        calls.append(("run_workflow", run_list, extract))
+        return Graph()
+
+    def build_workflow(settings, run_list, extract=True, resources=None):
+        calls.append(("build_workflow", run_list))
+        return Graph()
+
+    monkeypatch.setattr(nipype_pipeline, "run_workflow", run_workflow)
+    monkeypatch.setattr(nipype_pipeline, "build_workflow", build_workflow)
+    monkeypatch.setattr(nipype_pipeline, "aggregate", lambda settings, fingerprints, run_list:
+                        calls.append(("aggregate", run_list)))
+    return calls
+
+
+def run_main(tmp_path, monkeypatch, argv, run_list):
+    import json
+    monkeypatch.setattr(nipype_pipeline, "subjects_to_run",
+                        lambda settings: ({"PEG0001": "a", "PEG0002": "b"}, list(run_list)))
+    config_file = str(tmp_path / "run.json")
+    with open(config_file, "w") as f:
+        json.dump({"results_dir": str(tmp_path / "results"), "experiment_dir": str(tmp_path / "data")}, f)
+    nipype_pipeline.main(argv + ["--config", config_file])
+
+
+@pytest.mark.parametrize("argv, expected", [
+    ([], [("run_workflow", ["PEG0001"], True), ("write_graph", "flat"), ("aggregate", ["PEG0001"])]),
+    (["aggregate"], [("aggregate", ["PEG0001"])]),
+    (["preprocess"], [("run_workflow", ["PEG0001"], False)]),
+    # the graph of a pre-processing run shows the whole workflow
+    (["graph", "preprocess"], [("run_workflow", ["PEG0001"], False), ("build_workflow", ["PEG0001"]),
+                               ("write_graph", "flat")])])
+def test_stage_selection(tmp_path, monkeypatch, stage_calls, argv, expected):
+    run_main(tmp_path, monkeypatch, argv, ["PEG0001"])
+    assert stage_calls == expected
+
+
+def test_unknown_stage(tmp_path, monkeypatch, stage_calls):
+    with pytest.raises(SystemExit):
+        run_main(tmp_path, monkeypatch, ["extract", "report"], ["PEG0001"])
+    assert stage_calls == []
+
+
+# without pending subjects the workflow is not built, the aggregation still runs
+def test_no_pending_subjects(tmp_path, monkeypatch, stage_calls, capsys):
+    run_main(tmp_path, monkeypatch, ["extract", "graph", "aggregate"], [])
+    assert stage_calls == [("aggregate", [])]
+    assert "No subjects to process - stages skipped: extract, graph" in capsys.readouterr().out
+
+
+# resume runs extract and aggregate for the unfinished subjects of the status file
+def test_resume(tmp_path, monkeypatch, stage_calls):
+    from subject_status import set_status, write_status
+    status_file = nipype_pipeline.result_paths(settings(tmp_path))["status_file"]
+    os.makedirs(os.path.dirname(status_file))
+    status = set_status({}, ["PEG0001"], "complete", stage="extract")
+    write_status(status_file, set_status(status, ["PEG0002"], "failed", error="NUC crashed", crashes=[]))
+    run_main(tmp_path, monkeypatch, ["resume"], ["PEG0001"])
+    assert stage_calls == [("run_workflow", ["PEG0002"], True), ("aggregate", ["PEG0002"])]
@@ -0,0 +1,115 @@
+import os
+import shutil
+import time
+
+import pytest
+
+pytest.importorskip("nipype")
+
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, File, TraitedSpec, traits
+from nipype.interfaces.fsl.base import Info
+
+from node_cache import RESTORED_MESSAGE, CachedBET, ResultStoreMixin, evict_result_store
+
+
+## CACHE KEY ##
+def write(path, text):
+    with open(str(path), "w") as f:
+        f.write(text)
+    return str(path)
+
+
+# the key depends on the content of the input files, the parameters and the FSL version, not on paths or environ
+def test_store_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(Info, "version", classmethod(lambda cls: "6.0.5"))
+    first = write(tmp_path / "a.nii.gz", "image")
+    os.makedirs(str(tmp_path / "other"))
+    copy = write(tmp_path / "other" / "b.nii.gz", "image")
+    key = CachedBET(in_file=first, frac=0.5)._store_key()
+    assert CachedBET(in_file=copy, frac=0.5, environ={"FSLDIR": "/opt/fsl"})._store_key() == key
+    assert CachedBET(in_file=first, frac=0.6)._store_key() != key
+    write(tmp_path / "other" / "b.nii.gz", "changed image")
+    assert CachedBET(in_file=copy, frac=0.5)._store_key() != key
+    monkeypatch.setattr(Info, "version", classmethod(lambda cls: "6.0.7"))
+    assert CachedBET(in_file=first, frac=0.5)._store_key() != key
+
+
+## RESTORE ##
+class CopyInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True)
+    suffix = traits.Str("")
+
+
+class CopyOutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+
+
+# writes the input with a suffix to copied.txt in the working directory and returns 0 like a command line
+class Copy(BaseInterface):
+    input_spec = CopyInputSpec
+    output_spec = CopyOutputSpec
+    _cmd = "copy"
+    runs = 0
+
+    def _run_interface(self, runtime):
+        Copy.runs += 1
+        with open(self.inputs.in_file) as f:
+            write(self._list_outputs()["out_file"], f.read() + self.inputs.suffix)
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        return {"out_file": os.path.abspath("copied.txt")}
+
+
+class CachedCopy(ResultStoreMixin, Copy):
+    pass
+
+
+# outputs of a stored entry are copied to the names of _list_outputs in the new working directory
+def test_restore_outputs(tmp_path, monkeypatch):
+    store = str(tmp_path / "store")
+    in_file = write(tmp_path / "input.txt", "data")
+    Copy.runs = 0
+    for run in ("run_1", "run_2"):
+        os.makedirs(str(tmp_path / run))
+        monkeypatch.chdir(tmp_path / run)
+        result = CachedCopy(store_dir=store, in_file=in_file, suffix="!").run()
+        with open(result.outputs.out_file) as f:
+            assert f.read() == "data!"
+        assert result.outputs.out_file == str(tmp_path / run / "copied.txt")
+    assert Copy.runs == 1
+    assert result.runtime.stdout.startswith(RESTORED_MESSAGE)
+    # other parameters are a new entry
+    CachedCopy(store_dir=store, in_file=in_file, suffix="?").run()
+    assert Copy.runs == 2
+
+
+## EVICTION ##
+# entry with outputs.json last used days ago and a file of size bytes
+def store_entry(store, key, days, size):
+    entry = os.path.join(store, key[:2], key)
+    os.makedirs(entry)
+    write(os.path.join(entry, "out_file_0_image.nii.gz"), "x" * size)
+    write(os.path.join(entry, "outputs.json"), "{}")
+    used = time.time() - days * 24 * 3600
+    os.utime(os.path.join(entry, "outputs.json"), (used, used))
+    return entry
+
+
+def test_evict_by_age_and_size(tmp_path):
+    store = str(tmp_path / "store")
+    old = store_entry(store, "aa01", 40, 1000)
+    recent = store_entry(store, "bb01", 1, 1000)
+    newest = store_entry(store, "cc01", 0, 1000)
+    leftover = os.path.join(store, "dd", "dd01.123.tmp")
+    os.makedirs(leftover)
+    os.utime(leftover, (time.time() - 2 * 24 * 3600,) * 2)
+    evict_result_store(store, max_age_days=30)
+    assert not os.path.exists(old) and os.path.exists(recent) and os.path.exists(newest)
+    assert not os.path.exists(leftover)
+    # the least recently used entry is removed until the store fits
+    evict_result_store(store, max_size_gb=1500 / 1024 ** 3)
+    assert not os.path.exists(recent) and os.path.exists(newest)
+    shutil.rmtree(store)
+    evict_result_store(store, max_size_gb=0)
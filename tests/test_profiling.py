@@ -0,0 +1,92 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("nipype")
+import networkx as nx
+from nipype.utils.filemanip import savepkl
+
+from profiling import COLUMNS, collect_profile, critical_paths
+
+
+# node of an execution graph with a working directory like .../run_01/_subject_id_PEG0001/NUC
+class FakeNode:
+    def __init__(self, work_dir, subject, name):
+        self.name = name
+        self.directory = os.path.join(str(work_dir), "_subject_id_" + subject if subject else "", name)
+
+    def output_dir(self):
+        return self.directory
+
+
+def write_result(node, wall_s, cpu_percent=None, samples=None, inputs=None):
+    os.makedirs(node.directory, exist_ok=True)
+    runtime = SimpleNamespace(startTime="2026-01-01T00:00:00", endTime="2026-01-01T00:00:%02d" % wall_s,
+                              duration=wall_s, cpu_percent=cpu_percent, mem_peak_gb=None, prof_dict=samples)
+    savepkl(os.path.join(node.directory, "result_%s.pklz" % node.name),
+            SimpleNamespace(runtime=runtime, inputs=inputs or {}, outputs=None))
+
+
+# two subjects share the infosource; NUC and BET run in parallel before the registration
+def synthetic_graph(work_dir, walls):
+    graph = nx.DiGraph()
+    infosource = FakeNode(work_dir, "", "infosource")
+    write_result(infosource, 1)
+    for subject, (nuc_s, bet_s, reg_s) in walls.items():
+        nodes = {name: FakeNode(work_dir, subject, name) for name in ("selectfiles", "NUC", "BETnode_DSC", "fsl_reg")}
+        for node, wall_s in zip(nodes.values(), (1, nuc_s, bet_s, reg_s)):
+            write_result(node, wall_s)
+        graph.add_edges_from([(infosource, nodes["selectfiles"]), (nodes["selectfiles"], nodes["NUC"]),
+                              (nodes["selectfiles"], nodes["BETnode_DSC"]), (nodes["NUC"], nodes["fsl_reg"]),
+                              (nodes["BETnode_DSC"], nodes["fsl_reg"])])
+    return graph
+
+
+## CRITICAL PATH ##
+# the path of every subject follows its slowest branch and includes the shared infosource
+def test_critical_paths(tmp_path):
+    graph = synthetic_graph(tmp_path, {"PEG0001": (5, 2, 3), "PEG0002": (2, 7, 4)})
+    profile = collect_profile(graph)
+    assert len(profile) == 9
+    assert profile.columns.tolist() == COLUMNS
+    assert (profile["index"] == -1).all()
+    assert sorted(profile["subject"].unique()) == ["", "PEG0001", "PEG0002"]
+    assert critical_paths(graph, profile) == {
+        "PEG0001": {"wall_s": 10.0, "nodes": ["infosource", "selectfiles", "NUC", "fsl_reg"]},
+        "PEG0002": {"wall_s": 13.0, "nodes": ["infosource", "selectfiles", "BETnode_DSC", "fsl_reg"]}}
+
+
+# a map node counts with its slowest subnode
+def test_critical_paths_map_node(tmp_path):
+    graph = synthetic_graph(tmp_path, {"PEG0001": (5, 2, 3)})
+    profile = collect_profile(graph)
+    subnodes = pd.DataFrame({"subject": "PEG0001", "node": "BETnode_DSC", "index": [0, 1, 2],
+                             "wall_s": [1.0, 6.0, 2.0]})
+    profile = pd.concat([profile[profile["node"] != "BETnode_DSC"], subnodes], ignore_index=True)
+    assert critical_paths(graph, profile)["PEG0001"] == {"wall_s": 11.0, "nodes": ["infosource", "selectfiles",
+                                                                                    "BETnode_DSC", "fsl_reg"]}
+
+
+## CPU TIME ##
+# CPU seconds are integrated from the resource monitor samples, with fewer than two samples they are estimated
+# from the peak CPU use times the duration, without CPU use they are unknown
+def test_cpu_seconds(tmp_path):
+    graph = nx.DiGraph()
+    nodes = [FakeNode(tmp_path, "PEG0001", name) for name in ("sampled", "single_sample", "peak_only", "unknown")]
+    input_file = tmp_path / "input.bin"
+    input_file.write_bytes(b"0" * 100)
+    write_result(nodes[0], 4, 300.0, {"time": [0.0, 1.0, 2.0, 4.0], "cpus": [100.0, 300.0, 100.0, 100.0]},
+                 inputs={"in_file": str(input_file)})
+    write_result(nodes[1], 4, 250.0, {"time": [0.0], "cpus": [250.0]})
+    write_result(nodes[2], 4, 250.0)
+    write_result(nodes[3], 4)
+    graph.add_nodes_from(nodes)
+    profile = collect_profile(graph).set_index("node")
+    np.testing.assert_allclose(profile.loc["sampled", "cpu_s"], 2.0 + 2.0 + 2.0)
+    np.testing.assert_allclose(profile.loc[["single_sample", "peak_only"], "cpu_s"], [10.0, 10.0])
+    assert np.isnan(profile.loc["unknown", "cpu_s"])
+    assert np.isnan(profile.loc["unknown", "cpu_peak"])
+    assert profile.loc["sampled", "input_bytes"] == 100
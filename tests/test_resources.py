@@ -0,0 +1,72 @@
+import os
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("nipype")
+from nipype.utils.filemanip import savepkl
+
+from node_cache import RESTORED_MESSAGE
+import resources
+from resources import DEFAULT_RESOURCES, node_arguments, node_resources, recorded_resources
+
+
+def write_result(work_dir, subject, node, mem_gb, cpu_percent, stdout=""):
+    folder = os.path.join(str(work_dir), "_subject_id_" + subject, node)
+    os.makedirs(folder)
+    runtime = SimpleNamespace(mem_peak_gb=mem_gb, cpu_percent=cpu_percent, stdout=stdout)
+    savepkl(os.path.join(folder, "result_%s.pklz" % node), SimpleNamespace(runtime=runtime))
+
+
+# nodes restored from the result store did not run, their tiny peaks are not recorded
+def test_restored_runs_are_not_recorded(tmp_path):
+    write_result(tmp_path, "PEG0001", "segmentation", 0.05, 10.0, RESTORED_MESSAGE + " /store/ab/abc")
+    write_result(tmp_path, "PEG0002", "fsl_reg", 0.05, 10.0, RESTORED_MESSAGE + " /store/cd/cde")
+    write_result(tmp_path, "PEG0003", "fsl_reg", 2.0, 95.0)
+    assert recorded_resources(str(tmp_path)) == {"fsl_reg": (2.5, 1)}
+    resources = node_resources(str(tmp_path))
+    assert resources["segmentation"] == DEFAULT_RESOURCES["segmentation"]
+    assert resources["fsl_reg"] == (2.5, 1)
+
+
+# recorded peaks below the defaults do not lower them
+def test_recorded_resources_only_raise_defaults(tmp_path):
+    write_result(tmp_path, "PEG0001", "segmentation", 0.5, 250.0)
+    mem_gb, threads = node_resources(str(tmp_path))["segmentation"]
+    assert mem_gb == DEFAULT_RESOURCES["segmentation"][0]
+    assert threads == 3
+
+
+# result files are only loaded once, the cached peaks are kept when the working directory is removed
+def test_recorded_resources_cache(tmp_path, monkeypatch):
+    work_dir, cache_file = tmp_path / "work", str(tmp_path / "46_Profiling" / "recorded_resources.json")
+    write_result(work_dir, "PEG0001", "fsl_reg", 2.0, 95.0)
+    write_result(work_dir, "PEG0002", "segmentation", 4.0, 150.0)
+    loaded = []
+    load = resources.loadpkl
+    monkeypatch.setattr(resources, "loadpkl", lambda path: loaded.append(path) or load(path))
+    expected = {"fsl_reg": (2.5, 1), "segmentation": (5.0, 2)}
+    assert recorded_resources(str(work_dir), cache_file=cache_file) == expected
+    assert len(loaded) == 2
+    assert recorded_resources(str(work_dir), cache_file=cache_file) == expected
+    assert len(loaded) == 2
+
+    # a new run of a subject is loaded again
+    result_file = os.path.join(str(work_dir), "_subject_id_PEG0001", "fsl_reg", "result_fsl_reg.pklz")
+    os.remove(result_file)
+    os.rmdir(os.path.dirname(result_file))
+    write_result(work_dir, "PEG0001", "fsl_reg", 3.0, 95.0)
+    os.utime(result_file, (1, 1))
+    assert recorded_resources(str(work_dir), cache_file=cache_file)["fsl_reg"] == (3.75, 1)
+    assert loaded[2:] == [result_file]
+
+    shutil.rmtree(str(work_dir))
+    assert node_resources(str(work_dir), cache_file=cache_file)["fsl_reg"] == (3.75, 1)
+
+
+# estimates are limited to the budget of the plugin
+def test_node_arguments():
+    arguments = node_arguments({"segmentation": (3.0, 1), "fsl_reg": (8.0, 4)}, memory_gb=6, n_procs=2)
+    assert arguments == {"segmentation": {"mem_gb": 3.0, "n_procs": 1}, "fsl_reg": {"mem_gb": 6, "n_procs": 2}}
+    assert node_arguments({"fsl_reg": (8.0, 4)}) == {"fsl_reg": {"mem_gb": 8.0, "n_procs": 4}}
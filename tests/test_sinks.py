@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+pytest.importorskip("nipype")
+
+from nipype.interfaces.io import DataSink
+
+import nipype_pipeline
+from sinks import PipelineDataSink, apply_substitutions, compile_substitutions
+
+
+## SUBSTITUTIONS ##
+# a replacement that contains a key or is part of a key cannot be applied in one pass
+@pytest.mark.parametrize("substitutions", [(("_output", "_NUC"), ("_NUC_brain", "_NUC_BET")),
+                                           (("_lps", "_reor"), ("_reor", "_lps")),
+                                           (("_flirt", "_coreg_flirt"),),
+                                           (("", "_x"),)])
+def test_rejected_substitutions(substitutions):
+    with pytest.raises(ValueError):
+        compile_substitutions(substitutions)
+
+
+# one pass gives the names of the sequential replacement of DataSink
+def test_substitutions_of_the_pipeline():
+    paths = ["/results/run_01_results/03_MPRAGE_reor_NUC_BET/_subject_id_PEG0001/MPRAGE_lps_output_brain.nii.gz",
+             "/results/run_01_results/05_MPRAGE_reor_NUC_BET_seg/_subject_id_PEG0001/MPRAGE_lps_output_brain_seg_1.nii.gz",
+             "/results/run_01_results/14_DSC_parametermaps_reor_coreg/_subject_id_PEG0001/DSC_pgui_TTP_lps_flirt.nii.gz",
+             "/results/run_01_results/33_DSC_reor_coreg_gm_VOI_stats/_subject_id_PEG0001/voi_statistics.csv"]
+    for path in paths:
+        expected = path
+        for key, value in nipype_pipeline.substitutions:
+            expected = expected.replace(key, value)
+        assert apply_substitutions(path, nipype_pipeline.substitutions) == expected
+    assert apply_substitutions(paths[0], nipype_pipeline.substitutions).endswith("PEG0001/MPRAGE_reor_NUC_BET.nii.gz")
+
+
+# the datasink applies the compiled substitutions and then the regular expressions, as DataSink
+def test_datasink_substitute():
+    regexp = [(r"_seg_(\d)", r"_class\1")]
+    path = "/results/05_seg/_subject_id_PEG0001/MPRAGE_lps_output_brain_seg_1_masked.nii.gz"
+    sinks = []
+    for interface in (PipelineDataSink, DataSink):
+        sink = interface()
+        sink.inputs.substitutions = [("_subject_id_", ""), ("_masked", ""), ("_lps", "_reor")]
+        sink.inputs.regexp_substitutions = regexp
+        sinks.append(sink._substitute(path))
+    assert sinks[0] == sinks[1] == "/results/05_seg/PEG0001/MPRAGE_reor_output_brain_class1.nii.gz"
+    assert PipelineDataSink()._substitute(path) == path
+
+
+## COMPRESSION ##
+def sink_run(tmp_path, sources):
+    sink = PipelineDataSink(base_directory=str(tmp_path / "results"), container="run_01_results")
+    setattr(sink.inputs, "14_maps", sources)
+    return sink.run().outputs.out_file
+
+
+# .nii files are saved as .nii.gz; in later runs they are only copied and compressed again if the source is newer
+def test_datasink_skips_up_to_date_files(tmp_path, monkeypatch):
+    import sinks
+    node_dir = tmp_path / "work" / "_subject_id_PEG0001"
+    node_dir.mkdir(parents=True)
+    sources = [str(node_dir / "DSC_pgui_TTP.nii"), str(node_dir / "voi_statistics.csv")]
+    for path in sources:
+        with open(path, "w") as f:
+            f.write("data")
+    gz = str(tmp_path / "results" / "run_01_results" / "14_maps" / "_subject_id_PEG0001" / "DSC_pgui_TTP.nii.gz")
+
+    out_files = sink_run(tmp_path, sources)
+    assert sorted(os.path.basename(f) for f in out_files) == ["DSC_pgui_TTP.nii.gz", "voi_statistics.csv"]
+    assert os.path.isfile(gz) and not os.path.exists(gz[:-len(".gz")])
+
+    compressed = []
+    monkeypatch.setattr(sinks, "gzip_nifti", lambda path, level: compressed.append(path) or path + ".gz")
+    out_files = sink_run(tmp_path, sources)
+    assert compressed == [] and gz in out_files and len(out_files) == 2
+    assert not os.path.exists(gz[:-len(".gz")])
+
+    newer = os.path.getmtime(gz) + 10
+    os.utime(sources[0], (newer, newer))
+    sink_run(tmp_path, sources)
+    assert compressed == [gz[:-len(".gz")]]
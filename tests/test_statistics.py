@@ -0,0 +1,260 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("pyarrow")
+
+from custom_nodes import voi_statistics
+from voi_histograms import write_subject_histograms
+from voi_results import from_voi_statistics, write_subject
+
+perfusion_map = "DSC_pgui_parametric_MTT"
+second_map = "DSC_pgui_oSVD_MTT"
+stats = ["_median", "_mean"]
+
+
+# one patient with MCA_contra (bit 0) and MCA_ipsi (bit 1) and two MTT maps; a third of the ipsilateral voxels are 0
+def zero_voxel_patient(st, directory, suffix="_reor_coreg"):
+    rng = np.random.default_rng(0)
+    shape = (8, 8, 6)
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[:4] = 1
+    labels[4:] = 2
+    data = np.where(labels == 1, rng.normal(4.0, 0.5, shape), rng.normal(6.0, 1.0, shape)).astype(np.float32)
+    data[4:, :, :2] = 0
+
+    maps_dir = os.path.join(directory, st.maps_folder, "PEG0001")
+    masks_dir = os.path.join(directory, st.masks_folder, "PEG0001")
+    work_dir = os.path.join(directory, "work")
+    for folder in (maps_dir, masks_dir, work_dir):
+        os.makedirs(folder)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(maps_dir, perfusion_map + suffix + ".nii.gz"))
+    nib.save(nib.Nifti1Image(data, np.eye(4)), os.path.join(work_dir, perfusion_map + ".nii.gz"))
+    nib.save(nib.Nifti1Image(data * 1.2, np.eye(4)), os.path.join(maps_dir, second_map + suffix + ".nii.gz"))
+    nib.save(nib.Nifti1Image(data * 1.2, np.eye(4)), os.path.join(work_dir, second_map + ".nii.gz"))
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), os.path.join(masks_dir, st.labels_file))
+    with open(os.path.join(masks_dir, st.labels_names), "w") as f:
+        json.dump({"territories": ["MCA_contra", "MCA_ipsi"]}, f)
+    return work_dir, masks_dir
+
+
+# writes the VOI results and histograms of both maps of the patient to the stores in directory
+def store_patient(st, directory, work_dir, masks_dir):
+    table, _, histograms = voi_statistics([os.path.join(work_dir, name + ".nii.gz") for name in (perfusion_map, second_map)],
+                                          os.path.join(masks_dir, st.labels_file),
+                                          os.path.join(masks_dir, st.labels_names))[:3]
+    write_subject(os.path.join(directory, "voi_results"), "PEG0001", from_voi_statistics(table, "PEG0001"))
+    write_subject_histograms(os.path.join(directory, "voi_histograms"), "PEG0001", histograms)
+
+
+# the VOI results store, the histograms and the nifti extraction exclude zero voxels in the same way and give the
+# same table of all maps
+def test_perfusion_sources_agree_with_zero_voxels(statistics_module, tmp_path, monkeypatch):
+    st = statistics_module
+    work_dir, masks_dir = zero_voxel_patient(st, str(tmp_path))
+    monkeypatch.chdir(work_dir)
+    store_patient(st, str(tmp_path), work_dir, masks_dir)
+
+    extracted = st.extract_patient("PEG0001", str(tmp_path), stats)
+    stored = st.read_voi_results_table(str(tmp_path / "voi_results"), ["PEG0001"], stats).loc["PEG0001"]
+    sketch = st.read_sketch_table(str(tmp_path / "voi_histograms"), ["PEG0001"], stats).loc["PEG0001"]
+
+    columns = [name + "_MCA_" + side + stat for name in (perfusion_map, second_map) for side in ("ipsi", "contra")
+               for stat in stats]
+    assert sorted(stored.index) == sorted(sketch.index) == sorted(extracted.index) == sorted(columns)
+    np.testing.assert_allclose(stored[columns].values, extracted[columns].values, rtol=1e-6)
+    # percentiles of the histograms are accurate to one bin (1024 bins)
+    np.testing.assert_allclose(sketch[columns].values, extracted[columns].values, rtol=5e-3)
+
+    rel_mtt = {source: values[perfusion_map + "_MCA_ipsi_median"] / values[perfusion_map + "_MCA_contra_median"]
+               for source, values in [("extracted", extracted), ("stored", stored), ("sketch", sketch)]}
+    assert rel_mtt["stored"] == pytest.approx(rel_mtt["extracted"], rel=1e-6)
+    assert rel_mtt["sketch"] == pytest.approx(rel_mtt["extracted"], rel=5e-3)
+
+
+# maps of runs with and without reorientation get the same columns
+@pytest.mark.parametrize("suffix", ["_reor_coreg", "_coreg", "_flirt"])
+def test_extract_patient_map_names(statistics_module, tmp_path, suffix):
+    st = statistics_module
+    zero_voxel_patient(st, str(tmp_path), suffix)
+    extracted = st.extract_patient("PEG0001", str(tmp_path), stats)
+    assert sorted(extracted.index) == sorted(name + "_MCA_" + side + stat for name in (perfusion_map, second_map)
+                                             for side in ("ipsi", "contra") for stat in stats)
+
+
+# the readers of the stores select maps
+def test_store_readers_select_maps(statistics_module, tmp_path, monkeypatch):
+    st = statistics_module
+    work_dir, masks_dir = zero_voxel_patient(st, str(tmp_path))
+    monkeypatch.chdir(work_dir)
+    store_patient(st, str(tmp_path), work_dir, masks_dir)
+    stored = st.read_voi_results_table(str(tmp_path / "voi_results"), ["PEG0001"], stats, [second_map])
+    sketch = st.read_sketch_table(str(tmp_path / "voi_histograms"), ["PEG0001"], stats, [second_map])
+    assert st.perfusion_maps(stored) == st.perfusion_maps(sketch) == [second_map]
+
+
+# the bootstrap reports the optimal threshold of do_the_ROC/opt_thr on every resample
+def test_batched_opt_threshold_matches_opt_thr(statistics_module, capsys):
+    st = statistics_module
+    rng = np.random.default_rng(8)
+    n_patients = 40
+    perf_vuln = rng.random(n_patients) < 0.4
+    # rounded scores give ties; with this seed one resample has its optimum between collinear points of the ROC curve
+    sim_score = np.round(np.where(perf_vuln, rng.normal(55, 8, n_patients), rng.normal(65, 8, n_patients)))
+    idx = rng.integers(0, n_patients, size=(300, n_patients))
+    batched = st.batched_metrics(perf_vuln, sim_score < st.sim_thr, sim_score, idx)
+    column = st.bootstrap_metrics.index("opt_threshold")
+    for row, resample in zip(batched, idx):
+        if perf_vuln[resample].all() or not perf_vuln[resample].any():
+            continue
+        roc = st.do_the_ROC(~perf_vuln[resample], sim_score[resample])
+        threshold, gmean, _, _ = st.opt_thr(roc, "resample")
+        assert row[column] == pytest.approx(threshold, abs=1e-4)
+        assert row[column + 1] == pytest.approx(gmean, abs=1e-4)
+    capsys.readouterr()
+
+
+# perfusion table of the batch with MTT in the MCA territory; patients P1, P2 and P4 are vulnerable (relMTT 1.5)
+def batch_table():
+    import pandas as pd
+    rel = {"PEG0001": 1.5, "PEG0002": 1.5, "PEG0003": 1.0, "PEG0004": 1.5, "PEG0005": 1.0}
+    return pd.DataFrame({perfusion_map + "_MCA_ipsi_median": [4.0 * r for r in rel.values()],
+                         perfusion_map + "_MCA_contra_median": 4.0}, index=list(rel))
+
+
+# simulation with M2 pressures of the given patients, the stenosis is on the left side
+def batch_simulation(pressures):
+    import pandas as pd
+    sim = pd.DataFrame({column: 90.0 for column in ["M2 sup R", "M2 inf R"]}, index=list(pressures))
+    sim["M2 sup L"] = list(pressures.values())
+    sim["M2 inf L"] = 90.0
+    sim["Stenosis_L0_R1"] = 0
+    return sim
+
+
+# a patient missing in one simulation is not simulated vulnerable and left out of its ROC, the batch continues
+def test_batch_with_patient_missing_in_simulation(statistics_module):
+    st = statistics_module
+    sims = {"MAP70": batch_simulation({"PEG0001": 40.0, "PEG0002": 45.0, "PEG0003": 60.0, "PEG0005": 70.0}),
+            "MAP80": batch_simulation({"PEG0001": 40.0, "PEG0002": 45.0, "PEG0003": 60.0, "PEG0004": 48.0,
+                                       "PEG0005": 70.0})}
+    results = st.batch_evaluation(batch_table(), sims, ["MCA"], ["_median"]).set_index("bp")
+    assert results.loc["MAP70", ["tp", "fn", "tn", "fp"]].tolist() == [2, 1, 2, 0]
+    assert results.loc["MAP80", ["tp", "fn", "tn", "fp"]].tolist() == [3, 0, 2, 0]
+    assert results.loc["MAP70", "auc"] == pytest.approx(1.0)
+    comparison = st.batch_delong(batch_table().assign(**{
+        "DSC_pgui_oSVD_MTT_MCA_ipsi_median": [5.0, 6.0, 4.0, 4.5, 4.0],
+        "DSC_pgui_oSVD_MTT_MCA_contra_median": 4.0}), sims, ["MCA"], ["_median"])
+    assert list(comparison["bp"]) == ["MAP70", "MAP80"]
+
+
+# only maps with a threshold are evaluated, reduced maps are vulnerable below their threshold
+def test_batch_thresholds_per_parameter(statistics_module, capsys):
+    st = statistics_module
+    table = batch_table().assign(**{"DSC_pgui_parametric_Tmax_MCA_ipsi_median": 3.0,
+                                    "DSC_pgui_parametric_Tmax_MCA_contra_median": 1.0,
+                                    "DSC_pgui_parametric_CBF_MCA_ipsi_median": [30.0, 30.0, 50.0, 30.0, 50.0],
+                                    "DSC_pgui_parametric_CBF_MCA_contra_median": 50.0})
+    sims = {"MAP70": batch_simulation({"PEG0001": 40.0, "PEG0002": 45.0, "PEG0003": 60.0, "PEG0004": 48.0,
+                                       "PEG0005": 70.0})}
+    results = st.batch_evaluation(table, sims, ["MCA"], ["_median"])
+    assert list(results["map"]) == [perfusion_map]
+    assert "DSC_pgui_parametric_CBF, DSC_pgui_parametric_Tmax - skipped" in capsys.readouterr().out
+    results = st.batch_evaluation(table, sims, ["MCA"], ["_median"], thresholds={"MTT": 1.387, "CBF": 0.7})
+    cbf = results.set_index("map").loc["DSC_pgui_parametric_CBF"]
+    assert [cbf["tp"], cbf["tn"]] == [3, 2]
+
+
+# a patient without files and without cached rows is skipped with an empty row
+def test_extract_cohort_skips_patients_without_files(statistics_module, tmp_path, capsys):
+    st = statistics_module
+    zero_voxel_patient(st, str(tmp_path))
+    df = st.extract_cohort(["PEG0001", "PEG0002"], str(tmp_path), stats, cache_dir=str(tmp_path / "cache"))
+    assert list(df.index) == ["PEG0001", "PEG0002"]
+    assert df.loc["PEG0001"].notna().all() and df.loc["PEG0002"].isna().all()
+    assert "No files of PEG0002 found" in capsys.readouterr().out
+
+
+## THRESHOLD SWEEP ##
+# relMTT and simulated pressure of a phantom cohort, rounded to the grids (ties) and with missing values
+def phantom_cohort(n_subjects=80):
+    import phantom
+    rng = np.random.default_rng(5)
+    truth = phantom.cohort_truth(n_subjects, rng=rng)
+    sim, _ = phantom.simulation_tables(truth, rng=rng)
+    right = truth["Stenosis_L0_R1"].to_numpy() == 1
+    pressure = np.where(right, sim[["M2 sup R", "M2 inf R"]].min(axis=1), sim[["M2 sup L", "M2 inf L"]].min(axis=1))
+    rel = truth["rel_mtt"].to_numpy().round(1)
+    pressure = pressure.round()
+    rel[[3, 17]] = np.nan
+    pressure[[5, 17, 40]] = np.nan
+    return rel, pressure
+
+
+# every pair of thresholds gives the confusion matrix of sklearn (NaN values are never vulnerable)
+def test_sweep_matches_confusion_matrix(statistics_module):
+    from sklearn.metrics import confusion_matrix
+    st = statistics_module
+    rel, pressure = phantom_cohort()
+    rel_grid = np.round(np.arange(0.8, 2.01, 0.1), 1)
+    sim_grid = np.arange(25.0, 90.0, 1.0)
+    sweep = st.sweep_thresholds(rel, pressure, rel_grid, sim_grid)
+    assert len(sweep) == len(rel_grid) * len(sim_grid)
+    for (rel_thr, sim_thr), row in sweep.iterrows():
+        with np.errstate(invalid="ignore"):
+            expected = confusion_matrix(rel >= rel_thr, pressure < sim_thr, labels=[False, True]).ravel()
+        assert row[["tn", "fp", "fn", "tp"]].tolist() == expected.tolist(), (rel_thr, sim_thr)
+
+
+# pairs dominated in sensitivity and specificity are dropped, ties are kept
+def test_pareto_pairs(statistics_module):
+    import pandas as pd
+    st = statistics_module
+    sweep = pd.DataFrame({"sens": [0.9, 0.8, 0.8, 0.7, 0.9, 0.5, np.nan],
+                          "spec": [0.5, 0.7, 0.6, 0.7, 0.5, 0.9, 1.0]},
+                         index=pd.Index(list("ABCDEFG"), name="pair"))
+    front = st.pareto_pairs(sweep)
+    assert list(front.index) == ["A", "E", "B", "F"]
+
+
+## DELONG ##
+# DeLong's covariance of the AUCs from all pairs of positives and negatives
+def naive_delong(y_true, scores):
+    positives, negatives = scores[y_true][:, np.newaxis, :], scores[~y_true][np.newaxis, :, :]
+    # psi of every positive x negative x score
+    psi = (positives > negatives) + 0.5 * (positives == negatives)
+    auc = psi.mean(axis=(0, 1))
+    v10, v01 = psi.mean(axis=1), psi.mean(axis=0)
+    cov = np.cov(v10, rowvar=False) / len(v10) + np.cov(v01, rowvar=False) / len(v01)
+    return auc, cov
+
+
+def test_delong_matches_naive_computation(statistics_module):
+    import pandas as pd
+    st = statistics_module
+    rng = np.random.default_rng(2)
+    y_true = rng.random(60) < 0.4
+    scores = np.column_stack([np.round(rng.normal(y_true * 1.0, 1.0), 1), rng.normal(y_true * 0.5, 1.0),
+                              np.round(rng.normal(y_true * 1.5, 1.0))])
+    auc, diff, se, p = st.delong_test(y_true, pd.DataFrame(scores, columns=["a", "b", "c"]))
+    expected_auc, cov = naive_delong(y_true, scores)
+    np.testing.assert_allclose(auc.to_numpy(), expected_auc)
+    expected_se = np.sqrt(np.maximum(np.diag(cov)[:, np.newaxis] + np.diag(cov)[np.newaxis, :] - 2 * cov, 0))
+    np.testing.assert_allclose(se.to_numpy(), expected_se, atol=1e-12)
+    np.testing.assert_allclose(diff.to_numpy(), expected_auc[:, np.newaxis] - expected_auc[np.newaxis, :])
+
+
+def test_delong_degenerate_cases(statistics_module):
+    import pandas as pd
+    st = statistics_module
+    scores = pd.DataFrame({"a": [1.0, 2.0, 3.0, 4.0], "b": [2.0, 1.0, 4.0, 3.0]})
+    auc, diff, se, p = st.delong_test(np.zeros(4, dtype=bool), scores)
+    assert auc.isna().all() and se.isna().all().all() and p.isna().all().all()
+    # identical predictors have no difference: variance 0 and p = 1
+    same = pd.DataFrame({"a": [1.0, 2.0, 3.0, 4.0, 2.5], "b": [1.0, 2.0, 3.0, 4.0, 2.5]})
+    auc, diff, se, p = st.delong_test(np.array([False, False, True, True, True]), same)
+    assert auc["a"] == auc["b"] and diff.loc["a", "b"] == 0
+    assert se.loc["a", "b"] == 0 and p.loc["a", "b"] == 1.0
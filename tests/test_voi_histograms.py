@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from voi_histograms import histogram_fraction_above, histogram_percentiles, histogram_statistics
+
+
+# histogram of the rows of values with the binning of voi_statistics (n_bins bins from the minimum to the maximum)
+def histograms(rows, n_bins=64):
+    counts, lo, hi = [], [], []
+    for values in rows:
+        values = np.asarray(values, dtype=np.float64)
+        row_lo, row_hi = values.min(), values.max()
+        index = np.zeros(values.size, dtype=np.int64)
+        if row_hi > row_lo:
+            index = np.minimum(((values - row_lo) * (n_bins / (row_hi - row_lo))).astype(np.int64), n_bins - 1)
+        counts.append(np.bincount(index, minlength=n_bins))
+        lo.append(row_lo)
+        hi.append(row_hi)
+    return np.array(counts), np.array(lo), np.array(hi)
+
+
+def test_empty_histogram():
+    counts, lo, hi = np.zeros((1, 16)), np.array([np.nan]), np.array([np.nan])
+    assert np.isnan(histogram_percentiles(counts, lo, hi, [0, 50, 100])).all()
+    with np.errstate(invalid="ignore"):
+        assert np.isnan(histogram_fraction_above(counts, lo, hi, 1.0)).all()
+
+
+# a territory of one value has all voxels in the first bin
+def test_all_mass_in_one_bin():
+    counts, lo, hi = histograms([np.full(20, 3.5)])
+    assert counts[0, 0] == 20
+    np.testing.assert_array_equal(histogram_percentiles(counts, lo, hi, [0, 25, 50, 100]), [[3.5] * 4])
+    assert histogram_fraction_above(counts, lo, hi, 3.0)[0] == 1.0
+    assert histogram_fraction_above(counts, lo, hi, 4.0)[0] == 0.0
+
+
+# percentiles 0 and 100 lie in the first and the last bin
+def test_extreme_percentiles():
+    rng = np.random.default_rng(1)
+    values = rng.gamma(4.0, 1.5, 500)
+    counts, lo, hi = histograms([values])
+    width = (hi - lo) / counts.shape[1]
+    p0, p100 = histogram_percentiles(counts, lo, hi, [0, 100])[0]
+    assert lo[0] <= p0 <= lo[0] + width[0]
+    assert hi[0] - width[0] <= p100 <= hi[0]
+
+
+# percentiles of several rows agree with np.percentile within one bin width, also without the zero voxels
+def test_percentiles_within_one_bin():
+    rng = np.random.default_rng(4)
+    rows = [rng.normal(4.0, 1.0, 300), rng.gamma(2.0, 3.0, 1000), np.round(rng.normal(50.0, 10.0, 200))]
+    rows[1][:100] = 0
+    q = [1, 10, 25, 50, 75, 90, 99]
+    counts, lo, hi = histograms(rows)
+    width = (hi - lo) / counts.shape[1]
+    values = histogram_percentiles(counts, lo, hi, q)
+    for row, expected, bin_width in zip(values, rows, width):
+        np.testing.assert_allclose(row, np.percentile(expected, q), atol=bin_width)
+
+    n_zero = np.array([np.count_nonzero(row == 0) for row in rows])
+    nonzero = histogram_percentiles(counts, lo, hi, q, n_zero)
+    for row, expected, bin_width in zip(nonzero, rows, width):
+        np.testing.assert_allclose(row, np.percentile(expected[expected != 0], q), atol=bin_width)
+    fraction = histogram_fraction_above(counts, lo, hi, 6.0)
+    np.testing.assert_allclose(fraction, [np.mean(row > 6.0) for row in rows], atol=0.02)
+
+
+# statistics of a histogram file with and without the zero voxels
+def test_histogram_statistics_zeros():
+    values = np.array([0, 0, 1, 2, 3, 4, 5, 6], dtype=np.float64)
+    counts, lo, hi = histograms([values], n_bins=6)
+    data = {"map": np.array(["DSC_pgui_parametric_MTT"]), "territory": np.array(["MCA_ipsi"]), "counts": counts,
+            "lo": lo, "hi": hi, "n_zero": np.array([2]), "sum": np.array([values.sum()])}
+    table = histogram_statistics(data, "PEG0001", ["mean"]).set_index("statistic")["value"]
+    assert table["mean"] == pytest.approx(values.mean()) and table["n_voxels"] == 8
+    table = histogram_statistics(data, "PEG0001", ["mean"], include_zeros=False).set_index("statistic")["value"]
+    assert table["mean"] == pytest.approx(3.5) and table["n_voxels"] == 6
@@ -0,0 +1,161 @@
+############################## VOI HISTOGRAMS ##################################
+# Histograms of the perfusion values of every subject x perfusion map x territory, saved by the voi_statistics node
+# of the pipeline (voi_histograms.npz next to voi_statistics.csv) and collected in a folder with one file per subject.
+# Percentiles, IQR, mean and the fraction of voxels above a threshold are computed from the histograms without
+# reading the images again.
+#
+# Arrays of a histogram file (one row per perfusion map x territory):
+#   map, territory   names of the row
+#   lo, hi           minimum and maximum value of the territory (NaN for empty territories)
+#   counts           number of voxels in n_bins equal bins from lo to hi
+#   n_zero           number of voxels with value 0
+#   sum              sum of all values
+# Percentiles are interpolated between the sorted values around their position as by np.percentile; every sorted value
+# is estimated within its bin (values are assumed to be uniform within a bin), so the error is at most one bin width,
+# (hi - lo) / n_bins. Zero voxels are in one bin and are removed from it if zeros are excluded.
+#
+# Statistics of sketch_table: "mean", "median", "iqr", "p<percentile>" (i.e. "p90") and "gt<threshold>" (fraction of
+# voxels above threshold, i.e. "gt6" for Tmax > 6 s)
+
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+## STORE ##
+def write_subject_histograms(store_dir, subject, path):
+    os.makedirs(store_dir, exist_ok=True)
+    target = os.path.join(store_dir, subject + ".npz")
+    temp = os.path.join(store_dir, ".%s.npz.%d" % (subject, os.getpid()))
+    shutil.copyfile(path, temp)
+    os.replace(temp, target)
+    return target
+
+
+def remove_subject_histograms(store_dir, subjects):
+    for subject in subjects:
+        path = os.path.join(store_dir, subject + ".npz")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def stored_histogram_subjects(store_dir):
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(f[:-len(".npz")] for f in os.listdir(store_dir) if f.endswith(".npz") and not f.startswith("."))
+
+
+def load_histograms(path):
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+## QUERIES ##
+# counts of the bins without the zero voxels (zeros are in the bin of 0)
+def _without_zeros(counts, lo, hi, n_zero):
+    counts = counts.copy()
+    n_bins = counts.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # same binning as in voi_statistics
+        zero_bin = np.floor((0.0 - lo) * (n_bins / (hi - lo)))
+    zero_bin = np.where(hi > lo, np.clip(np.nan_to_num(zero_bin), 0, n_bins - 1), 0).astype(np.int64)
+    rows = np.flatnonzero(n_zero > 0)
+    counts[rows, zero_bin[rows]] -= n_zero[rows]
+    return counts
+
+
+# percentiles q (0-100) of every row; returns (rows x percentiles)
+def histogram_percentiles(counts, lo, hi, q, n_zero=None):
+    counts = np.asarray(counts, dtype=np.float64)
+    lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+    if n_zero is not None:
+        counts = _without_zeros(counts, lo, hi, np.asarray(n_zero, dtype=np.float64))
+    n_rows, n_bins = counts.shape
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64)) / 100.0
+    cdf = np.cumsum(counts, axis=1)
+    total = cdf[:, -1]
+    # position of the percentile in the sorted values (as np.percentile)
+    position = q[np.newaxis, :] * np.maximum(total - 1, 0)[:, np.newaxis]
+    shift = (np.arange(n_rows) * (total.max() + 1 if n_rows else 1))[:, np.newaxis]
+
+    # value of the sorted value of every rank, assuming the values of a bin are uniform within the bin
+    def sorted_value(rank):
+        # bin of every rank, all rows in one search: the cumulative counts are shifted by row
+        bins = np.searchsorted((cdf + shift).ravel(), (rank + shift).ravel(), side="right").reshape(rank.shape)
+        bins = np.clip(bins - np.arange(n_rows)[:, np.newaxis] * n_bins, 0, n_bins - 1)
+        in_bin = np.take_along_axis(counts, bins, axis=1)
+        before = np.take_along_axis(cdf, bins, axis=1) - in_bin
+        with np.errstate(divide="ignore", invalid="ignore"):
+            within = np.clip((rank - before + 0.5) / in_bin, 0, 1)
+            return lo[:, np.newaxis] + (bins + np.nan_to_num(within)) * ((hi - lo) / n_bins)[:, np.newaxis]
+
+    # linear interpolation between the sorted values around the position (as np.percentile), also if they are in
+    # different bins
+    lower = np.floor(position)
+    upper = np.minimum(lower + 1, np.maximum(total - 1, 0)[:, np.newaxis])
+    fraction = position - lower
+    values = (1 - fraction) * sorted_value(lower) + fraction * sorted_value(upper)
+    values[total <= 0] = np.nan
+    return values
+
+
+# fraction of the voxels of every row above threshold (the bin of the threshold is split linearly)
+def histogram_fraction_above(counts, lo, hi, threshold, n_zero=None):
+    counts = np.asarray(counts, dtype=np.float64)
+    lo, hi = np.asarray(lo, dtype=np.float64), np.asarray(hi, dtype=np.float64)
+    if n_zero is not None:
+        counts = _without_zeros(counts, lo, hi, np.asarray(n_zero, dtype=np.float64))
+    n_bins = counts.shape[1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        position = np.where(hi > lo, (threshold - lo) * (n_bins / (hi - lo)), np.where(lo > threshold, 0, n_bins))
+        position = np.clip(np.nan_to_num(position), 0, n_bins)
+        edges = np.arange(n_bins)[np.newaxis, :]
+        # part of every bin above the threshold
+        above = np.clip(edges + 1 - position[:, np.newaxis], 0, 1)
+        return (counts * above).sum(axis=1) / counts.sum(axis=1)
+
+
+# statistics of the histograms of one subject as long rows (subject, map, territory, statistic, value);
+# include_zeros=True includes voxels with value 0 (as mean, median and n_voxels of voi_statistics.csv), False excludes
+# them (as the _nonzero statistics of voi_statistics.csv and statistics.py)
+def histogram_statistics(histograms, subject, statistics, include_zeros=True):
+    counts, lo, hi = histograms["counts"], histograms["lo"], histograms["hi"]
+    n_zero = None if include_zeros else histograms["n_zero"]
+    n_voxels = counts.sum(axis=1).astype(np.int64) - (0 if include_zeros else histograms["n_zero"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = {"n_voxels": n_voxels, "mean": histograms["sum"] / n_voxels}
+    percentiles = {}
+    for statistic in statistics:
+        if statistic == "median":
+            percentiles[statistic] = 50.0
+        elif statistic == "iqr":
+            percentiles["p25"], percentiles["p75"] = 25.0, 75.0
+        elif re.match(r"^p\d+(\.\d+)?$", statistic):
+            percentiles[statistic] = float(statistic[1:])
+        elif re.match(r"^gt-?\d+(\.\d+)?$", statistic):
+            values[statistic] = histogram_fraction_above(counts, lo, hi, float(statistic[2:]), n_zero)
+        elif statistic != "mean":
+            raise ValueError("Unknown histogram statistic %r" % statistic)
+    if percentiles:
+        results = histogram_percentiles(counts, lo, hi, list(percentiles.values()), n_zero)
+        values.update({name: results[:, i] for i, name in enumerate(percentiles)})
+    if "iqr" in statistics:
+        values["iqr"] = values["p75"] - values["p25"]
+    rows = pd.DataFrame({"map": histograms["map"], "territory": histograms["territory"]})
+    rows = pd.concat([rows.assign(statistic=name, value=values[name]) for name in list(statistics) + ["n_voxels"]],
+                     ignore_index=True)
+    rows.insert(0, "subject", subject)
+    return rows
+
+
+# statistics of the given subjects of the store as long rows, i.e. for voi_results.from_long_rows and to_wide
+def sketch_table(store_dir, subjects, statistics, include_zeros=True):
+    tables = [histogram_statistics(load_histograms(os.path.join(store_dir, subject + ".npz")), subject, statistics,
+                                   include_zeros)
+              for subject in subjects if os.path.exists(os.path.join(store_dir, subject + ".npz"))]
+    if not tables:
+        return pd.DataFrame(columns=["subject", "map", "territory", "statistic", "value"])
+    return pd.concat(tables, ignore_index=True)
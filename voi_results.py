@@ -0,0 +1,108 @@
+############################## VOI RESULTS STORE ###############################
+# Typed long-format table of the VOI results of the pipeline with one row per subject x perfusion map x territory x
+# statistic. The store is a folder of Parquet files (one per subject, requires pyarrow), so single subjects can be
+# replaced without rewriting the cohort and readers select columns and rows without parsing column names.
+#
+# Columns:
+#   subject    subject ID, i.e. PEG0005
+#   map        perfusion map, i.e. DSC_pgui_parametric_MTT
+#   algorithm  deconvolution algorithm of the map (parametric, oSVD, sSVD, c) or "" for maps without one (TTP)
+#   parameter  perfusion parameter of the map, i.e. MTT, CBF, CBV, Tmax, TTP
+#   territory  vascular territory, i.e. ACA, MCA, PCA, hemi
+#   side       ipsi or contra
+#   statistic  i.e. mean, median (all voxels of the territory), mean_nonzero, median_nonzero, n_nonzero (voxels with
+#              value 0 excluded)
+#   value      value of the statistic
+#   n_voxels   number of voxels in the territory
+
+import os
+
+import pandas as pd
+
+
+COLUMNS = ["subject", "map", "algorithm", "parameter", "territory", "side", "statistic", "value", "n_voxels"]
+CATEGORIES = ["subject", "map", "algorithm", "parameter", "territory", "side", "statistic"]
+
+
+# splits a perfusion map name, i.e. DSC_pgui_parametric_MTT -> ("parametric", "MTT"), DSC_pgui_TTP -> ("", "TTP")
+def split_map_name(map_name):
+    parts = map_name.replace("DSC_pgui_", "", 1).split("_")
+    return ("_".join(parts[:-1]), parts[-1])
+
+
+# splits a territory name, i.e. MCA_ipsi -> ("MCA", "ipsi")
+def split_territory(territory):
+    name, _, side = territory.rpartition("_")
+    return (name, side) if name else (territory, "")
+
+
+# creates the typed table from rows with the columns subject, map, territory, statistic, value
+# (i.e. the rows of the manifest); the statistic "n_voxels" becomes its own column
+def from_long_rows(rows):
+    rows = rows[["subject", "map", "territory", "statistic", "value"]]
+    is_count = rows["statistic"] == "n_voxels"
+    counts = rows[is_count].drop(columns="statistic").rename(columns={"value": "n_voxels"})
+    table = rows[~is_count].merge(counts, on=["subject", "map", "territory"], how="left")
+
+    maps = {name: split_map_name(name) for name in table["map"].unique()}
+    territories = {name: split_territory(name) for name in table["territory"].unique()}
+    table["algorithm"] = table["map"].map(lambda name: maps[name][0])
+    table["parameter"] = table["map"].map(lambda name: maps[name][1])
+    table["side"] = table["territory"].map(lambda name: territories[name][1])
+    table["territory"] = table["territory"].map(lambda name: territories[name][0])
+
+    table = table[COLUMNS].astype({column: "category" for column in CATEGORIES})
+    table["value"] = table["value"].astype("float64")
+    table["n_voxels"] = table["n_voxels"].fillna(0).astype("int64")
+    return table.reset_index(drop=True)
+
+
+# creates the typed table of one subject from its voi_statistics.csv (columns map, territory and one per statistic)
+def from_voi_statistics(path, subject):
+    rows = pd.read_csv(path).melt(id_vars=["map", "territory"], var_name="statistic")
+    rows.insert(0, "subject", subject)
+    return from_long_rows(rows)
+
+
+# writes the table of one subject; the temporary file starts with "." and is ignored by readers of the store
+def write_subject(store_dir, subject, table):
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, subject + ".parquet")
+    temp = os.path.join(store_dir, ".%s.parquet.%d" % (subject, os.getpid()))
+    table.to_parquet(temp, index=False)
+    os.replace(temp, path)
+    return path
+
+
+# removes the tables of the given subjects, i.e. before a complete rebuild of the store
+def remove_subjects(store_dir, subjects):
+    for subject in subjects:
+        path = os.path.join(store_dir, subject + ".parquet")
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# subjects with a table in the store
+def stored_subjects(store_dir):
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(f[:-len(".parquet")] for f in os.listdir(store_dir) if f.endswith(".parquet") and not f.startswith("."))
+
+
+# reads the store with column and row selection, i.e.
+# read_voi_results(store_dir, columns=["subject", "territory", "side", "value"],
+#                  filters=[("map", "==", "DSC_pgui_parametric_MTT"), ("statistic", "in", ["median"])])
+def read_voi_results(store_dir, columns=None, filters=None):
+    if not stored_subjects(store_dir):
+        return pd.DataFrame(columns=columns or COLUMNS)
+    return pd.read_parquet(store_dir, columns=columns, filters=filters)
+
+
+# one row per subject, columns are named <map>_<territory>_<side>_<statistic>, i.e. DSC_pgui_parametric_MTT_MCA_ipsi_median
+def to_wide(table):
+    table = table.astype({column: str for column in ["map", "territory", "side", "statistic"]})
+    names = table["map"] + "_" + table["territory"] + "_" + table["side"] + "_" + table["statistic"]
+    wide = table.assign(column=names).pivot_table(index="subject", columns="column", values="value", observed=True)
+    wide.columns.name = None
+    wide.index = wide.index.astype(str)
+    return wide